@@ -0,0 +1,121 @@
+"""
+Minimal stand-ins for the python-telegram-bot objects the handlers touch.
+
+Messages are recorded instead of sent, so the bot's handlers can be driven
+end to end without Telegram.
+"""
+
+import itertools
+from typing import List, Optional
+
+from telegram.helpers import escape_markdown
+
+
+class Outbox:
+    """Everything the bot sent or edited"""
+
+    def __init__(self):
+        self.sent = 0
+        self.edits = 0
+        self.bytes = 0
+        self.texts: List[str] = []
+        self._ids = itertools.count(1)
+
+    def record(self, text: str, edit: bool):
+        if edit:
+            self.edits += 1
+        else:
+            self.sent += 1
+        self.bytes += len(text.encode())
+        self.texts.append(text)
+
+    def reset(self):
+        self.sent = self.edits = self.bytes = 0
+        self.texts.clear()
+
+    @property
+    def last(self) -> str:
+        return self.texts[-1] if self.texts else ""
+
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+        self.type = "private"
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = "Bench"
+        self.username = f"bench{user_id}"
+
+
+class FakeMessage:
+    def __init__(self, outbox: Outbox, chat_id: int, text: str = ""):
+        self.outbox = outbox
+        self.message_id = next(outbox._ids)
+        self.chat_id = chat_id
+        self.chat = FakeChat(chat_id)
+        self.text = text
+
+    @property
+    def text_markdown_v2(self) -> str:
+        # No entities are recorded, so the text is all literal
+        return escape_markdown(self.text, version=2)
+
+    async def reply_text(self, text: str, **kwargs) -> "FakeMessage":
+        self.outbox.record(text, edit=False)
+        return FakeMessage(self.outbox, self.chat_id, text)
+
+    async def edit_text(self, text: str, **kwargs) -> "FakeMessage":
+        self.outbox.record(text, edit=True)
+        self.text = text
+        return self
+
+    async def edit_reply_markup(self, reply_markup=None, **kwargs) -> "FakeMessage":
+        return self
+
+
+class FakeCallbackQuery:
+    def __init__(self, outbox: Outbox, user_id: int, data: str, message: FakeMessage = None):
+        self.data = data
+        self.from_user = FakeUser(user_id)
+        self.message = message or FakeMessage(outbox, user_id)
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, text: str, **kwargs):
+        return await self.message.edit_text(text, **kwargs)
+
+    async def edit_message_reply_markup(self, reply_markup=None, **kwargs):
+        return await self.message.edit_reply_markup(reply_markup)
+
+
+class FakeUpdate:
+    """An incoming text message or button press"""
+
+    def __init__(self, outbox: Outbox, user_id: int, text: str = "", callback_data: Optional[str] = None):
+        self.effective_user = FakeUser(user_id)
+        self.effective_chat = FakeChat(user_id)
+        if callback_data is None:
+            self.message = FakeMessage(outbox, user_id, text)
+            self.callback_query = None
+        else:
+            self.message = None
+            self.callback_query = FakeCallbackQuery(outbox, user_id, callback_data)
+
+    @property
+    def effective_message(self) -> FakeMessage:
+        return self.message or self.callback_query.message
+
+
+class FakeContext:
+    """The parts of ContextTypes.DEFAULT_TYPE the handlers use"""
+
+    def __init__(self, user_data: dict = None, args: List[str] = None):
+        self.user_data = user_data if user_data is not None else {}
+        self.chat_data = {}
+        self.bot_data = {}
+        self.args = args or []
@@ -0,0 +1,22 @@
+"""Session authentication."""
+
+import hashlib
+import hmac
+
+SESSION_TTL = 3600
+
+
+def hash_password(password, salt):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, 100_000)
+
+
+def login(user, password):
+    """Start a session for `user` if the password matches."""
+    expected = hash_password(password, user.salt)
+    if expected == user.password_hash:
+        return user.start_session(SESSION_TTL)
+    return None
+
+
+def logout(session):
+    session.invalidate()
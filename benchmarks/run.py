@@ -0,0 +1,248 @@
+"""
+End-to-end latency benchmarks for the bot.
+
+Drives get_repo_structure, get_code_context, view_file, process_code_task
+and apply_fix against local GitHub and LLM stand-ins (servers.py) through
+fake Telegram objects (fake_telegram.py), for repositories of different sizes,
+and reports latency percentiles, API calls and bytes transferred.
+
+    python benchmarks/run.py
+    python benchmarks/run.py --sizes 10,1000 --iterations 50 --json results.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from servers import GitHubStandIn, LLMStandIn, TARGET_PATH  # noqa: E402
+from fake_telegram import Outbox, FakeUpdate, FakeCallbackQuery, FakeContext, FakeMessage  # noqa: E402
+
+USER_ID = 4242
+TOKEN = "bench-github-token"
+REQUEST = "Fix the login timing attack in auth: password hashes are compared with =="
+
+SCENARIOS = ("get_repo_structure", "get_code_context", "view_file", "process_code_task", "apply_fix")
+
+
+def percentile(samples, pct: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+class Bench:
+    """One bot instance wired to stand-ins for a repository of `size` files"""
+
+    def __init__(self, size: int, args):
+        self.size = size
+        self.args = args
+        self.outbox = Outbox()
+        self.github = GitHubStandIn(size, truncate_at=args.truncate_at, latency=args.github_latency / 1000)
+        self.llm = LLMStandIn(latency=args.llm_latency / 1000, chunk_delay=args.llm_chunk_delay / 1000)
+        self.cache_dir = tempfile.TemporaryDirectory(prefix="repofiy-bench-")
+        self.bot = None
+        self.fix_data = None
+
+    async def __aenter__(self):
+        await self.github.start()
+        await self.llm.start()
+        os.environ.update({
+            'REPOFIY_GITHUB_API_URL': self.github.url,
+            'REPOFIY_GROQ_URL': self.llm.endpoint,
+            'REPOFIY_OPENROUTER_URL': self.llm.endpoint,
+            'REPOFIY_CACHE_DIR': self.cache_dir.name,
+            'REPOFIY_SESSION_URL': 'memory://',
+            'REPOFIY_TELEGRAM_CHAT_INTERVAL': str(self.args.telegram_interval),
+        })
+        os.environ.pop('REPOFIY_RESPONSE_CACHE_DB', None)
+        import repofiy_bot
+        self.bot = repofiy_bot.BugFixerBot("bench-telegram-token", groq_key="bench-groq-key")
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.bot.shutdown(None)
+        await self.llm.stop()
+        await self.github.stop()
+        self.cache_dir.cleanup()
+
+    def context(self) -> FakeContext:
+        return FakeContext({
+            'github_token': TOKEN,
+            'repo': self.github.full_name,
+            'ai_provider': 'groq',
+        })
+
+    async def get_repo_structure(self):
+        repo = await self.bot.github.get_repo(TOKEN, self.github.full_name)
+        structure = await self.bot.get_repo_structure(repo)
+        assert structure, "empty structure"
+
+    async def get_code_context(self):
+        context = self.context()
+        repo = await self.bot.github.get_repo(TOKEN, self.github.full_name)
+        code_context = await self.bot.get_code_context(
+            repo, REQUEST, token_budget=self.bot.context_budget(context.user_data)
+        )
+        assert TARGET_PATH in code_context, "target file missing from context"
+
+    async def view_file(self):
+        await self.bot.view_file(FakeUpdate(self.outbox, USER_ID, "/view"), self.context(), TARGET_PATH,
+                                 self.github.full_name)
+        assert TARGET_PATH in self.outbox.last, self.outbox.last
+
+    async def process_code_task(self):
+        update = FakeUpdate(self.outbox, USER_ID, f"/fix {REQUEST}")
+        await self.bot.process_code_task(update, self.context(), REQUEST, "fix", bypass_cache=True)
+        await self._wait_for_tasks()
+        self.fix_data = await self.bot.sessions.get("fix", USER_ID)
+        assert self.fix_data and self.fix_data['solution'].get('changes'), self.outbox.last
+
+    async def apply_fix(self):
+        if self.fix_data is None:
+            await self.process_code_task()
+        query = FakeCallbackQuery(self.outbox, USER_ID, f"apply_{USER_ID}", FakeMessage(self.outbox, USER_ID))
+        await self.bot.apply_fix(query, self.context(), USER_ID, dict(self.fix_data))
+        assert "Successfully" in self.outbox.last, self.outbox.last
+
+    async def _wait_for_tasks(self):
+        while True:
+            jobs = self.bot.tasks.user_tasks(USER_ID)
+            if not jobs:
+                return
+            running = [job.task for job in jobs if job.task is not None]
+            if running:
+                await asyncio.wait(running)
+            else:
+                await asyncio.sleep(0.001)
+
+    async def measure(self, scenario: str) -> dict:
+        """Run `scenario` for the configured iterations; the first run is reported as cold"""
+        step = getattr(self, scenario)
+        runs = []
+        for _ in range(self.args.iterations):
+            self.github.stats.reset()
+            self.llm.stats.reset()
+            self.outbox.reset()
+            self.github.remaining = 5000
+            started = time.perf_counter()
+            await step()
+            elapsed = (time.perf_counter() - started) * 1000
+            runs.append({
+                'ms': elapsed,
+                'github_calls': self.github.stats.total_calls,
+                'github_bytes': self.github.stats.bytes_in + self.github.stats.bytes_out,
+                'llm_calls': self.llm.stats.total_calls,
+                'llm_bytes': self.llm.stats.bytes_in + self.llm.stats.bytes_out,
+                'telegram_messages': self.outbox.sent + self.outbox.edits,
+            })
+        cold, warm = runs[0], runs[1:] or runs[:1]
+        latencies = [run['ms'] for run in warm]
+
+        def mean(key):
+            return sum(run[key] for run in warm) / len(warm)
+
+        return {
+            'files': self.size,
+            'scenario': scenario,
+            'iterations': len(runs),
+            'cold_ms': cold['ms'],
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'cold_github_calls': cold['github_calls'],
+            'cold_github_bytes': cold['github_bytes'],
+            'github_calls': mean('github_calls'),
+            'github_bytes': mean('github_bytes'),
+            'llm_calls': mean('llm_calls'),
+            'llm_bytes': mean('llm_bytes'),
+            'telegram_messages': mean('telegram_messages'),
+        }
+
+
+def format_bytes(count: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if count < 1024 or unit == "MB":
+            return f"{count:.0f}{unit}" if unit == "B" else f"{count:.1f}{unit}"
+        count /= 1024
+
+
+def print_table(results):
+    header = (
+        f"{'files':>6}  {'scenario':<19} {'cold ms':>9} {'p50 ms':>8} {'p95 ms':>8}  "
+        f"{'GitHub calls':>12} {'GitHub bytes':>15}  {'LLM calls':>9} {'LLM bytes':>9}  {'TG msgs':>7}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['files']:>6}  {r['scenario']:<19} {r['cold_ms']:>9.1f} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f}  "
+            f"{r['cold_github_calls']:>5}/{r['github_calls']:<6.1f} "
+            f"{format_bytes(r['cold_github_bytes']):>7}/{format_bytes(r['github_bytes']):<7}  "
+            f"{r['llm_calls']:>9.1f} {format_bytes(r['llm_bytes']):>9}  {r['telegram_messages']:>7.1f}"
+        )
+    print("\nGitHub columns are cold/warm-mean; p50/p95 and the other columns cover the warm runs.")
+
+
+async def main(args) -> list:
+    results = []
+    for size in args.sizes:
+        setup = time.perf_counter()
+        async with Bench(size, args) as bench:
+            logging.getLogger('benchmarks').info(f"{size} files ready in {time.perf_counter() - setup:.1f}s")
+            for scenario in args.scenarios:
+                results.append(await bench.measure(scenario))
+                if not args.json_only:
+                    r = results[-1]
+                    print(f"{size:>6} files  {scenario:<19} p50 {r['p50_ms']:.1f} ms", file=sys.stderr)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default="10,1000,50000",
+                        type=lambda value: [int(size) for size in value.split(',')],
+                        help="comma-separated repository sizes in files (default: 10,1000,50000)")
+    parser.add_argument('--iterations', type=int, default=20, help="runs per scenario, the first is cold")
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS),
+                        type=lambda value: [name for name in value.split(',') if name],
+                        help="comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument('--github-latency', type=float, default=0.0, help="added ms per GitHub response")
+    parser.add_argument('--llm-latency', type=float, default=50.0, help="ms before the first LLM token")
+    parser.add_argument('--llm-chunk-delay', type=float, default=0.0, help="ms between streamed LLM chunks")
+    parser.add_argument('--telegram-interval', type=float, default=0.0,
+                        help="seconds between edits of one chat (the bot defaults to 1.0)")
+    parser.add_argument('--truncate-at', type=int, default=100000,
+                        help="entries before a recursive tree listing is truncated, as GitHub does")
+    parser.add_argument('--json', dest='json_path', help="also write the results to this file")
+    parser.add_argument('--json-only', action='store_true', help="print JSON instead of the table")
+    parser.add_argument('--verbose', action='store_true', help="keep the bot's INFO logging")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    import repofiy_bot  # noqa: E402,F401  (configures logging on import)
+    logging.getLogger('repofiy_bot').setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger('benchmarks').setLevel(logging.INFO)
+
+    results = asyncio.run(main(args))
+    if args.json_only:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
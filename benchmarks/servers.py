@@ -0,0 +1,392 @@
+"""
+Local stand-ins for the GitHub REST API and an OpenAI-compatible LLM API.
+
+Both replay the recorded responses in fixtures/ and count the requests and
+bytes they serve, so a benchmark run never leaves the machine.
+"""
+
+import asyncio
+import base64
+import copy
+import hashlib
+import json
+import os
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# File every benchmark request is about; its fix is the recorded completion
+TARGET_PATH = "src/app/auth.py"
+
+
+def load_fixture(*parts: str):
+    with open(os.path.join(FIXTURES, *parts), 'r', encoding='utf-8') as f:
+        if parts[-1].endswith('.json'):
+            return json.load(f)
+        return f.read()
+
+
+def render(template, **values):
+    """Fill {{name}} placeholders in a recorded response"""
+    if isinstance(template, dict):
+        return {key: render(value, **values) for key, value in template.items()}
+    if isinstance(template, list):
+        return [render(value, **values) for value in template]
+    if isinstance(template, str):
+        if template.startswith('{{') and template.endswith('}}') and template[2:-2] in values:
+            # Whole-value placeholders keep the value's type (numbers, ...)
+            return values[template[2:-2]]
+        for key, value in values.items():
+            template = template.replace(f'{{{{{key}}}}}', str(value))
+    return template
+
+
+def git_sha(kind: str, data: bytes) -> str:
+    return hashlib.sha1(f"{kind} {len(data)}\0".encode() + data).hexdigest()
+
+
+class ServerStats:
+    """Requests and bytes per endpoint"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def reset(self):
+        self.calls.clear()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def snapshot(self) -> dict:
+        return {'calls': self.total_calls, 'bytes': self.bytes_in + self.bytes_out, 'endpoints': dict(self.calls)}
+
+
+class StandInServer:
+    """aiohttp server on a free localhost port that keeps ServerStats"""
+
+    def __init__(self):
+        self.stats = ServerStats()
+        self.port: Optional[int] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def routes(self, app: web.Application):
+        raise NotImplementedError
+
+    @web.middleware
+    async def _count(self, request: web.Request, handler):
+        body = await request.read()
+        self.stats.bytes_in += len(body)
+        response = await handler(request)
+        self.stats.calls[f"{request.method} {request.match_info.route.resource.canonical}"] += 1
+        if isinstance(response, web.Response) and response.body is not None:
+            self.stats.bytes_out += len(response.body)
+        return response
+
+    async def start(self):
+        app = web.Application(middlewares=[self._count], client_max_size=64 * 1024 * 1024)
+        self.routes(app)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class GitHubStandIn(StandInServer):
+    """GitHub REST API for one synthetic repository of `file_count` files.
+
+    Serves the endpoints the bot uses: repository, ref, branch, recursive and
+    single-level trees, blobs, and the Git Data + pulls endpoints behind a
+    commit. Responses carry ETags (answered with 304 when unchanged) and rate
+    limit headers like the real API. Recursive listings over `truncate_at`
+    entries are truncated, as GitHub does for very large repositories.
+    """
+
+    def __init__(self, file_count: int, owner: str = "bench", name: str = "repo", branch: str = "main",
+                 truncate_at: int = 100000, latency: float = 0.0):
+        super().__init__()
+        self.owner, self.name, self.branch = owner, name, branch
+        self.truncate_at = truncate_at
+        self.latency = latency
+        self.remaining = 5000
+        self.pulls = 0
+        self.templates = {
+            name[:-5]: load_fixture('github', name)
+            for name in os.listdir(os.path.join(FIXTURES, 'github'))
+        }
+        self.files = self._build_files(file_count)
+        self.blobs = {}
+        self.trees: Dict[str, List[dict]] = {}
+        self._build_trees()
+        self.commit_sha = git_sha("commit", f"tree {self.root_sha}\n\nInitial commit\n".encode())
+        self._created = 0
+
+    @property
+    def full_name(self) -> str:
+        return f"{self.owner}/{self.name}"
+
+    @staticmethod
+    def _build_files(count: int) -> Dict[str, bytes]:
+        files = {
+            "README.md": b"# Benchmark repository\n\nSynthetic code base used by the benchmarks.\n",
+            TARGET_PATH: load_fixture('repo', 'auth.py').encode(),
+            "src/app/__init__.py": b"",
+        }
+        for i in range(count - len(files)):
+            files[f"src/pkg{i // 100:03d}/module_{i:05d}.py"] = (
+                f'"""Module {i}."""\n\n\n'
+                f'def handler_{i}(value):\n'
+                f'    return value + {i}\n\n\n'
+                f'class Service{i}:\n'
+                f'    def run(self):\n'
+                f'        return handler_{i}(1)\n'
+            ).encode()
+        return dict(list(files.items())[:count])
+
+    def _build_trees(self):
+        """Blob shas and every directory's entries, deepest directories first"""
+        files: Dict[str, List[tuple]] = {"": []}
+        subdirs: Dict[str, List[str]] = {"": []}
+        listed = set()
+        for path, data in self.files.items():
+            sha = git_sha("blob", data)
+            self.blobs[sha] = data
+            parent = path.rpartition('/')[0]
+            files.setdefault(parent, []).append((path, 'blob', sha, len(data)))
+            while parent and parent not in listed:
+                listed.add(parent)
+                subdirs.setdefault(parent, [])
+                grandparent = parent.rpartition('/')[0]
+                subdirs.setdefault(grandparent, []).append(parent)
+                parent = grandparent
+
+        shas: Dict[str, str] = {}
+        for directory in sorted(subdirs, key=lambda d: d.count('/') if d else -1, reverse=True):
+            entries = list(files.get(directory, []))
+            entries += [(d, 'tree', shas[d], 0) for d in subdirs[directory]]
+            entries.sort()
+            shas[directory] = git_sha("tree", "".join(f"{p}{s}" for p, _, s, _ in entries).encode())
+            self.trees[shas[directory]] = entries
+        self.root_sha = shas[""]
+        self.tree_paths = {sha: directory for directory, sha in shas.items()}
+
+    def _headers(self, etag: str = None) -> dict:
+        self.remaining = max(self.remaining - 1, 0)
+        headers = {
+            'X-RateLimit-Limit': '5000',
+            'X-RateLimit-Remaining': str(self.remaining),
+            'X-RateLimit-Reset': str(int(time.time()) + 3600),
+        }
+        if etag:
+            headers['ETag'] = etag
+        return headers
+
+    async def _reply(self, request: web.Request, body, status: int = 200, etag: str = None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if etag and request.headers.get('If-None-Match') == etag:
+            # Conditional hits don't count against the rate limit
+            self.remaining += 1
+            return web.Response(status=304, headers=self._headers(etag))
+        return web.json_response(body, status=status, headers=self._headers(etag))
+
+    def _values(self, **extra) -> dict:
+        return dict(base=self.url, owner=self.owner, name=self.name, branch=self.branch, **extra)
+
+    def routes(self, app: web.Application):
+        repo = f"/repos/{self.owner}/{self.name}"
+        app.router.add_get(repo, self.get_repo)
+        app.router.add_get(f"{repo}/git/ref/heads/{{branch}}", self.get_ref)
+        app.router.add_get(f"{repo}/branches/{{branch}}", self.get_branch)
+        app.router.add_get(f"{repo}/git/trees/{{sha}}", self.get_tree)
+        app.router.add_get(f"{repo}/git/blobs/{{sha}}", self.get_blob)
+        app.router.add_get(f"{repo}/git/commits/{{sha}}", self.get_commit)
+        app.router.add_post(f"{repo}/git/blobs", self.create_blob)
+        app.router.add_post(f"{repo}/git/trees", self.create_tree)
+        app.router.add_post(f"{repo}/git/commits", self.create_commit)
+        app.router.add_post(f"{repo}/git/refs", self.create_ref)
+        app.router.add_post(f"{repo}/pulls", self.create_pull)
+
+    async def get_repo(self, request):
+        return await self._reply(request, render(self.templates['repo'], **self._values()), etag='"repo-v1"')
+
+    async def get_ref(self, request):
+        body = render(self.templates['ref'], **self._values(sha=self.commit_sha))
+        return await self._reply(request, body, etag=f'"ref-{self.commit_sha}"')
+
+    async def get_branch(self, request):
+        body = render(self.templates['branch'], **self._values(sha=self.commit_sha, tree=self.root_sha))
+        return await self._reply(request, body)
+
+    async def get_commit(self, request):
+        sha = request.match_info['sha']
+        body = render(self.templates['commit'], **self._values(sha=sha, tree=self.root_sha, message="Initial commit"))
+        return await self._reply(request, body)
+
+    async def get_tree(self, request):
+        sha = request.match_info['sha']
+        if sha in (self.commit_sha, self.branch):
+            sha = self.root_sha
+        if sha not in self.trees:
+            return await self._reply(request, {"message": "Not Found"}, status=404)
+
+        prefix = self.tree_paths[sha]
+        prefix = f"{prefix}/" if prefix else ""
+        if request.query.get('recursive'):
+            entries = [
+                entry for directory, directory_sha in self._subdirectories(sha)
+                for entry in self.trees[directory_sha]
+            ]
+        else:
+            entries = self.trees[sha]
+        truncated = len(entries) > self.truncate_at
+        body = render(self.templates['tree'], **self._values(sha=sha))
+        body['tree'] = [
+            {
+                'path': path[len(prefix):],
+                'mode': '040000' if kind == 'tree' else '100644',
+                'type': kind,
+                'sha': entry_sha,
+                **({'size': size} if kind == 'blob' else {}),
+                'url': f"{self.url}/repos/{self.full_name}/git/{kind}s/{entry_sha}",
+            }
+            for path, kind, entry_sha, size in sorted(entries[:self.truncate_at])
+        ]
+        body['truncated'] = truncated
+        return await self._reply(request, body)
+
+    def _subdirectories(self, sha: str):
+        """(path, sha) of a tree and every tree below it"""
+        stack = [sha]
+        while stack:
+            current = stack.pop()
+            yield self.tree_paths[current], current
+            stack.extend(entry_sha for _, kind, entry_sha, _ in self.trees[current] if kind == 'tree')
+
+    async def get_blob(self, request):
+        sha = request.match_info['sha']
+        data = self.blobs.get(sha)
+        if data is None:
+            return await self._reply(request, {"message": "Not Found"}, status=404)
+        body = render(
+            self.templates['blob'],
+            **self._values(sha=sha, size=len(data), content=base64.b64encode(data).decode())
+        )
+        return await self._reply(request, body)
+
+    def _new_sha(self, kind: str) -> str:
+        self._created += 1
+        return git_sha(kind, f"created {self._created}".encode())
+
+    async def create_blob(self, request):
+        payload = await request.json()
+        sha = git_sha("blob", payload['content'].encode())
+        return await self._reply(request, render(self.templates['blob_created'], **self._values(sha=sha)), status=201)
+
+    async def create_tree(self, request):
+        payload = await request.json()
+        for element in payload.get('tree', []):
+            # GitHub wants exactly one of sha (null deletes) and content
+            if ('sha' in element) == ('content' in element):
+                return web.json_response({'message': 'Invalid tree element', 'element': element}, status=422)
+        body = render(self.templates['tree'], **self._values(sha=self._new_sha("tree")))
+        return await self._reply(request, body, status=201)
+
+    async def create_commit(self, request):
+        payload = await request.json()
+        body = render(
+            self.templates['commit'],
+            **self._values(sha=self._new_sha("commit"), tree=payload['tree'], message=payload['message'])
+        )
+        return await self._reply(request, body, status=201)
+
+    async def create_ref(self, request):
+        payload = await request.json()
+        body = render(self.templates['ref'], **self._values(sha=payload['sha']))
+        body['ref'] = payload['ref']
+        return await self._reply(request, body, status=201)
+
+    async def create_pull(self, request):
+        payload = await request.json()
+        self.pulls += 1
+        body = render(
+            self.templates['pull'],
+            **self._values(number=self.pulls, title=payload['title'], body=payload.get('body', ''),
+                           head=payload['head'], sha=self.commit_sha)
+        )
+        return await self._reply(request, body, status=201)
+
+
+class LLMStandIn(StandInServer):
+    """OpenAI-compatible chat completions endpoint (Groq, OpenRouter).
+
+    Answers every request with the recorded completion, after `latency`
+    seconds. Streaming requests get it as server-sent events in chunks of
+    `chunk_size` characters, `chunk_delay` seconds apart.
+    """
+
+    PATH = "/openai/v1/chat/completions"
+
+    def __init__(self, latency: float = 0.05, chunk_size: int = 16, chunk_delay: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.completion = load_fixture('llm', 'completion.json')
+        self.prompt_chars = 0
+
+    @property
+    def endpoint(self) -> str:
+        return f"{self.url}{self.PATH}"
+
+    def routes(self, app: web.Application):
+        app.router.add_post(self.PATH, self.complete)
+
+    async def complete(self, request):
+        payload = await request.json()
+        self.prompt_chars += sum(len(str(message.get('content', ''))) for message in payload.get('messages', []))
+        await asyncio.sleep(self.latency)
+        completion = copy.deepcopy(self.completion)
+        completion['model'] = payload.get('model', completion['model'])
+        if not payload.get('stream'):
+            return web.json_response(completion)
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        content = completion['choices'][0]['message']['content']
+        for i in range(0, len(content), self.chunk_size):
+            chunk = {
+                'id': completion['id'],
+                'object': 'chat.completion.chunk',
+                'model': completion['model'],
+                'choices': [{'index': 0, 'delta': {'content': content[i:i + self.chunk_size]}, 'finish_reason': None}],
+            }
+            event = f"data: {json.dumps(chunk)}\n\n".encode()
+            self.stats.bytes_out += len(event)
+            try:
+                await response.write(event)
+            except ConnectionResetError:
+                # The bot stops reading once the JSON object is complete
+                return response
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        return response
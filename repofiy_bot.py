@@ -6,7 +6,7 @@ Fix bugs, create features, make code changes, refactor code, and manage your ent
 import os
 import logging
 import asyncio
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, NamedTuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -14,15 +14,37 @@ from telegram.ext import (
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    BasePersistence,
+    PersistenceInput,
     filters,
 )
-import requests
-from github import Github, GithubException
+from telegram.error import BadRequest, RetryAfter
+import aiohttp
+from aiohttp import web
+from github import Github, GithubException, InputGitTreeElement
+from github.Repository import Repository
 import json
 import subprocess
 import tempfile
 import shutil
 import time
+import base64
+import threading
+import functools
+import hashlib
+import re
+import math
+import ast
+import sqlite3
+import hmac
+import signal
+import random
+import difflib
+import heapq
+from collections import OrderedDict, Counter, deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(
@@ -31,6 +53,3109 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Directories that never contribute useful context
+IGNORED_DIRS = {'node_modules', '__pycache__', '.git', 'venv', 'env', 'dist', 'build'}
+
+# GitHub REST API root, REPOFIY_GITHUB_API_URL points it elsewhere
+GITHUB_API_URL = "https://api.github.com"
+
+# Source files considered for AI code context
+CODE_EXTENSIONS = ('.py', '.js', '.ts', '.java', '.go', '.rb')
+
+# Fast and strong model of each AI provider
+MODEL_TIERS = {
+    "groq": {"fast": "llama-3.1-8b-instant", "strong": "llama-3.3-70b-versatile"},
+    "anthropic": {"fast": "claude-3-5-haiku-20241022", "strong": "claude-3-5-sonnet-20241022"},
+    "openrouter": {"fast": "meta-llama/llama-3.1-8b-instruct", "strong": "meta-llama/llama-3.1-70b-instruct"},
+}
+
+# Model used for each AI provider when no routing applies
+DEFAULT_MODELS = {provider: tiers["strong"] for provider, tiers in MODEL_TIERS.items()}
+
+# Approximate list prices in USD per million (input, output) tokens, for routing
+MODEL_PRICES = {
+    ("groq", "llama-3.1-8b-instant"): (0.05, 0.08),
+    ("groq", "llama-3.3-70b-versatile"): (0.59, 0.79),
+    ("anthropic", "claude-3-5-haiku-20241022"): (0.80, 4.00),
+    ("anthropic", "claude-3-5-sonnet-20241022"): (3.00, 15.00),
+    ("openrouter", "meta-llama/llama-3.1-8b-instruct"): (0.02, 0.05),
+    ("openrouter", "meta-llama/llama-3.1-70b-instruct"): (0.12, 0.30),
+}
+
+# Appended to the system prompt: how every proposal must be returned
+RESPONSE_FORMAT = """Please analyze the request and provide:
+1. A summary of what's likely causing the bug or what needs to change
+2. The specific files that need to be modified
+3. The exact code changes needed, as edits rather than whole files
+4. Any tests that should be run
+
+Respond in JSON format:
+{
+    "summary": "Brief explanation of the fix",
+    "cause": "Root cause analysis",
+    "files": ["list", "of", "files"],
+    "changes": {
+        "filename": "edits for this file"
+    },
+    "diff_preview": "Brief preview of the main changes",
+    "tests_to_run": ["list of test commands"],
+    "confidence": "high/medium/low"
+}
+
+Write the edits for an existing file as one or more SEARCH/REPLACE blocks:
+<<<<<<< SEARCH
+lines copied exactly from the current file
+=======
+the lines that replace them
+>>>>>>> REPLACE
+Each SEARCH section must match the file exactly, including indentation, and be
+just long enough to be unique. A unified diff is accepted too. Only give the
+complete content for new files."""
+
+DEFAULT_SYSTEM_PROMPT = """You are an expert software engineer working on GitHub repositories through a Telegram bot.
+Propose precise, minimal changes; the user reviews them and they are applied as a pull request."""
+
+# Default prompt context budget (tokens) per AI provider,
+# override with REPOFIY_CONTEXT_TOKENS_<PROVIDER>
+CONTEXT_TOKEN_BUDGETS = {
+    "groq": 6000,
+    "openrouter": 12000,
+    "anthropic": 24000,
+}
+
+TOKEN_PIECE_RE = re.compile(r'[A-Za-z]+|[0-9]+|\s+|[^\sA-Za-z0-9]')
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate BPE token count, close enough for budgeting code prompts"""
+    tokens = 0
+    for piece in TOKEN_PIECE_RE.findall(text):
+        if piece[0].isspace():
+            # A single space merges into the next word; indentation doesn't
+            if len(piece) > 1 or piece == '\n':
+                tokens += math.ceil(len(piece) / 4)
+        elif piece[0].isalnum():
+            tokens += math.ceil(len(piece) / 4)
+        else:
+            tokens += 1
+    return tokens
+
+
+class TreeEntry(NamedTuple):
+    """Single blob or tree in a repository listing"""
+    path: str
+    type: str  # "blob" or "tree"
+    size: int
+    sha: str
+    mode: str
+
+    @property
+    def name(self) -> str:
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def depth(self) -> int:
+        return self.path.count('/')
+
+
+class PromptParts(NamedTuple):
+    """AI prompt split into a stable prefix and the volatile request.
+
+    `system`, `repo` and `files` only depend on the system prompt, the
+    repository and the selected code, so repeated requests and revisions
+    send a byte-identical prefix that providers can cache.
+    """
+    system: str
+    repo: str
+    files: str
+    request: str
+
+    @property
+    def prefix(self) -> str:
+        if not self.repo and not self.files:
+            return ""
+        return f"{self.repo}\n\nCode Context:\n{self.files}"
+
+    def text(self) -> str:
+        return "\n\n".join(part for part in (self.system, self.prefix, self.request) if part)
+
+    def chat_messages(self) -> List[dict]:
+        """OpenAI-style messages, prefix first so automatic prefix caching applies"""
+        messages = [{"role": "system", "content": self.system}] if self.system else []
+        messages.append({"role": "user", "content": "\n\n".join(part for part in (self.prefix, self.request) if part)})
+        return messages
+
+    def anthropic_request(self) -> dict:
+        """Anthropic system and messages with cache breakpoints after the system prompt and the code"""
+        cache = {"type": "ephemeral"}
+        content = [{"type": "text", "text": self.prefix, "cache_control": cache}] if self.prefix else []
+        content.append({"type": "text", "text": self.request})
+        request = {"messages": [{"role": "user", "content": content}]}
+        if self.system:
+            request["system"] = [{"type": "text", "text": self.system, "cache_control": cache}]
+        return request
+
+
+class RepoTreeIndex:
+    """Flat in-memory index of a repository tree.
+
+    Built from a single recursive Git Trees API call. When GitHub truncates the
+    recursive listing (very large repos), the affected subtrees are walked one
+    level at a time instead.
+    """
+
+    def __init__(self, entries: List[TreeEntry], tree_sha: str = "", walked: bool = False):
+        self.entries = sorted(entries, key=lambda e: e.path)
+        self.by_path = {e.path: e for e in self.entries}
+        self.tree_sha = tree_sha
+        self.walked = walked  # True if the recursive listing was truncated
+        self._children: Dict[str, List[TreeEntry]] = {}
+        for e in self.entries:
+            self._children.setdefault(e.path.rpartition('/')[0], []).append(e)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, path: str) -> Optional[TreeEntry]:
+        return self.by_path.get(path.strip('/'))
+
+    def files(self, extensions: tuple = None, skip_ignored: bool = True) -> List[TreeEntry]:
+        """List blobs, optionally filtered by extension"""
+        files = []
+        for entry in self.entries:
+            if entry.type != "blob":
+                continue
+            if skip_ignored and self.is_ignored(entry.path):
+                continue
+            if extensions and not entry.path.endswith(extensions):
+                continue
+            files.append(entry)
+        return files
+
+    def children(self, path: str = "") -> List[TreeEntry]:
+        """Direct children of a directory ("" for the root)"""
+        return list(self._children.get(path.strip('/'), ()))
+
+    @staticmethod
+    def is_ignored(path: str) -> bool:
+        """Hidden files and files inside ignored directories"""
+        return any(part.startswith('.') or part in IGNORED_DIRS for part in path.split('/'))
+
+    @classmethod
+    def fetch(cls, repo, ref: str = None) -> "RepoTreeIndex":
+        """Fetch the full tree of `ref` (default branch if omitted)"""
+        ref = ref or repo.default_branch
+        entries: List[TreeEntry] = []
+        tree = repo.get_git_tree(ref, recursive=True)
+
+        if not tree.raw_data.get('truncated'):
+            entries.extend(cls._entries(tree.tree))
+            return cls(entries, tree_sha=tree.sha)
+
+        logger.info(f"Tree for {repo.full_name} truncated, walking subtrees")
+        cls._walk_level(repo, tree.sha, "", entries)
+        return cls(entries, tree_sha=tree.sha, walked=True)
+
+    @classmethod
+    def _walk(cls, repo, sha: str, prefix: str, entries: List[TreeEntry]):
+        """Collect a subtree, falling back to a level walk only if GitHub truncates it"""
+        tree = repo.get_git_tree(sha, recursive=True)
+        if not tree.raw_data.get('truncated'):
+            entries.extend(cls._entries(tree.tree, prefix))
+            return
+        cls._walk_level(repo, sha, prefix, entries)
+
+    @classmethod
+    def _walk_level(cls, repo, sha: str, prefix: str, entries: List[TreeEntry]):
+        level = repo.get_git_tree(sha)
+        for element in cls._entries(level.tree, prefix):
+            entries.append(element)
+            # Not worth thousands of requests on vendored directories
+            if element.type == "tree" and not cls.is_ignored(element.path):
+                cls._walk(repo, element.sha, f"{element.path}/", entries)
+
+    @staticmethod
+    def _entries(elements, prefix: str = "") -> List[TreeEntry]:
+        return [
+            TreeEntry(
+                path=f"{prefix}{el.path}",
+                type=el.type,
+                size=el.size or 0,
+                sha=el.sha,
+                mode=el.mode,
+            )
+            for el in elements
+            if el.type in ("blob", "tree")
+        ]
+
+
+class BlobCache:
+    """Process-wide LRU cache of blob contents keyed by (repo, blob sha).
+
+    Blob shas are content hashes, so entries never go stale; they are only
+    evicted (least recently used first) to stay under the byte budget.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, repo_name: str, sha: str) -> Optional[bytes]:
+        key = (repo_name, sha)
+        with self._lock:
+            data = self._data.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def peek(self, repo_name: str, sha: str) -> Optional[bytes]:
+        """Cached contents without touching LRU order or hit/miss stats"""
+        with self._lock:
+            return self._data.get((repo_name, sha))
+
+    def put(self, repo_name: str, sha: str, data: bytes):
+        # A single blob larger than the whole budget is not worth caching
+        if len(data) > self.max_bytes:
+            return
+        key = (repo_name, sha)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._data[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class TreeCache:
+    """Tree indexes keyed by (repo, commit sha).
+
+    Only the index for the latest known head of each repo is kept: once the
+    default branch moves, the entry for the old commit is dropped.
+    """
+
+    def __init__(self, max_repos: int):
+        self.max_repos = max_repos
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, repo_name: str, commit_sha: str) -> Optional[RepoTreeIndex]:
+        with self._lock:
+            cached = self._data.get(repo_name)
+            if cached is None:
+                return None
+            if cached[0] != commit_sha:
+                # Head moved since we cached this tree
+                del self._data[repo_name]
+                return None
+            self._data.move_to_end(repo_name)
+            return cached[1]
+
+    def put(self, repo_name: str, commit_sha: str, index: RepoTreeIndex):
+        with self._lock:
+            self._data[repo_name] = (commit_sha, index)
+            self._data.move_to_end(repo_name)
+            while len(self._data) > self.max_repos:
+                self._data.popitem(last=False)
+
+
+class SnapshotStore:
+    """On-disk repository snapshots that survive bot restarts.
+
+    Layout under `root`:
+        blobs/ab/cdef...           blob contents, addressed by git blob sha
+        repos/<owner>__<repo>/meta.json          repo metadata, head commit, sync time
+        repos/<owner>__<repo>/tree-<commit>.json tree entries at that commit
+
+    Blobs are immutable, so a head change only costs the tree listing plus
+    the blobs that actually changed. They are kept under `max_bytes`, least
+    recently used first out; file mtimes carry the order across restarts.
+    """
+
+    def __init__(self, root: str, max_age: float = 60, access_ttl: float = 3600, max_bytes: int = 1024 * 1024 * 1024):
+        self.root = root
+        self.max_age = max_age
+        self.access_ttl = access_ttl
+        self.max_bytes = max_bytes
+        self._meta: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'repos'), exist_ok=True)
+        self._blobs: "OrderedDict[str, int]" = OrderedDict()
+        self.blob_bytes = 0
+        self._scan_blobs()
+        self._evict_blobs()
+
+    def _scan_blobs(self):
+        found = []
+        blobs_dir = os.path.join(self.root, 'blobs')
+        for bucket in os.scandir(blobs_dir):
+            if not bucket.is_dir():
+                continue
+            for blob in os.scandir(bucket.path):
+                if blob.name.startswith('.tmp-'):
+                    continue
+                stat = blob.stat()
+                found.append((stat.st_mtime, bucket.name + blob.name, stat.st_size))
+        for _, sha, size in sorted(found):
+            self._blobs[sha] = size
+            self.blob_bytes += size
+
+    def _evict_blobs(self):
+        """Drop least recently used blobs until the store is within its byte budget"""
+        while True:
+            with self._lock:
+                if self.blob_bytes <= self.max_bytes or not self._blobs:
+                    return
+                sha, size = self._blobs.popitem(last=False)
+                self.blob_bytes -= size
+            try:
+                os.unlink(self._blob_path(sha))
+            except FileNotFoundError:
+                pass
+
+    def _repo_dir(self, repo_name: str) -> str:
+        return os.path.join(self.root, 'repos', repo_name.lower().replace('/', '__'))
+
+    def _blob_path(self, sha: str) -> str:
+        return os.path.join(self.root, 'blobs', sha[:2], sha[2:])
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def load_meta(self, repo_name: str) -> dict:
+        key = repo_name.lower()
+        with self._lock:
+            if key in self._meta:
+                return self._meta[key]
+        try:
+            with open(os.path.join(self._repo_dir(repo_name), 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            meta = {}
+        with self._lock:
+            return self._meta.setdefault(key, meta)
+
+    def update_meta(self, repo_name: str, **fields):
+        meta = dict(self.load_meta(repo_name), **fields)
+        with self._lock:
+            self._meta[repo_name.lower()] = meta
+        self._write_atomic(os.path.join(self._repo_dir(repo_name), 'meta.json'), json.dumps(meta).encode())
+
+    def is_fresh(self, meta: dict) -> bool:
+        """Whether the recorded head can be trusted without asking GitHub"""
+        return bool(meta.get('commit')) and time.time() - meta.get('synced_at', 0) < self.max_age
+
+    def has_access(self, meta: dict, token: str) -> bool:
+        verified_at = meta.get('access', {}).get(self.token_id(token), 0)
+        return bool(meta.get('repo')) and time.time() - verified_at < self.access_ttl
+
+    @staticmethod
+    def token_id(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+    def load_tree(self, repo_name: str, commit_sha: str) -> Optional[RepoTreeIndex]:
+        try:
+            with open(os.path.join(self._repo_dir(repo_name), f'tree-{commit_sha}.json'), 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        entries = [TreeEntry(*entry) for entry in data['entries']]
+        return RepoTreeIndex(entries, tree_sha=data['tree_sha'], walked=data.get('walked', False))
+
+    def save_tree(self, repo_name: str, commit_sha: str, index: RepoTreeIndex):
+        repo_dir = self._repo_dir(repo_name)
+        data = {'tree_sha': index.tree_sha, 'walked': index.walked, 'entries': [list(e) for e in index.entries]}
+        self._write_atomic(os.path.join(repo_dir, f'tree-{commit_sha}.json'), json.dumps(data).encode())
+        # Only the latest tree is kept; blobs stay shared
+        for name in os.listdir(repo_dir):
+            if name.startswith('tree-') and name != f'tree-{commit_sha}.json':
+                os.unlink(os.path.join(repo_dir, name))
+
+    def read_blob(self, sha: str) -> Optional[bytes]:
+        path = self._blob_path(sha)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if sha in self._blobs:
+                self._blobs.move_to_end(sha)
+            else:
+                # Written by another process sharing the directory
+                self._blobs[sha] = len(data)
+                self.blob_bytes += len(data)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def has_blob(self, sha: str) -> bool:
+        with self._lock:
+            if sha in self._blobs:
+                return True
+        return os.path.exists(self._blob_path(sha))
+
+    def write_blob(self, sha: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if sha in self._blobs:
+                return
+        self._write_atomic(self._blob_path(sha), data)
+        with self._lock:
+            if sha not in self._blobs:
+                self._blobs[sha] = len(data)
+                self.blob_bytes += len(data)
+        self._evict_blobs()
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one in-flight call.
+
+    The first caller starts the call; callers arriving before it finishes
+    await the same task. Nothing is cached once it completes.
+    """
+
+    def __init__(self):
+        self._calls: Dict[tuple, asyncio.Task] = {}
+        self.shared = 0
+
+    async def do(self, key: tuple, fn, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fn(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._forget, key))
+        else:
+            self.shared += 1
+        # One caller giving up must not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key: tuple, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the error as retrieved in case every caller has gone
+            task.exception()
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms exported in the OpenMetrics text format.
+
+    Metrics are declared once and updated by name from anywhere, including
+    the GitHub worker threads. Figures the bot already keeps elsewhere
+    (cache hits, queue lengths, ...) are registered with `collect` and read
+    at scrape time instead of being counted twice.
+    """
+
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, prefix: str = "repofiy"):
+        self.prefix = prefix
+        self._families: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def _declare(self, name: str, kind: str, help_text: str, buckets: tuple = None) -> dict:
+        family = self._families.get(name)
+        if family is None:
+            family = {'kind': kind, 'help': help_text, 'buckets': buckets, 'values': {}, 'collectors': []}
+            self._families[name] = family
+        return family
+
+    def counter(self, name: str, help_text: str):
+        self._declare(name, "counter", help_text)
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self._declare(name, "histogram", help_text, tuple(sorted(buckets)))
+
+    def collect(self, name: str, kind: str, help_text: str, fn, **labels):
+        """Export the number `fn()` returns at scrape time as a counter or gauge sample"""
+        self._declare(name, kind, help_text)['collectors'].append((self._label_key(labels), fn))
+
+    @staticmethod
+    def _label_key(labels: dict) -> tuple:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = self._label_key(labels)
+        with self._lock:
+            values = self._families[name]['values']
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._label_key(labels)
+        with self._lock:
+            family = self._families[name]
+            state = family['values'].get(key)
+            if state is None:
+                state = family['values'][key] = [[0] * len(family['buckets']), 0.0, 0]
+            for i, bound in enumerate(family['buckets']):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe the seconds spent in the block, also when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _format_labels(key: tuple, extra: tuple = ()) -> str:
+        pairs = key + extra
+        if not pairs:
+            return ""
+        return "{" + ",".join(
+            f'{label}="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for label, value in pairs
+        ) + "}"
+
+    @staticmethod
+    def _format_value(value: float) -> str:
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    def render(self) -> str:
+        """All metrics in the OpenMetrics text exposition format"""
+        lines = []
+        with self._lock:
+            families = {
+                name: (family, {
+                    key: (list(value[0]), value[1], value[2]) if isinstance(value, list) else value
+                    for key, value in family['values'].items()
+                })
+                for name, family in self._families.items()
+            }
+        for name, (family, values) in sorted(families.items()):
+            full_name = f"{self.prefix}_{name}"
+            kind = family['kind']
+            lines.append(f"# TYPE {full_name} {kind}")
+            lines.append(f"# HELP {full_name} {family['help']}")
+            for key, fn in family['collectors']:
+                try:
+                    values[key] = fn()
+                except Exception as e:
+                    logger.warning(f"Metric {full_name} could not be collected: {str(e)}")
+            suffix = "_total" if kind == "counter" else ""
+            for key, value in sorted(values.items()):
+                if kind != "histogram":
+                    lines.append(f"{full_name}{suffix}{self._format_labels(key)} {self._format_value(value)}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(family['buckets'], counts):
+                    lines.append(f"{full_name}_bucket{self._format_labels(key, (('le', str(float(bound))),))} {bucket_count}")
+                lines.append(f"{full_name}_bucket{self._format_labels(key, (('le', '+Inf'),))} {count}")
+                lines.append(f"{full_name}_sum{self._format_labels(key)} {self._format_value(total)}")
+                lines.append(f"{full_name}_count{self._format_labels(key)} {count}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """aiohttp handler for GET /metrics"""
+        return web.Response(body=self.render().encode(), headers={'Content-Type': self.CONTENT_TYPE})
+
+    async def serve(self, listen: str, port: int) -> web.AppRunner:
+        """Standalone /metrics server, for polling mode where there is no webhook server"""
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+        logger.info(f"Metrics available on {listen}:{port}/metrics")
+        return runner
+
+
+class GitHubGateway:
+    """Shared GitHub access layer for all users and commands.
+
+    Reuses one client per token and one repository handle per (token, repo),
+    and serves trees and blobs from the process-wide caches, backed by the
+    on-disk snapshot store when one is configured. PyGithub is blocking, so
+    every call runs on a bounded thread pool instead of the event loop.
+    Concurrent requests for the same repository, head, tree or blob share a
+    single upstream call.
+
+    Repository handles and branch heads are revalidated with ETags, so an
+    unchanged answer is a 304 that doesn't count against the rate limit. The
+    remaining budget of every token is tracked from response headers; below
+    `reserve` requests, background work such as prefetching backs off so the
+    rest stays available for interactive commands.
+
+    PyGithub's own throttle is set explicitly: reads are already bounded by
+    the worker pool, and writes are spaced by `write_interval` per token
+    instead of PyGithub's default full second.
+    """
+
+    def __init__(self, blob_cache: BlobCache, tree_cache: TreeCache, snapshots: SnapshotStore = None,
+                 repo_ttl: float = 300, head_ttl: float = 15, max_workers: int = 8, reserve: int = 500,
+                 base_url: str = GITHUB_API_URL, metrics: MetricsRegistry = None,
+                 request_interval: float = 0, write_interval: float = 0.25):
+        self.blob_cache = blob_cache
+        self.tree_cache = tree_cache
+        self.snapshots = snapshots
+        self.repo_ttl = repo_ttl
+        self.head_ttl = head_ttl
+        self.reserve = reserve
+        self.base_url = base_url
+        self.metrics = metrics
+        self.request_interval = request_interval
+        self.write_interval = write_interval
+        self.not_modified = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="github")
+        self._clients: Dict[str, Github] = {}
+        self._repos: Dict[tuple, tuple] = {}
+        self._heads: Dict[str, tuple] = {}
+        self._head_etags: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._background: set = set()
+        self._inflight = SingleFlight()
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking PyGithub call on the GitHub thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def close(self):
+        # Prefetches must stop before the executor they submit to goes away
+        tasks = list(self._background)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def client(self, token: str) -> Github:
+        with self._lock:
+            client = self._clients.get(token)
+            if client is None:
+                client = self._new_client(token)
+                self._clients[token] = client
+            return client
+
+    def _new_client(self, token: str) -> Github:
+        client = Github(
+            token,
+            base_url=self.base_url,
+            seconds_between_requests=self.request_interval,
+            seconds_between_writes=self.write_interval,
+        )
+        if self.metrics:
+            # PyGithub calls this debug hook with every response it receives
+            requester = self._requester(client)
+            on_response = requester.DEBUG_ON_RESPONSE
+
+            def count_response(status, headers, data):
+                self.metrics.inc("github_requests", status=status)
+                # PyGithub passes the decoded body text; count its bytes, not characters
+                body = data.encode() if isinstance(data, str) else data or b""
+                self.metrics.inc("github_response_bytes", len(body))
+                on_response(status, headers, data)
+
+            requester.DEBUG_ON_RESPONSE = count_response
+        return client
+
+    @staticmethod
+    def _requester(obj):
+        # PyGithub keeps the last rate limit headers on the requester that a
+        # client shares with every object it creates; it isn't public API
+        if isinstance(obj, Github):
+            return obj._Github__requester
+        return obj._requester
+
+    def budget(self, token_or_repo) -> Optional[dict]:
+        """Rate limit budget of a token as of its last response, None until a request was made"""
+        obj = self.client(token_or_repo) if isinstance(token_or_repo, str) else token_or_repo
+        requester = self._requester(obj)
+        remaining, limit = requester.rate_limiting
+        if limit < 0:
+            return None
+        return {'remaining': remaining, 'limit': limit, 'reset': requester.rate_limiting_resettime}
+
+    def budget_low(self, repo) -> bool:
+        """True when the token behind `repo` is down to its reserve"""
+        budget = self.budget(repo)
+        return budget is not None and budget['remaining'] < self.reserve
+
+    def check_budget(self, repo):
+        """Fail fast with a readable error instead of spending a request on a 403"""
+        budget = self.budget(repo)
+        if budget and budget['remaining'] == 0 and budget['reset'] > time.time():
+            minutes = math.ceil((budget['reset'] - time.time()) / 60)
+            raise RuntimeError(f"GitHub API rate limit reached for this token, it resets in {minutes} min")
+
+    async def verify_token(self, token: str) -> str:
+        """Login of the token's owner; raises if the token is invalid"""
+        return await self.run(lambda: self._new_client(token).get_user().login)
+
+    async def get_repo(self, token: str, repo_name: str):
+        """Repository handle, re-fetched only after `repo_ttl` seconds"""
+        key = (token, repo_name.lower())
+        cached = self._repos.get(key)
+        if cached and time.monotonic() - cached[0] < self.repo_ttl:
+            return cached[1]
+        stale = cached[1] if cached else None
+        return await self._inflight.do(('repo',) + key, self._load_repo, token, repo_name, stale)
+
+    async def _load_repo(self, token: str, repo_name: str, stale=None):
+        repo = None
+        if stale is not None:
+            self.check_budget(stale)
+            # Conditional request; also notices revoked access
+            if await self.run(stale.update):
+                await self._save_repo_meta(token, stale)
+            else:
+                self.not_modified += 1
+            repo = stale
+
+        if repo is None and self.snapshots:
+            # Rebuild the handle from the snapshot if this token was recently verified
+            meta = await self.run(self.snapshots.load_meta, repo_name)
+            if self.snapshots.has_access(meta, token):
+                headers = {'etag': meta['repo_etag']} if meta.get('repo_etag') else None
+                repo = self.client(token).create_from_raw_data(Repository, meta['repo'], headers)
+
+        if repo is None:
+            repo = await self.run(self.client(token).get_repo, repo_name)
+            await self._save_repo_meta(token, repo)
+
+        self._repos[(token, repo_name.lower())] = (time.monotonic(), repo)
+        return repo
+
+    async def _save_repo_meta(self, token: str, repo):
+        if not self.snapshots:
+            return
+        meta = await self.run(self.snapshots.load_meta, repo.full_name)
+        access = dict(meta.get('access', {}), **{self.snapshots.token_id(token): time.time()})
+        await self.run(
+            self.snapshots.update_meta, repo.full_name, repo=repo.raw_data, repo_etag=repo.etag, access=access
+        )
+
+    async def head_sha(self, repo) -> str:
+        """Commit sha at the head of the default branch"""
+        cached = self._heads.get(repo.full_name)
+        if cached and time.monotonic() - cached[0] < self.head_ttl:
+            return cached[1]
+        return await self._inflight.do(('head', repo.full_name), self._load_head, repo)
+
+    async def _load_head(self, repo) -> str:
+        self.check_budget(repo)
+        etag, sha = self._head_etags.get(repo.full_name, (None, None))
+        status, headers, output = await self.run(
+            self._requester(repo).requestJson,
+            "GET", f"{repo.url}/git/ref/heads/{repo.default_branch}",
+            headers={"If-None-Match": etag} if etag else None
+        )
+        if status == 304:
+            self.not_modified += 1
+        elif status >= 400:
+            raise GithubException(status, json.loads(output) if output else None, headers)
+        else:
+            sha = json.loads(output)['object']['sha']
+            self._head_etags[repo.full_name] = (headers.get('etag'), sha)
+
+        self._heads[repo.full_name] = (time.monotonic(), sha)
+        return sha
+
+    async def get_tree_index(self, repo) -> RepoTreeIndex:
+        """File tree at the current head, shared by concurrent callers"""
+        return await self._inflight.do(('tree', repo.full_name), self._load_tree_index, repo)
+
+    async def _load_tree_index(self, repo) -> RepoTreeIndex:
+        meta = await self.run(self.snapshots.load_meta, repo.full_name) if self.snapshots else {}
+
+        if self.snapshots and self.snapshots.is_fresh(meta):
+            # Recently synced snapshot: no network at all
+            commit_sha = meta['commit']
+        else:
+            if meta.get('head_etag') and repo.full_name not in self._head_etags:
+                # Revalidate the head we synced before the restart
+                self._head_etags[repo.full_name] = (meta['head_etag'], meta['commit'])
+            commit_sha = await self.head_sha(repo)
+
+        index = self.tree_cache.get(repo.full_name, commit_sha)
+        if index is None and self.snapshots:
+            index = await self.run(self.snapshots.load_tree, repo.full_name, commit_sha)
+        if index is None:
+            self.check_budget(repo)
+            index = await self.run(RepoTreeIndex.fetch, repo, commit_sha)
+            if self.snapshots:
+                old_commit = meta.get('commit')
+                if old_commit and old_commit != commit_sha:
+                    old_index = await self.run(self.snapshots.load_tree, repo.full_name, old_commit)
+                    if old_index is not None:
+                        changed = await self.run(self._changed_warm_entries, old_index, index)
+                        self.prefetch(repo, changed)
+                await self.run(self.snapshots.save_tree, repo.full_name, commit_sha, index)
+        self.tree_cache.put(repo.full_name, commit_sha, index)
+
+        if self.snapshots and not self.snapshots.is_fresh(meta):
+            head_etag = self._head_etags.get(repo.full_name, (None, None))[0]
+            await self.run(
+                self.snapshots.update_meta, repo.full_name,
+                commit=commit_sha, head_etag=head_etag, synced_at=time.time()
+            )
+        return index
+
+    async def tree_at(self, repo, commit_sha: str) -> RepoTreeIndex:
+        """File tree at an exact commit, bypassing the head and snapshot freshness windows"""
+        index = self.tree_cache.get(repo.full_name, commit_sha)
+        if index is None and self.snapshots:
+            index = await self.run(self.snapshots.load_tree, repo.full_name, commit_sha)
+        if index is None:
+            self.check_budget(repo)
+            index = await self.run(RepoTreeIndex.fetch, repo, commit_sha)
+        self.tree_cache.put(repo.full_name, commit_sha, index)
+        return index
+
+    def _changed_warm_entries(self, old_index: RepoTreeIndex, index: RepoTreeIndex) -> List[TreeEntry]:
+        """Files that changed since the previous head and whose old version we had on disk"""
+        changed = []
+        for entry in index.files():
+            old = old_index.get(entry.path)
+            if old is not None and old.sha != entry.sha and self.snapshots.has_blob(old.sha):
+                changed.append(entry)
+        return changed
+
+    def prefetch(self, repo, entries: List[TreeEntry], limit: int = 200):
+        """Download blobs in the background, stopping when the token's budget runs low"""
+        if not entries:
+            return
+        logger.info(f"Prefetching {min(len(entries), limit)} files of {repo.full_name}")
+
+        async def prefetch():
+            for entry in entries[:limit]:
+                if self.budget_low(repo):
+                    logger.info(f"GitHub budget low, stopped syncing {repo.full_name}")
+                    break
+                try:
+                    await self.read_blob(repo, entry)
+                except Exception as e:
+                    logger.warning(f"Could not prefetch {entry.path}: {str(e)}")
+
+        task = asyncio.create_task(prefetch())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def read_blob(self, repo, entry: TreeEntry) -> bytes:
+        """Raw blob contents, downloaded at most once per sha"""
+        data = self.blob_cache.get(repo.full_name, entry.sha)
+        if data is not None:
+            return data
+        return await self._inflight.do(('blob', repo.full_name, entry.sha), self._load_blob, repo, entry)
+
+    async def _load_blob(self, repo, entry: TreeEntry) -> bytes:
+        data = None
+        if self.snapshots:
+            data = await self.run(self.snapshots.read_blob, entry.sha)
+        if data is None:
+            self.check_budget(repo)
+            blob = await self.run(repo.get_git_blob, entry.sha)
+            data = base64.b64decode(blob.content)
+            if self.snapshots:
+                await self.run(self.snapshots.write_blob, entry.sha, data)
+        self.blob_cache.put(repo.full_name, entry.sha, data)
+        return data
+
+
+class CodeChunk(NamedTuple):
+    """Function, class, method or module-level region of a source file"""
+    path: str
+    kind: str  # "function", "class", "method" or "module"
+    name: str  # qualified for methods, e.g. "Session.refresh"
+    start_line: int
+    end_line: int
+    text: str
+
+    @property
+    def size(self) -> int:
+        return self.end_line - self.start_line + 1
+
+
+class CodeChunker:
+    """Splits source files into functions, classes and methods.
+
+    Python is parsed with `ast`; brace languages (JS/TS, Java, Go) and Ruby
+    go through a lightweight tokenizer that skips strings and comments while
+    tracking block depth. Code between definitions becomes "module" chunks.
+    Results are cached by blob sha.
+    """
+
+    IDENT = r'[A-Za-z_$][\w$]*'
+    CONTROL_WORDS = {'if', 'for', 'while', 'switch', 'catch', 'return', 'function', 'new', 'else', 'do', 'try', 'synchronized'}
+
+    JS_HEADS = [
+        ('class', re.compile(rf'^\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?class\s+(?P<name>{IDENT})')),
+        ('class', re.compile(rf'^\s*(?:export\s+)?interface\s+(?P<name>{IDENT})')),
+        ('function', re.compile(rf'^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*(?P<name>{IDENT})')),
+        ('function', re.compile(
+            rf'^\s*(?:export\s+)?(?:const|let|var)\s+(?P<name>{IDENT})\s*(?::[^=]+)?=\s*(?:async\s+)?'
+            rf'(?:function\b|\([^)]*\)\s*(?::[^=]+)?=>|{IDENT}\s*=>)'
+        )),
+    ]
+    JS_METHODS = [
+        ('method', re.compile(
+            rf'^\s*(?:(?:public|private|protected|static|readonly|async|override|get|set)\s+)*\*?'
+            rf'(?P<name>{IDENT})\s*(?:<[^>]*>)?\s*\([^;]*$'
+        )),
+    ]
+    JAVA_HEADS = [
+        ('class', re.compile(
+            r'^\s*(?:@\w+\s+)*(?:(?:public|private|protected|static|final|abstract|sealed)\s+)*'
+            r'(?:class|interface|enum|record)\s+(?P<name>\w+)'
+        )),
+    ]
+    JAVA_METHODS = [
+        ('method', re.compile(
+            r'^\s*(?:(?:public|private|protected|static|final|abstract|synchronized|native|default)\s+)*'
+            r'(?:<[^>]+>\s+)?[\w<>\[\],.?]+(?:\s*<[^>]*>)?\s+(?P<name>\w+)\s*\([^;]*$'
+        )),
+    ]
+    GO_HEADS = [
+        ('function', re.compile(r'^func\s+(?:\(\s*\w*\s*\*?(?P<recv>\w+)[^)]*\)\s*)?(?P<name>\w+)')),
+        ('class', re.compile(r'^type\s+(?P<name>\w+)\s+(?:struct|interface)\b')),
+    ]
+    RUBY_HEAD = re.compile(r'^\s*(?P<kind>def|class|module)\s+(?:self\.)?(?P<name>[\w:.?!=]+)')
+    RUBY_OPENER = re.compile(r'^\s*(?:def|class|module|if|unless|while|until|case|begin|for)\b|\bdo\s*(?:\|[^|]*\|)?\s*$')
+    RUBY_END = re.compile(r'(?:^|;)\s*end\b')
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[tuple, List[CodeChunk]]" = OrderedDict()
+
+    def chunks(self, path: str, sha: str, text: str) -> List[CodeChunk]:
+        ext = os.path.splitext(path)[1]
+        key = (sha, ext)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            # Identical content may live under another path
+            return cached if not cached or cached[0].path == path else [c._replace(path=path) for c in cached]
+
+        chunks = self._split(path, ext, text)
+        self._cache[key] = chunks
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return chunks
+
+    def _split(self, path: str, ext: str, text: str) -> List[CodeChunk]:
+        lines = text.split('\n')
+        bounds = None
+        try:
+            if ext == '.py':
+                bounds = self._python_bounds(text)
+            elif ext in ('.js', '.jsx', '.ts', '.tsx', '.mjs', '.cjs'):
+                bounds = self._brace_bounds(lines, self.JS_HEADS, self.JS_METHODS)
+            elif ext == '.java':
+                bounds = self._brace_bounds(lines, self.JAVA_HEADS, self.JAVA_METHODS)
+            elif ext == '.go':
+                bounds = self._brace_bounds(lines, self.GO_HEADS, [])
+            elif ext == '.rb':
+                bounds = self._ruby_bounds(lines)
+        except (SyntaxError, ValueError, RecursionError):
+            bounds = None
+
+        if bounds is None:
+            bounds = self._paragraph_bounds(lines)
+        else:
+            bounds += self._module_gaps(lines, bounds)
+
+        chunks = []
+        for kind, name, start, end in sorted(bounds, key=lambda b: (b[2], -b[3])):
+            chunk_text = '\n'.join(lines[start - 1:end])
+            if chunk_text.strip():
+                chunks.append(CodeChunk(path, kind, name, start, end, chunk_text))
+        return chunks
+
+    @staticmethod
+    def _python_bounds(text: str) -> List[tuple]:
+        bounds = []
+
+        def start_of(node):
+            return min([node.lineno] + [d.lineno for d in node.decorator_list])
+
+        for node in ast.parse(text).body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                bounds.append(('function', node.name, start_of(node), node.end_lineno))
+            elif isinstance(node, ast.ClassDef):
+                bounds.append(('class', node.name, start_of(node), node.end_lineno))
+                for child in node.body:
+                    if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                        bounds.append(('method', f"{node.name}.{child.name}", start_of(child), child.end_lineno))
+        return bounds
+
+    @staticmethod
+    def _line_depths(lines: List[str]) -> List[tuple]:
+        """(depth at start, depth at end) of each line, ignoring strings and comments"""
+        depths = []
+        depth = 0
+        state = None  # None, "block" comment, or the open quote character
+        for line in lines:
+            start = depth
+            i = 0
+            while i < len(line):
+                char = line[i]
+                if state == 'block':
+                    if line.startswith('*/', i):
+                        state = None
+                        i += 1
+                elif state is not None:
+                    if char == '\\':
+                        i += 1
+                    elif char == state:
+                        state = None
+                elif line.startswith('//', i):
+                    break
+                elif line.startswith('/*', i):
+                    state = 'block'
+                    i += 1
+                elif char in '"\'`':
+                    state = char
+                elif char == '{':
+                    depth += 1
+                elif char == '}':
+                    depth = max(0, depth - 1)
+                i += 1
+            # Only template literals and block comments span lines
+            if state in ('"', "'"):
+                state = None
+            depths.append((start, depth))
+        return depths
+
+    def _brace_bounds(self, lines: List[str], heads: list, member_heads: list) -> List[tuple]:
+        depths = self._line_depths(lines)
+        bounds = []
+        self._scan_braces(lines, depths, heads, member_heads, 0, len(lines) - 1, 0, None, bounds)
+        return bounds
+
+    def _scan_braces(self, lines, depths, heads, member_heads, first, last, level, parent, bounds):
+        candidates = heads if parent is None else heads + member_heads
+        i = first
+        while i <= last:
+            if depths[i][0] != level:
+                i += 1
+                continue
+            match_kind, name = None, None
+            for kind, pattern in candidates:
+                match = pattern.match(lines[i])
+                if match and match.group('name') not in self.CONTROL_WORDS:
+                    groups = match.groupdict()
+                    match_kind, name = kind, groups['name']
+                    if groups.get('recv'):
+                        # Go method with a receiver
+                        match_kind, name = 'method', f"{groups['recv']}.{name}"
+                    break
+            if match_kind is None:
+                i += 1
+                continue
+
+            end = self._block_end(lines, depths, i, level, last)
+            start = i
+            # Attach annotations and decorators written above the definition
+            while start > first and lines[start - 1].strip().startswith('@'):
+                start -= 1
+
+            if parent is not None and match_kind != 'class':
+                match_kind, name = 'method', f"{parent}.{name}"
+            bounds.append((match_kind, name, start + 1, end + 1))
+
+            if match_kind == 'class':
+                self._scan_braces(lines, depths, heads, member_heads, i + 1, end, level + 1, name, bounds)
+            i = end + 1
+
+    @staticmethod
+    def _block_end(lines, depths, i, level, last) -> int:
+        # The body may open a line or two below the signature
+        for k in range(i, min(i + 3, last + 1)):
+            if depths[k][1] > level:
+                for j in range(k, last + 1):
+                    if depths[j][1] <= level:
+                        return j
+                return last
+            if depths[k][1] == level and lines[k].rstrip().endswith((';', '}')):
+                return k
+        return i
+
+    def _ruby_bounds(self, lines: List[str]) -> List[tuple]:
+        bounds = []
+        stack = []  # (kind, name or None, start index)
+        for i, line in enumerate(lines):
+            code = line.split('#', 1)[0]
+            if not code.strip():
+                continue
+            head = self.RUBY_HEAD.match(code)
+            opens = bool(self.RUBY_OPENER.search(code))
+            closes = len(self.RUBY_END.findall(code))
+
+            if opens:
+                if head:
+                    parents = [name for kind, name, _ in stack if kind in ('class', 'module')]
+                    name = head.group('name')
+                    if head.group('kind') == 'def' and parents:
+                        stack.append(('method', f"{parents[-1]}.{name}", i))
+                    else:
+                        kind = 'function' if head.group('kind') == 'def' else 'class'
+                        stack.append((kind, name, i))
+                else:
+                    stack.append(('block', None, i))
+                # A one-line definition closes itself
+                if closes and stack:
+                    kind, name, start = stack.pop()
+                    closes -= 1
+                    if kind != 'block':
+                        bounds.append((kind, name, start + 1, i + 1))
+
+            for _ in range(closes):
+                if not stack:
+                    break
+                kind, name, start = stack.pop()
+                if kind != 'block':
+                    bounds.append((kind, name, start + 1, i + 1))
+        return bounds
+
+    @staticmethod
+    def _module_gaps(lines: List[str], bounds: List[tuple]) -> List[tuple]:
+        """Module-level chunks for lines outside every definition"""
+        covered = [False] * (len(lines) + 2)
+        for _, _, start, end in bounds:
+            for number in range(start, end + 1):
+                covered[number] = True
+
+        gaps = []
+        start = None
+        for number in range(1, len(lines) + 2):
+            if number <= len(lines) and not covered[number]:
+                if start is None:
+                    start = number
+            elif start is not None:
+                if any(lines[n - 1].strip() for n in range(start, number)):
+                    gaps.append(('module', '', start, number - 1))
+                start = None
+        return gaps
+
+    @staticmethod
+    def _paragraph_bounds(lines: List[str]) -> List[tuple]:
+        """Fallback: blocks starting at an unindented line after a blank line"""
+        bounds = []
+        start = 1
+        for number in range(2, len(lines) + 1):
+            line = lines[number - 1]
+            if line and not line[0].isspace() and not lines[number - 2].strip() and not line.startswith(('}', ')', ']', 'end')):
+                bounds.append(('module', '', start, number - 1))
+                start = number
+        bounds.append(('module', '', start, len(lines)))
+        return bounds
+
+
+class LexicalIndex:
+    """BM25 index over one repository's file paths, identifiers and symbols.
+
+    Documents are files, versioned by blob sha. `sync` registers every file
+    by its path as soon as the tree is known and drops files whose sha
+    changed; `add_content` folds in the file text whenever a blob has been
+    downloaded. The index therefore fills in incrementally across requests.
+    """
+
+    # Path and definition names say more about a file than a passing mention
+    PATH_WEIGHT = 3
+    SYMBOL_WEIGHT = 2
+
+    IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+    CAMEL_RE = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+')
+    STOPWORDS = {
+        'the', 'and', 'for', 'with', 'that', 'this', 'from', 'into', 'when', 'not', 'are', 'was',
+        'but', 'all', 'can', 'should', 'add', 'make', 'fix', 'bug', 'new', 'use', 'get', 'set',
+        'self', 'return', 'import', 'def', 'class', 'function', 'const', 'let', 'var', 'none',
+        'null', 'true', 'false', 'if', 'else', 'in', 'is', 'of', 'to', 'it', 'on', 'or', 'an',
+        'py', 'js', 'ts', 'java', 'go', 'rb', 'src', 'lib',
+    }
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs: Dict[str, dict] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.total_length = 0
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        """Lowercased identifiers plus their snake_case/camelCase parts"""
+        tokens = []
+        for identifier in cls.IDENTIFIER_RE.findall(text):
+            parts = [p for chunk in identifier.split('_') for p in cls.CAMEL_RE.findall(chunk)]
+            words = {identifier.lower(), *(p.lower() for p in parts)}
+            tokens.extend(w for w in words if len(w) > 1 and w not in cls.STOPWORDS)
+        return tokens
+
+    def has_content(self, path: str) -> bool:
+        doc = self.docs.get(path)
+        return bool(doc and doc['has_content'])
+
+    def sync(self, entries: List[TreeEntry]):
+        """Match the index to the current tree, keeping unchanged files"""
+        current = {entry.path: entry.sha for entry in entries}
+        for path in [p for p, doc in self.docs.items() if current.get(p) != doc['sha']]:
+            self._remove(path)
+        for path, sha in current.items():
+            if path not in self.docs:
+                self._add(path, sha, self.tokenize(path) * self.PATH_WEIGHT, has_content=False)
+
+    def add_content(self, path: str, sha: str, text: str, symbols: List[str] = ()):
+        """Index file text along with the names of the symbols it defines"""
+        doc = self.docs.get(path)
+        if doc is None or doc['sha'] != sha or doc['has_content']:
+            return
+        terms = self.tokenize(path) * self.PATH_WEIGHT
+        terms += self.tokenize(' '.join(symbols)) * self.SYMBOL_WEIGHT
+        terms += self.tokenize(text)
+        self._remove(path)
+        self._add(path, sha, terms, has_content=True)
+
+    def search(self, query: str, limit: int = 10) -> List[tuple]:
+        """(path, score) pairs, best first"""
+        terms = set(self.tokenize(query))
+        if not terms or not self.docs:
+            return []
+
+        n_docs = len(self.docs)
+        avg_length = self.total_length / n_docs or 1
+        scores: Dict[str, float] = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for path, tf in postings.items():
+                length = self.docs[path]['length']
+                norm = tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_length))
+                scores[path] = scores.get(path, 0.0) + idf * norm
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def _add(self, path: str, sha: str, terms: List[str], has_content: bool):
+        counts = Counter(terms)
+        self.docs[path] = {'sha': sha, 'length': len(terms), 'terms': list(counts), 'has_content': has_content}
+        self.total_length += len(terms)
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[path] = tf
+
+    def _remove(self, path: str):
+        doc = self.docs.pop(path, None)
+        if doc is None:
+            return
+        self.total_length -= doc['length']
+        for term in doc['terms']:
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(path, None)
+                if not postings:
+                    del self.postings[term]
+
+
+class ContextPacker:
+    """Packs ranked files into prompt context under a token budget.
+
+    Files go in whole while they fit. A file that doesn't fit contributes
+    whole functions, classes or methods instead, best matches for the request
+    first, rather than an arbitrary prefix.
+    """
+
+    MIN_USEFUL_TOKENS = 64
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+
+    @property
+    def remaining(self) -> int:
+        return self.budget - self.used
+
+    def pack(self, files: List[tuple], query: str) -> str:
+        """Render (path, text, chunks) triples, best first, into at most `budget` tokens"""
+        query_terms = set(LexicalIndex.tokenize(query))
+        sections = []
+
+        for path, text, chunks in files:
+            if self.remaining < self.MIN_USEFUL_TOKENS:
+                break
+
+            section = f"\n--- {path} ---\n{text}\n"
+            cost = estimate_tokens(section)
+            if cost <= self.remaining:
+                sections.append(section)
+                self.used += cost
+                continue
+
+            section = self._pack_chunks(path, chunks, query_terms)
+            if section:
+                sections.append(section)
+
+        return "".join(sections)
+
+    def _pack_chunks(self, path: str, chunks: List[CodeChunk], query_terms: set) -> str:
+        if not chunks:
+            return ""
+
+        def relevance(chunk: CodeChunk) -> int:
+            # A match in the symbol name counts double
+            name_terms = set(LexicalIndex.tokenize(chunk.name))
+            return 2 * len(query_terms & name_terms) + len(query_terms & set(LexicalIndex.tokenize(chunk.text)))
+
+        scored = [(relevance(chunk), chunk) for chunk in chunks]
+        # Best match first; on a tie the enclosing class beats its methods
+        ranked = [chunk for score, chunk in sorted(scored, key=lambda s: (-s[0], -s[1].size, s[1].start_line)) if score > 0]
+        if not ranked:
+            # Nothing matches: the file's opening region stands in for it
+            ranked = chunks[:1]
+
+        header = f"\n--- {path} (excerpts) ---\n"
+        chosen: List[CodeChunk] = []
+        used = estimate_tokens(header)
+        for chunk in ranked:
+            if any(chunk.start_line <= c.end_line and c.start_line <= chunk.end_line for c in chosen):
+                continue
+            cost = estimate_tokens(chunk.text) + 8  # line marker
+            if used + cost > self.remaining:
+                continue
+            chosen.append(chunk)
+            used += cost
+
+        if not chosen:
+            return ""
+
+        self.used += used
+        body = "".join(
+            f"# lines {c.start_line}-{c.end_line}{f' ({c.name})' if c.name else ''}\n{c.text}\n"
+            for c in sorted(chosen, key=lambda c: c.start_line)
+        )
+        return header + body
+
+
+class CommitEngine:
+    """Applies a set of file changes as one commit through the Git Data API.
+
+    Text files go inline in a single tree built on top of the base tree;
+    only binary content is uploaded as separate blobs, one at a time, since
+    GitHub asks for writes not to be made concurrently. The branch ref is
+    created last, pointing at the finished commit, so a failure part-way
+    leaves nothing on the branch.
+    """
+
+    def __init__(self, github: GitHubGateway):
+        self.github = github
+
+    async def commit(self, repo, base_branch, branch_name: str, changes: Dict[str, Optional[str]],
+                     message: str, modes: Dict[str, str] = None, progress=None):
+        """Commit `changes` ({path: new content, or None to delete}) onto a new branch"""
+        if not changes:
+            raise ValueError("The proposed solution has no file changes to apply")
+
+        modes = modes or {}
+        base_commit_sha = base_branch.commit.sha
+        base_tree_sha = base_branch.commit.commit.tree.sha
+        base_tree, parent = await asyncio.gather(
+            self.github.run(repo.get_git_tree, base_tree_sha),
+            self.github.run(repo.get_git_commit, base_commit_sha),
+        )
+
+        binary = [path for path, content in changes.items() if self._is_binary(content)]
+        blobs = {}
+        for uploaded, path in enumerate(binary, 1):
+            content = changes[path]
+            data = content if isinstance(content, bytes) else content.encode('utf-8')
+            blobs[path] = await self.github.run(repo.create_git_blob, base64.b64encode(data).decode(), "base64")
+            if progress:
+                progress.update(files_uploaded=f"{uploaded}/{len(binary)}")
+
+        elements = []
+        for path, content in changes.items():
+            if content is None:
+                # A null sha removes the path from the tree
+                element = InputGitTreeElement(path=path, mode=modes.get(path, '100644'), type='blob', sha=None)
+            elif path in blobs:
+                element = InputGitTreeElement(
+                    path=path, mode=modes.get(path, '100644'), type='blob', sha=blobs[path].sha
+                )
+            else:
+                element = InputGitTreeElement(
+                    path=path, mode=modes.get(path, '100644'), type='blob', content=content
+                )
+            elements.append(element)
+
+        if progress:
+            progress.update("Creating commit...")
+        tree = await self.github.run(repo.create_git_tree, elements, base_tree)
+        commit = await self.github.run(repo.create_git_commit, message, tree, [parent])
+
+        await self.github.run(repo.create_git_ref, ref=f"refs/heads/{branch_name}", sha=commit.sha)
+        return commit
+
+    @staticmethod
+    def _is_binary(content) -> bool:
+        """Content that can't be sent as text inside the tree request"""
+        return isinstance(content, bytes) or (content is not None and '\x00' in content)
+
+
+class PatchResult(NamedTuple):
+    """Outcome of applying one file's proposed change"""
+    content: Optional[str]
+    applied: int
+    conflicts: List[str]
+
+
+class PatchEngine:
+    """Applies proposed edits to the current contents of a file.
+
+    A change is a set of SEARCH/REPLACE blocks, a unified diff, or the
+    complete new content (for new files). Each hunk is located exactly
+    first, then ignoring whitespace, then with up to `max_fuzz` context
+    lines dropped from either end, and finally by line similarity. Hunks
+    that can't be placed, or that match several places with nothing to
+    choose between them, are reported as conflicts rather than guessed.
+    """
+
+    AMBIGUOUS = -1  # placement result when `old` matches more than one place
+
+    SEARCH_REPLACE_RE = re.compile(
+        r'^<{5,9} ?SEARCH[^\n]*\n(.*?)^={5,9}[ \t]*\n(.*?)^>{5,9} ?REPLACE[^\n]*$', re.M | re.S
+    )
+    HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@|^@@')
+
+    def __init__(self, max_fuzz: int = 2, similarity: float = 0.9, search_window: int = 300):
+        self.max_fuzz = max_fuzz
+        self.similarity = similarity
+        self.search_window = search_window
+
+    def kind(self, change: str) -> str:
+        """'search_replace', 'diff' or 'content'"""
+        if self.SEARCH_REPLACE_RE.search(change):
+            return "search_replace"
+        if re.search(r'^@@', change, re.M) and re.search(r'^[-+]', change, re.M):
+            return "diff"
+        return "content"
+
+    def apply(self, base: Optional[str], change: str) -> PatchResult:
+        """Apply `change` to `base` (None for a file that doesn't exist yet)"""
+        kind = self.kind(change)
+        if kind == "content":
+            return PatchResult(change, 0, [])
+
+        newline = '\r\n' if base and '\r\n' in base else '\n'
+        lines = (base or '').splitlines()
+        trailing_newline = base is None or base.endswith(('\n', '\r'))
+
+        if kind == "diff":
+            hunks = self._parse_diff(change)
+            label = "hunk"
+        else:
+            hunks = [
+                (None, self._split(search), self._split(replace), 0, 0)
+                for search, replace in self.SEARCH_REPLACE_RE.findall(change)
+            ]
+            label = "block"
+
+        applied, conflicts, offset, position = 0, [], 0, 0
+        for number, (hint, old, new, lead, trail) in enumerate(hunks, 1):
+            if base is None and old:
+                conflicts.append(f"{label} {number}: file does not exist")
+                continue
+            target = hint - 1 + offset if hint else None
+            found = self._locate(lines, old, new, position, target, lead, trail, label == "block")
+            if found is None and position:
+                # Out-of-order hunks: search the whole file
+                found = self._locate(lines, old, new, 0, target, lead, trail, label == "block")
+            where = f" near line {hint}" if hint else ""
+            if found is None:
+                conflicts.append(f"{label} {number}{where}: the original lines were not found")
+                continue
+            if found == self.AMBIGUOUS:
+                conflicts.append(f"{label} {number}{where}: the original lines match more than one place")
+                continue
+            start, length, replacement = found
+            lines[start:start + length] = replacement
+            offset += len(replacement) - length
+            position = start + len(replacement)
+            applied += 1
+
+        content = newline.join(lines)
+        if trailing_newline and lines:
+            content += newline
+        return PatchResult(content, applied, conflicts)
+
+    @staticmethod
+    def _split(text: str) -> List[str]:
+        return text.splitlines()
+
+    def _parse_diff(self, diff: str):
+        """(start line hint, old lines, new lines, leading context, trailing context) per hunk"""
+        hunks = []
+        current = None
+        for line in diff.splitlines():
+            header = self.HUNK_HEADER_RE.match(line)
+            if header:
+                current = [int(header.group(1)) if header.group(1) else None, []]
+                hunks.append(current)
+            elif current is None or line.startswith(('--- ', '+++ ', '\\')):
+                continue
+            elif line.startswith(('-', '+', ' ')):
+                current[1].append((line[0], line[1:]))
+            elif not line.strip():
+                # Blank context lines often lose their leading space
+                current[1].append((' ', ''))
+            else:
+                current = None
+
+        parsed = []
+        for hint, body in hunks:
+            while body and body[-1] == (' ', ''):
+                body.pop()
+            if not body:
+                continue
+            lead = next((i for i, (tag, _) in enumerate(body) if tag != ' '), len(body))
+            trail = next((i for i, (tag, _) in enumerate(reversed(body)) if tag != ' '), len(body))
+            old = [text for tag, text in body if tag != '+']
+            new = [text for tag, text in body if tag != '-']
+            parsed.append((hint, old, new, lead, trail))
+        return parsed
+
+    def _locate(self, lines: List[str], old: List[str], new: List[str], start: int, target: Optional[int],
+                lead: int, trail: int, trim_blank: bool):
+        """(start, length, replacement lines) for the best placement of `old`, or None"""
+        if not old:
+            at = len(lines) if target is None else min(max(target, 0), len(lines))
+            return at, 0, new
+
+        for normalize in (None, str.rstrip, lambda s: ' '.join(s.split())):
+            found = self._find(lines, old, start, target, normalize)
+            if found == self.AMBIGUOUS:
+                return found
+            if found is not None:
+                return found, len(old), self._reindent(lines[found:found + len(old)], old, new)
+
+        # Drop context lines the file no longer has, as `patch` does with fuzz
+        for fuzz in range(1, self.max_fuzz + 1):
+            head, tail = min(fuzz, lead), min(fuzz, trail)
+            if not head and not tail:
+                break
+            trimmed_old = old[head:len(old) - tail]
+            trimmed_new = new[head:len(new) - tail]
+            if not trimmed_old:
+                break
+            found = self._find(lines, trimmed_old, start, None if target is None else target + head, str.rstrip)
+            if found == self.AMBIGUOUS:
+                return found
+            if found is not None:
+                return found, len(trimmed_old), trimmed_new
+
+        if trim_blank:
+            # Search blocks often gain or lose blank lines at either end
+            while old and not old[0].strip():
+                old, new = old[1:], new[1:] if new and not new[0].strip() else new
+            while old and not old[-1].strip():
+                old, new = old[:-1], new[:-1] if new and not new[-1].strip() else new
+            if old:
+                found = self._find(lines, old, start, target, lambda s: ' '.join(s.split()))
+                if found == self.AMBIGUOUS:
+                    return found
+                if found is not None:
+                    return found, len(old), self._reindent(lines[found:found + len(old)], old, new)
+
+        found = self._find_similar(lines, old, start, target)
+        if found is not None:
+            return found, len(old), self._reindent(lines[found:found + len(old)], old, new)
+        return None
+
+    @classmethod
+    def _find(cls, lines: List[str], old: List[str], start: int, target: Optional[int], normalize) -> Optional[int]:
+        """Position of `old` in `lines` at or after `start`, closest to `target`.
+
+        Without a target, several matches give AMBIGUOUS rather than the first.
+        """
+        if normalize:
+            lines = [normalize(line) for line in lines]
+            old = [normalize(line) for line in old]
+        first, size = old[0], len(old)
+        matches = [
+            i for i in range(start, len(lines) - size + 1)
+            if lines[i] == first and lines[i:i + size] == old
+        ]
+        if not matches:
+            return None
+        if target is None:
+            return matches[0] if len(matches) == 1 else cls.AMBIGUOUS
+        return min(matches, key=lambda i: abs(i - target))
+
+    def _find_similar(self, lines: List[str], old: List[str], start: int, target: Optional[int]) -> Optional[int]:
+        """Best window at least `similarity` alike, when there is exactly one best"""
+        if len(old) < 3:
+            return None
+        size = len(old)
+        low, high = start, len(lines) - size
+        if target is not None:
+            low, high = max(low, target - self.search_window), min(high, target + self.search_window)
+        wanted = "\n".join(line.strip() for line in old)
+        best, best_ratio, tied = None, self.similarity, False
+        for i in range(low, high + 1):
+            matcher = difflib.SequenceMatcher(None, "\n".join(line.strip() for line in lines[i:i + size]), wanted)
+            if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio:
+                continue
+            ratio = matcher.ratio()
+            if ratio > best_ratio:
+                best, best_ratio, tied = i, ratio, False
+            elif ratio == best_ratio and best is not None:
+                tied = True
+        return None if tied else best
+
+    @staticmethod
+    def _reindent(matched: List[str], old: List[str], new: List[str]) -> List[str]:
+        """Shift `new` by the indentation the file has and `old` lacked"""
+        actual = next((line for line in matched if line.strip()), None)
+        expected = next((line for line in old if line.strip()), None)
+        if actual is None or expected is None:
+            return new
+        have = actual[:len(actual) - len(actual.lstrip())]
+        given = expected[:len(expected) - len(expected.lstrip())]
+        if have == given or not have.endswith(given):
+            return new
+        extra = have[:len(have) - len(given)]
+        return [extra + line if line.strip() else line for line in new]
+
+
+class ProviderClientRegistry:
+    """Long-lived AI provider clients keyed by (provider, api key).
+
+    HTTP providers share a keep-alive aiohttp session per key and Anthropic
+    gets one AsyncAnthropic client per key, so repeated calls skip the TCP and
+    TLS handshakes. Concurrency is capped per provider and clients that sit
+    unused for `idle_timeout` seconds are closed in the background.
+    """
+
+    def __init__(self, max_concurrency: int = 8, idle_timeout: float = 300):
+        self.max_concurrency = max_concurrency
+        self.idle_timeout = idle_timeout
+        self._clients: Dict[tuple, dict] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._reaper: Optional[asyncio.Task] = None
+
+    @asynccontextmanager
+    async def acquire(self, provider: str, api_key: str):
+        """Borrow the client for (provider, api_key), waiting for a provider slot"""
+        self._ensure_reaper()
+        semaphore = self._semaphores.setdefault(provider, asyncio.Semaphore(self.max_concurrency))
+        async with semaphore:
+            entry = self._get_entry(provider, api_key)
+            entry['in_use'] += 1
+            try:
+                yield entry['client']
+            finally:
+                entry['in_use'] -= 1
+                entry['last_used'] = time.monotonic()
+
+    def _get_entry(self, provider: str, api_key: str) -> dict:
+        # Don't keep raw keys around as dict keys
+        key = (provider, hashlib.sha256((api_key or "").encode()).hexdigest())
+        entry = self._clients.get(key)
+        if entry is None:
+            entry = {'client': self._create(provider, api_key), 'in_use': 0, 'last_used': time.monotonic()}
+            self._clients[key] = entry
+            logger.info(f"Opened {provider} client")
+        return entry
+
+    def _create(self, provider: str, api_key: str):
+        if provider == "anthropic":
+            from anthropic import AsyncAnthropic
+            # Retries are handled by ProviderResilience
+            return AsyncAnthropic(api_key=api_key, max_retries=0)
+
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=self.idle_timeout)
+        return aiohttp.ClientSession(connector=connector)
+
+    def _ensure_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_idle())
+
+    async def _reap_idle(self):
+        while self._clients:
+            await asyncio.sleep(self.idle_timeout / 2)
+            await self.close_idle()
+
+    async def close_idle(self):
+        """Close clients that have been unused for longer than idle_timeout"""
+        now = time.monotonic()
+        for key, entry in list(self._clients.items()):
+            if entry['in_use'] == 0 and now - entry['last_used'] > self.idle_timeout:
+                del self._clients[key]
+                await self._close_client(entry['client'])
+                logger.info(f"Closed idle {key[0]} client")
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+        clients, self._clients = self._clients, {}
+        for entry in clients.values():
+            await self._close_client(entry['client'])
+
+    @staticmethod
+    async def _close_client(client):
+        try:
+            await client.close()
+        except Exception as e:
+            logger.warning(f"Error closing AI client: {str(e)}")
+
+
+class ModelRouter:
+    """Chooses a model for each AI request.
+
+    Keeps rolling latency, error and cost figures per (provider, model).
+    Within the user's provider, scaffolding (/create), revisions, response
+    repairs and small requests go to the fast model, and larger code tasks go to the strong one.
+    If the strong model's estimated cost exceeds the user's budget, the fast
+    model is used instead, and so it is under the "auto" policy while the
+    strong model's median latency is above `max_latency` and the fast one
+    is quicker. A model failing most of its recent requests is swapped for
+    the provider's other tier.
+    """
+
+    POLICIES = ("auto", "quality", "speed")
+    FAST_TASKS = ("create", "revise", "repair")
+
+    def __init__(self, small_tokens: int = 1500, max_error_rate: float = 0.5, min_samples: int = 5, window: int = 100,
+                 max_latency: float = 30):
+        self.small_tokens = small_tokens
+        self.max_latency = max_latency
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.window = window
+        self._samples: Dict[tuple, deque] = {}
+
+    def record(self, target: tuple, latency: float, ok: bool, prompt_tokens: int = 0, completion_tokens: int = 0):
+        cost = self.cost(target, prompt_tokens, completion_tokens) if ok else 0.0
+        self._samples.setdefault(target, deque(maxlen=self.window)).append(
+            (latency, ok, cost, completion_tokens)
+        )
+
+    @staticmethod
+    def cost(target: tuple, prompt_tokens: int, completion_tokens: int) -> float:
+        price_in, price_out = MODEL_PRICES.get(target, (0.0, 0.0))
+        return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+    def stats(self, target: tuple) -> dict:
+        samples = self._samples.get(target) or ()
+        succeeded = [s for s in samples if s[1]]
+        latencies = sorted(s[0] for s in succeeded)
+        return {
+            'samples': len(samples),
+            'error_rate': (1 - len(succeeded) / len(samples)) if samples else 0.0,
+            'p50_latency': latencies[len(latencies) // 2] if latencies else None,
+            'avg_cost': sum(s[2] for s in succeeded) / len(succeeded) if succeeded else None,
+            'avg_completion_tokens': sum(s[3] for s in succeeded) / len(succeeded) if succeeded else None,
+        }
+
+    def healthy(self, target: tuple) -> bool:
+        stats = self.stats(target)
+        return stats['samples'] < self.min_samples or stats['error_rate'] <= self.max_error_rate
+
+    def slow(self, target: tuple, alternative: tuple) -> bool:
+        """Whether `target` is over `max_latency` while a healthy `alternative` is quicker"""
+        if not self.max_latency:
+            return False
+        stats = self.stats(target)
+        if stats['samples'] < self.min_samples or stats['p50_latency'] is None or \
+                stats['p50_latency'] <= self.max_latency:
+            return False
+        other = self.stats(alternative)['p50_latency']
+        return self.healthy(alternative) and (other is None or other < stats['p50_latency'])
+
+    def estimate_cost(self, target: tuple, prompt_tokens: int) -> float:
+        completion_tokens = self.stats(target)['avg_completion_tokens'] or 1500
+        return self.cost(target, prompt_tokens, completion_tokens)
+
+    def choose(self, provider: str, task: Optional[str], prompt_tokens: int,
+               policy: str = "auto", max_cost: float = None) -> str:
+        """Model of `provider` to use for a request of `prompt_tokens`"""
+        tiers = MODEL_TIERS.get(provider, MODEL_TIERS["groq"])
+        if policy == "quality":
+            tier = "strong"
+        elif policy == "speed" or task in self.FAST_TASKS or prompt_tokens < self.small_tokens:
+            tier = "fast"
+        else:
+            tier = "strong"
+        if tier == "strong" and max_cost is not None and \
+                self.estimate_cost((provider, tiers["strong"]), prompt_tokens) > max_cost:
+            tier = "fast"
+        if tier == "strong" and policy == "auto" and self.slow((provider, tiers["strong"]), (provider, tiers["fast"])):
+            logger.info(f"Routing around slow model {provider}/{tiers['strong']}")
+            tier = "fast"
+
+        model = tiers[tier]
+        other = tiers["fast" if tier == "strong" else "strong"]
+        if not self.healthy((provider, model)) and self.healthy((provider, other)):
+            logger.info(f"Routing around failing model {provider}/{model}")
+            model = other
+        return model
+
+
+class ProviderResilience:
+    """Retry, deadline and hedging policy for AI provider calls.
+
+    Transient failures (429, 5xx, dropped connections) are retried with
+    exponential backoff and full jitter, waiting at least as long as a
+    Retry-After header asks. Every call has an overall per-provider deadline
+    covering all attempts. Streams are only retried before their first chunk.
+
+    With a backup target, a second request is sent once the primary has been
+    silent for longer than its p95 latency; whichever answers first is used
+    and the other is cancelled.
+    """
+
+    RETRY_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+    def __init__(self, attempts: int = 3, base_delay: float = 1.0, max_delay: float = 20.0,
+                 deadlines: Dict[str, float] = None, default_deadline: float = 90,
+                 hedge_after: float = 15, min_samples: int = 20, window: int = 200):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadlines = deadlines or {}
+        self.default_deadline = default_deadline
+        self.hedge_after = hedge_after
+        self.min_samples = min_samples
+        self.window = window
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # Latency samples per (target, streaming): time to first chunk for streams
+        self._latencies: Dict[tuple, deque] = {}
+
+    def record(self, target: tuple, streaming: bool, seconds: float):
+        self._latencies.setdefault((target, streaming), deque(maxlen=self.window)).append(seconds)
+
+    def hedge_delay(self, target: tuple, streaming: bool) -> float:
+        """p95 latency of `target`, or `hedge_after` until enough samples exist"""
+        samples = self._latencies.get((target, streaming))
+        if not samples or len(samples) < self.min_samples:
+            return self.hedge_after
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status in self.RETRY_STATUSES
+        if isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)):
+            return True
+        status = getattr(error, 'status_code', None)  # anthropic.APIStatusError
+        if status is not None:
+            return status in self.RETRY_STATUSES
+        return type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+    @staticmethod
+    def retry_after(error: Exception) -> Optional[float]:
+        """Seconds the provider asked us to wait, if it said"""
+        headers = getattr(error, 'headers', None)
+        if headers is None and getattr(error, 'response', None) is not None:
+            headers = error.response.headers
+        value = headers.get('Retry-After') if headers else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    async def call(self, target: tuple, fn, on_token=None) -> str:
+        """Run `fn(on_token)` for `target` = (provider, model) with retries under the provider's deadline"""
+        provider = target[0]
+        budget = self.deadlines.get(provider, self.default_deadline)
+        deadline = time.monotonic() + budget
+        streamed = False
+        started = 0.0
+
+        async def forward(chunk):
+            nonlocal streamed
+            if not streamed:
+                streamed = True
+                self.record(target, True, time.monotonic() - started)
+            return await on_token(chunk)
+
+        for attempt in range(self.attempts):
+            started = time.monotonic()
+            try:
+                result = await asyncio.wait_for(fn(forward if on_token else None), deadline - started)
+                if not on_token:
+                    self.record(target, False, time.monotonic() - started)
+                return result
+            except Exception as e:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"{provider} did not answer within {budget:.0f}s") from e
+                if streamed or attempt + 1 >= self.attempts or not self.is_retryable(e):
+                    raise
+                delay = self.backoff(attempt, self.retry_after(e))
+                if time.monotonic() + delay >= deadline:
+                    raise
+                self.retries += 1
+                logger.warning(f"{provider} request failed ({type(e).__name__}: {e}), retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def hedged(self, primary: tuple, backup: Optional[tuple], call, on_token=None) -> str:
+        """Call `primary`, hedging to `backup` if it is slower than usual.
+
+        `call(target, on_token)` returns the coroutine for one request.
+        """
+        if backup is None:
+            return await self.call(primary, functools.partial(call, primary), on_token)
+
+        winner = None
+
+        def claim(target):
+            async def forward(chunk):
+                nonlocal winner
+                if winner is None:
+                    winner = target
+                if winner != target:
+                    return True  # lost the race, stop reading
+                return await on_token(chunk)
+            return forward if on_token else None
+
+        first = asyncio.create_task(self.call(primary, functools.partial(call, primary), claim(primary)))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay(primary, on_token is not None))
+        if done or winner is not None:
+            # Answered, failed or already streaming in time
+            return await first
+
+        self.hedges += 1
+        logger.info(f"Hedging slow {primary[0]} request to {backup[0]}/{backup[1]}")
+        second = asyncio.create_task(self.call(backup, functools.partial(call, backup), claim(backup)))
+        targets = {first: primary, second: backup}
+        pending = set(targets)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and winner in (None, targets[task]):
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+            # Nothing usable: surface the error of the stream that won, else the primary's
+            decisive = second if winner == backup else first
+            return decisive.result()
+        finally:
+            for task in targets:
+                task.cancel()
+
+
+class ResponseCache:
+    """Cache of parsed AI solutions keyed by a hash of what shapes the prompt.
+
+    Entries live in memory with a TTL and LRU size bound; with `db_path` they
+    are also written to sqlite so they survive restarts.
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 512, db_path: str = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(provider: str, model: str, task_type: str, description: str, context: str, system: str = "") -> str:
+        # Whitespace, case and trailing punctuation don't change the request
+        normalized = re.sub(r'\s+', ' ', description).strip().rstrip('.!?').lower()
+        context_hash = hashlib.sha256(context.encode('utf-8')).hexdigest()
+        # A changed system prompt or response format must not replay old answers
+        system_hash = hashlib.sha256(system.encode('utf-8')).hexdigest()
+        material = json.dumps([provider, model, task_type, normalized, context_hash, system_hash])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    async def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        cached = self._data.get(key)
+        if cached is None and self._db is not None:
+            cached = await asyncio.to_thread(self._db_get, key)
+            if cached is not None:
+                self._remember(key, cached)
+
+        if cached is None or now - cached[0] > self.ttl:
+            self._data.pop(key, None)
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        # Callers may modify the solution
+        return json.loads(cached[1])
+
+    async def put(self, key: str, value: dict):
+        entry = (time.time(), json.dumps(value))
+        self._remember(key, entry)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_put, key, entry)
+
+    def _remember(self, key: str, entry: tuple):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def _db_get(self, key: str) -> Optional[tuple]:
+        with self._db_lock:
+            row = self._db.execute("SELECT created_at, value FROM responses WHERE key = ?", (key,)).fetchone()
+        return row
+
+    def _db_put(self, key: str, entry: tuple):
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO responses (key, created_at, value) VALUES (?, ?, ?)", (key, *entry))
+            # Drop expired rows, then the oldest beyond the size bound
+            self._db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+            self._db.execute(
+                "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY created_at DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+
+
+class MemorySessionBackend:
+    """Session backend kept in this process; sessions are lost on restart"""
+
+    def __init__(self):
+        self._data: Dict[str, tuple] = {}
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.time():
+            del self._data[key]
+            return None
+        return entry[0]
+
+    async def set(self, key: str, value: str, ttl: float):
+        self._data[key] = (value, time.time() + ttl)
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    async def keys(self, prefix: str) -> List[str]:
+        now = time.time()
+        return [key for key, entry in self._data.items() if key.startswith(prefix) and entry[1] >= now]
+
+    async def purge_expired(self) -> int:
+        now = time.time()
+        expired = [key for key, entry in self._data.items() if entry[1] < now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+    async def close(self):
+        pass
+
+
+class SQLiteSessionBackend:
+    """Session backend in a SQLite file, shared by processes on one host"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets several bot processes read while one writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def _execute(self, sql: str, params: tuple = (), commit: bool = False) -> list:
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+            if commit:
+                self._db.commit()
+        return rows
+
+    async def get(self, key: str) -> Optional[str]:
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT value FROM sessions WHERE key = ? AND expires_at >= ?", (key, time.time())
+        )
+        return rows[0][0] if rows else None
+
+    async def set(self, key: str, value: str, ttl: float):
+        await asyncio.to_thread(
+            self._execute, "INSERT OR REPLACE INTO sessions (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl), True
+        )
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._execute, "DELETE FROM sessions WHERE key = ?", (key,), True)
+
+    async def keys(self, prefix: str) -> List[str]:
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT key FROM sessions WHERE substr(key, 1, ?) = ? AND expires_at >= ?",
+            (len(prefix), prefix, time.time())
+        )
+        return [row[0] for row in rows]
+
+    async def purge_expired(self) -> int:
+        def purge():
+            with self._lock:
+                count = self._db.execute("DELETE FROM sessions WHERE expires_at < ?", (time.time(),)).rowcount
+                self._db.commit()
+            return count
+        return await asyncio.to_thread(purge)
+
+    async def close(self):
+        self._db.close()
+
+
+class RedisSessionBackend:
+    """Session backend on any server speaking the Redis protocol (RESP).
+
+    Expiry is left to the server via SET ... EX, so several bot replicas can
+    share sessions without coordinating. Commands share one connection, so a
+    command that fails or is cancelled midway drops it: its reply could
+    otherwise be read as the answer to the next command.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0, password: str = None,
+                 timeout: float = 5):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._roundtrip("AUTH", self.password)
+        if self.db:
+            await self._roundtrip("SELECT", self.db)
+
+    async def command(self, *args):
+        """Send one command and return its decoded reply, reconnecting once if the connection dropped"""
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None or self._writer.is_closing():
+                        await asyncio.wait_for(self._connect(), self.timeout)
+                    return await asyncio.wait_for(self._roundtrip(*args), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    self._disconnect()
+                    if attempt:
+                        raise
+                except BaseException:
+                    # Cancelled, timed out or unparseable: the stream position is unknown
+                    self._disconnect()
+                    raise
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _roundtrip(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._writer.write(b"".join(parts))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def _read_reply(self):
+        line = await self._reader.readuntil(b"\r\n")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            raise RuntimeError(f"Redis error: {body.decode()}")
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode()
+        if kind == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.command("GET", key)
+
+    async def set(self, key: str, value: str, ttl: float):
+        await self.command("SET", key, value, "EX", max(1, int(ttl)))
+
+    async def delete(self, key: str):
+        await self.command("DEL", key)
+
+    async def keys(self, prefix: str) -> List[str]:
+        found, cursor = [], "0"
+        while True:
+            cursor, batch = await self.command("SCAN", cursor, "MATCH", f"{prefix}*", "COUNT", 500)
+            found.extend(batch)
+            if cursor == "0":
+                return found
+
+    async def purge_expired(self) -> int:
+        # The server expires keys itself
+        return 0
+
+    async def close(self):
+        self._disconnect()
+
+
+class SessionStore:
+    """JSON sessions in namespaces ("fix", "user") on a pluggable backend.
+
+    Every write refreshes the entry's TTL, so sessions that are left alone
+    expire on their own.
+    """
+
+    def __init__(self, backend, ttl: float = 86400, prefix: str = "repofiy"):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, ttl: float = 86400) -> "SessionStore":
+        """Build a store from memory://, sqlite:///path/to.db or redis://[:password@]host[:port][/db]"""
+        from urllib.parse import urlparse
+
+        parsed = urlparse(url or "memory://")
+        if parsed.scheme == "memory":
+            backend = MemorySessionBackend()
+        elif parsed.scheme == "sqlite":
+            # sqlite:///relative.db or sqlite:////absolute/path.db
+            path = parsed.path[1:]
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            backend = SQLiteSessionBackend(path)
+        elif parsed.scheme == "redis":
+            backend = RedisSessionBackend(
+                host=parsed.hostname or "localhost",
+                port=parsed.port or 6379,
+                db=int(parsed.path.strip("/") or 0),
+                password=parsed.password,
+            )
+        else:
+            raise ValueError(f"Unsupported session store URL: {url}")
+        return cls(backend, ttl=ttl)
+
+    def _key(self, namespace: str, key) -> str:
+        return f"{self.prefix}:{namespace}:{key}"
+
+    async def get(self, namespace: str, key) -> Optional[dict]:
+        raw = await self.backend.get(self._key(namespace, key))
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, namespace: str, key, value: dict, ttl: float = None):
+        await self.backend.set(self._key(namespace, key), json.dumps(value), ttl or self.ttl)
+
+    async def delete(self, namespace: str, key):
+        await self.backend.delete(self._key(namespace, key))
+
+    async def items(self, namespace: str) -> Dict[str, dict]:
+        prefix = self._key(namespace, "")
+        result = {}
+        for full_key in await self.backend.keys(prefix):
+            value = await self.backend.get(full_key)
+            if value is not None:
+                result[full_key[len(prefix):]] = json.loads(value)
+        return result
+
+    async def purge_expired(self) -> int:
+        return await self.backend.purge_expired()
+
+    async def close(self):
+        await self.backend.close()
+
+
+class SessionPersistence(BasePersistence):
+    """python-telegram-bot persistence for user_data on top of a SessionStore.
+
+    Before each update the user's data is reloaded if another replica changed
+    it, so replicas behind one bot token see the same tokens and repo choices.
+    """
+
+    def __init__(self, store: SessionStore, ttl: float = 30 * 86400, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self.ttl = ttl
+        # Last serialized state seen in the store, per user
+        self._synced: Dict[int, Optional[str]] = {}
+        self._last_seen: Dict[int, float] = {}
+
+    @staticmethod
+    def _dump(data) -> Optional[str]:
+        return json.dumps(data, sort_keys=True) if data is not None else None
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        stored = await self.store.items("user")
+        result = {int(user_id): data for user_id, data in stored.items()}
+        for user_id, data in result.items():
+            self._synced[user_id] = self._dump(data)
+            self._last_seen[user_id] = time.monotonic()
+        return result
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        # Written even when unchanged so active users keep their TTL
+        await self.store.set("user", user_id, data, ttl=self.ttl)
+        self._synced[user_id] = self._dump(data)
+        self._last_seen[user_id] = time.monotonic()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        stored = await self.store.get("user", user_id)
+        serialized = self._dump(stored)
+        self._last_seen[user_id] = time.monotonic()
+        # Unchanged in the store: keep local edits that haven't been flushed yet
+        if serialized == self._synced.get(user_id):
+            return
+        user_data.clear()
+        if stored:
+            user_data.update(stored)
+        self._synced[user_id] = serialized
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self.store.delete("user", user_id)
+        self._synced.pop(user_id, None)
+        self._last_seen.pop(user_id, None)
+
+    def forget_idle(self, user_data) -> int:
+        """Clear the in-memory copy of users idle for longer than the TTL.
+
+        Only the local copy is cleared; if the user comes back their data is
+        reloaded from the store, if it hasn't expired there too.
+        """
+        cutoff = time.monotonic() - self.ttl
+        idle = [user_id for user_id, seen in self._last_seen.items() if seen < cutoff]
+        for user_id in idle:
+            if user_id in user_data:
+                user_data[user_id].clear()
+            del self._last_seen[user_id]
+            self._synced[user_id] = None
+        return len(idle)
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # Every update is written through immediately
+        pass
+
+
+class StreamingJSONTracker:
+    """Follows a streamed model response and spots the end of its JSON object.
+
+    Text before the first `{` (prose, markdown fences) is ignored. Once the
+    outermost object closes, `document` holds it and `complete` is set, so the
+    caller can stop reading the stream and start parsing straight away. A
+    balanced span that isn't a JSON object, like "{curly}" in prose, is set
+    aside in `rejected` and the search goes on from the next `{`.
+    """
+
+    SUMMARY_RE = re.compile(r'"summary"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+    def __init__(self):
+        self.buffer = ""
+        self.document: Optional[str] = None
+        self.rejected: List[str] = []
+        self._start = -1
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    @property
+    def complete(self) -> bool:
+        return self.document is not None
+
+    def feed(self, chunk: str) -> bool:
+        """Consume a chunk; returns True once the JSON object is complete"""
+        if self.complete:
+            return True
+
+        offset = len(self.buffer)
+        self.buffer += chunk
+
+        for i, char in enumerate(chunk, start=offset):
+            if self._start < 0:
+                if char == '{':
+                    self._start = i
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._depth += 1
+            elif char == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    document = self.buffer[self._start:i + 1]
+                    if isinstance(self.loads(document)[0], dict):
+                        self.document = document
+                        return True
+                    self.rejected.append(document)
+                    self._start = -1
+        return False
+
+    @staticmethod
+    def loads(document: str):
+        """(value or None, error) allowing raw control characters and trailing commas"""
+        try:
+            return json.loads(document, strict=False), None
+        except json.JSONDecodeError as e:
+            error = e
+        try:
+            return json.loads(StreamingJSONTracker._strip_trailing_commas(document), strict=False), None
+        except json.JSONDecodeError:
+            return None, f"invalid JSON: {error.msg} at line {error.lineno} column {error.colno}"
+
+    @staticmethod
+    def _strip_trailing_commas(document: str) -> str:
+        """Drop commas right before a closing bracket, leaving string contents alone"""
+        kept, in_string, escaped = [], False, False
+        for i, char in enumerate(document):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == ',':
+                rest = document[i + 1:].lstrip()
+                if rest[:1] in ('}', ']'):
+                    continue
+            kept.append(char)
+        return ''.join(kept)
+
+    def partial_summary(self) -> str:
+        """The `summary` field as far as it has been streamed"""
+        match = self.SUMMARY_RE.search(self.buffer)
+        if not match:
+            return ""
+        text = match.group(1)
+        # Drop a dangling escape from a chunk boundary before decoding
+        if text.endswith('\\') and not text.endswith('\\\\'):
+            text = text[:-1]
+        try:
+            return json.loads(f'"{text}"')
+        except json.JSONDecodeError:
+            return text
+
+
+class ResponseParser:
+    """Extracts and validates the solution object from a model response.
+
+    The object is located with StreamingJSONTracker, so prose and markdown
+    fences around it don't matter. Literal newlines inside strings and
+    trailing commas are tolerated. Output that was cut off is closed after
+    its last complete value, and the values cut off mid-way are dropped
+    rather than kept half-written; such a solution is marked `truncated`.
+    Optional fields of the wrong type are converted where that is obvious
+    and dropped otherwise.
+    """
+
+    REQUIRED = {"summary": str, "files": list, "changes": dict, "diff_preview": str}
+    OPTIONAL = {"cause": str, "tests_to_run": list, "confidence": str}
+    MAX_REPAIR_CUTS = 64
+    MAX_SCANS = 8
+
+    def parse(self, text: str):
+        """(solution or None, list of problems found)
+
+        A stray `{` in prose before the object keeps the first scan from
+        ever balancing, so unusable candidates are followed by a rescan from
+        the next `{`. The problems of the first candidate are reported.
+        """
+        result, offset = None, 0
+        for _ in range(self.MAX_SCANS):
+            data, problems, start = self._parse_from(text, offset)
+            if data is not None:
+                return data, problems
+            result = result or (None, problems)
+            following = text.find('{', start + 1) if start >= 0 else -1
+            if following < 0:
+                break
+            offset = following
+        return result
+
+    def _parse_from(self, text: str, offset: int):
+        """(solution or None, problems, position of the candidate object or -1)"""
+        tracker = StreamingJSONTracker()
+        tracker.feed(text[offset:])
+        start = offset + tracker._start if tracker._start >= 0 else -1
+        truncated = False
+        if tracker.complete:
+            data, problem = StreamingJSONTracker.loads(tracker.document)
+        elif tracker._start >= 0:
+            data, problem = self._close_truncated(text[start:])
+            truncated = data is not None
+        elif tracker.rejected:
+            # Report the error of the longest candidate, most likely the intended object
+            data, problem = StreamingJSONTracker.loads(max(tracker.rejected, key=len))
+        else:
+            return None, ["the response contains no JSON object"], -1
+        if data is None:
+            return None, [problem], start
+        data, problems = self.validate(data)
+        if data is not None and truncated:
+            data["truncated"] = True
+        return data, problems, start
+
+    def validate(self, data):
+        """Check field types, filling in what can be derived; (solution or None, problems)"""
+        if not isinstance(data, dict):
+            return None, ["the top-level value is not an object"]
+        data = dict(data)
+        if isinstance(data.get("files"), str):
+            data["files"] = [data["files"]]
+        if "files" not in data and isinstance(data.get("changes"), dict):
+            data["files"] = list(data["changes"])
+        if "diff_preview" not in data:
+            data["diff_preview"] = ""
+
+        problems = []
+        for field, kind in self.REQUIRED.items():
+            if field not in data:
+                problems.append(f'"{field}" is missing')
+            elif not isinstance(data[field], kind):
+                problems.append(f'"{field}" must be a {kind.__name__}')
+        for field, kind in self.OPTIONAL.items():
+            value = data.get(field)
+            if value is None or isinstance(value, kind):
+                continue
+            # Not worth a repair: e.g. confidence 0.9 becomes "0.9", a single test becomes a list
+            if kind is str and isinstance(value, (int, float)):
+                data[field] = str(value)
+            elif kind is list and isinstance(value, str):
+                data[field] = [value]
+            else:
+                del data[field]
+        if isinstance(data.get("files"), list) and not all(isinstance(path, str) for path in data["files"]):
+            problems.append('"files" must only contain paths')
+        if isinstance(data.get("changes"), dict):
+            for path, change in data["changes"].items():
+                if change is not None and not isinstance(change, str):
+                    problems.append(f'"changes" for {path} must be a string')
+        return (None, problems) if problems else (data, [])
+
+    def _close_truncated(self, fragment: str):
+        """Close a cut-off object after its last complete value"""
+        stack, in_string, escaped = [], False, False
+        # (position, containers open there) just before each separator
+        cuts = [(len(fragment), None)]
+        for i, char in enumerate(fragment):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in '{[':
+                stack.append('}' if char == '{' else ']')
+            elif char in '}]' and stack:
+                stack.pop()
+            elif char == ',':
+                cuts.append((i, list(stack)))
+        cuts[0] = (len(fragment), None if in_string else stack)
+
+        # Longest candidate first: everything, then before each separator from the end
+        for position, open_containers in [cuts[0]] + cuts[:0:-1][:self.MAX_REPAIR_CUTS]:
+            if open_containers is None:
+                continue
+            candidate = fragment[:position].rstrip().rstrip(',')
+            if candidate.endswith(':'):
+                continue
+            data, _ = StreamingJSONTracker.loads(candidate + ''.join(reversed(open_containers)))
+            if data is not None:
+                logger.warning(f"Model response was truncated, kept it up to character {position}")
+                return data, None
+        return None, "the JSON object is incomplete (the response was cut off)"
+
+
+class MessageEditScheduler:
+    """Central outbound scheduler for Telegram message edits.
+
+    Edits are queued per chat and coalesced per message: only the newest
+    pending text for a message is ever sent. Each chat gets its own minimum
+    interval between edits, all chats share a global rate, and flood control
+    (RetryAfter) pauses the chat for as long as Telegram asks.
+    """
+
+    def __init__(self, global_rate: float = 25, chat_interval: float = 1.0, group_interval: float = 3.0):
+        self.global_interval = 1.0 / global_rate
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.flood_waits = 0
+        self._pending: Dict[int, "OrderedDict[int, dict]"] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._chat_ready_at: Dict[int, float] = {}
+        self._next_global = 0.0
+
+    async def edit(self, message, text: str, wait: bool = False, **kwargs):
+        """Queue `message.edit_text(text, **kwargs)`.
+
+        With `wait`, returns once this text (or a newer one for the same
+        message) has been delivered and re-raises delivery errors.
+        """
+        chat_id = message.chat_id
+        pending = self._pending.setdefault(chat_id, OrderedDict())
+        entry = pending.get(message.message_id)
+        if entry is None:
+            entry = {'futures': []}
+            pending[message.message_id] = entry
+        # Newest state wins; earlier waiters are resolved by this delivery
+        entry.update(message=message, text=text, kwargs=kwargs)
+
+        future = None
+        if wait:
+            future = asyncio.get_running_loop().create_future()
+            entry['futures'].append(future)
+
+        worker = self._workers.get(chat_id)
+        if worker is None or worker.done():
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+        if future is not None:
+            return await future
+
+    async def _drain(self, chat_id: int):
+        pending = self._pending[chat_id]
+        interval = self.group_interval if chat_id < 0 else self.chat_interval
+
+        while pending:
+            await self._wait_for_slot(chat_id)
+            message_id, entry = pending.popitem(last=False)
+            futures = entry['futures']
+
+            try:
+                result = await entry['message'].edit_text(entry['text'], **entry['kwargs'])
+            except RetryAfter as e:
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                self.flood_waits += 1
+                logger.warning(f"Flood control in chat {chat_id}, retrying in {delay}s")
+                self._chat_ready_at[chat_id] = time.monotonic() + delay
+                self._requeue(pending, message_id, entry)
+                continue
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    result = None
+                else:
+                    self._resolve(futures, error=e)
+                    continue
+            except Exception as e:
+                self._resolve(futures, error=e)
+                continue
+            finally:
+                self._chat_ready_at[chat_id] = max(
+                    self._chat_ready_at.get(chat_id, 0.0), time.monotonic() + interval
+                )
+
+            self._resolve(futures, result=result)
+
+        self._pending.pop(chat_id, None)
+        self._workers.pop(chat_id, None)
+
+    @staticmethod
+    def _requeue(pending, message_id: int, entry: dict):
+        newer = pending.get(message_id)
+        if newer is None:
+            pending[message_id] = entry
+        else:
+            # A newer state arrived meanwhile: keep it, carry over the waiters
+            newer['futures'] = entry['futures'] + newer['futures']
+        pending.move_to_end(message_id, last=False)
+
+    async def _wait_for_slot(self, chat_id: int):
+        now = time.monotonic()
+        chat_wait = self._chat_ready_at.get(chat_id, 0.0) - now
+        if chat_wait > 0:
+            await asyncio.sleep(chat_wait)
+            now = time.monotonic()
+
+        # Reserve the next global slot
+        slot = max(now, self._next_global)
+        self._next_global = slot + self.global_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    @staticmethod
+    def _resolve(futures: list, result=None, error: Exception = None):
+        for future in futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class ProgressReporter:
+    """Background status-message updater for long-running tasks.
+
+    The work only records its current stage and counters through `update`;
+    a background task renders them at most once per `interval` seconds and
+    only when something changed, so reporting never delays the work itself.
+    """
+
+    def __init__(self, edit, header: str, loader=None, interval: float = 1.5):
+        self.edit = edit  # async callable taking the new message text
+        self.header = header
+        self.loader = loader
+        self.interval = interval
+        self.stage = ""
+        self.detail = ""
+        self.counters: Dict[str, str] = {}
+        self._frame = 0
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, stage: str = None, detail: str = None, **counters):
+        """Record progress; e.g. update("Committing...", files_committed="2/5")"""
+        if stage is not None:
+            self.stage = stage
+        if detail is not None:
+            self.detail = detail
+        for name, value in counters.items():
+            self.counters[name.replace('_', ' ').capitalize()] = str(value)
+        self._dirty = True
+
+    def render(self) -> str:
+        stage = self.loader(self._frame, self.stage) if self.loader else self.stage
+        text = f"{self.header}\n\n{stage}"
+        if self.counters:
+            text += "\n" + " · ".join(f"{name}: {value}" for name, value in self.counters.items())
+        if self.detail:
+            text += f"\n\n🧠 {self.detail}"
+        return text
+
+    def start(self) -> "ProgressReporter":
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        """Stop reporting; waits for an in-flight edit so it can't land after the caller's final one"""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def __aenter__(self) -> "ProgressReporter":
+        return self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._dirty:
+                continue
+            self._dirty = False
+            self._frame += 1
+            try:
+                await self.edit(self.render())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug(f"Skipped progress update: {str(e)}")
+
+
+class ScheduledTask:
+    """A code task waiting for, or holding, a TaskScheduler slot"""
+
+    def __init__(self, user_id: int, factory, on_position=None, on_cancel=None):
+        self.user_id = user_id
+        self.factory = factory
+        self.on_position = on_position
+        self.on_cancel = on_cancel
+        self.position = 0
+        self.granted = asyncio.get_running_loop().create_future()
+        self.task: Optional[asyncio.Task] = None
+
+
+class TaskScheduler:
+    """Runs code tasks on a fixed number of worker slots.
+
+    Tasks wait in FIFO order. A waiting task starts once a slot is free and its
+    user has fewer than `per_user` tasks running. Waiting tasks get their queue
+    position through `on_position` whenever it changes, and cancelled tasks
+    (queued or running) get `on_cancel`.
+    """
+
+    def __init__(self, workers: int = 4, per_user: int = 1, max_queued: int = 100, max_queued_per_user: int = 3):
+        self.workers = workers
+        self.per_user = per_user
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.completed = 0
+        self.cancelled = 0
+        self._pending: List[ScheduledTask] = []
+        self._running: Dict[int, List[ScheduledTask]] = {}
+        self._notifications = set()
+
+    @property
+    def running_count(self) -> int:
+        return sum(len(jobs) for jobs in self._running.values())
+
+    @property
+    def queued_count(self) -> int:
+        return len(self._pending)
+
+    def submit(self, user_id: int, factory, on_position=None, on_cancel=None) -> ScheduledTask:
+        """Queue `factory()` (a coroutine function) for `user_id`.
+
+        Raises asyncio.QueueFull if the queue, or the user's share of it, is full.
+        """
+        queued_for_user = sum(1 for job in self._pending if job.user_id == user_id)
+        if len(self._pending) >= self.max_queued or queued_for_user >= self.max_queued_per_user:
+            raise asyncio.QueueFull()
+
+        job = ScheduledTask(user_id, factory, on_position, on_cancel)
+        self._pending.append(job)
+        job.task = asyncio.create_task(self._run(job))
+        self._dispatch()
+        return job
+
+    def user_tasks(self, user_id: int) -> List[ScheduledTask]:
+        return self._running.get(user_id, []) + [job for job in self._pending if job.user_id == user_id]
+
+    def cancel(self, user_id: int) -> int:
+        """Cancel every queued and running task of `user_id`"""
+        jobs = self.user_tasks(user_id)
+        for job in jobs:
+            # Out of the queue right away so nobody announces a position to it
+            if job in self._pending:
+                self._pending.remove(job)
+            job.position = 0
+            job.task.cancel()
+        self._dispatch()
+        return len(jobs)
+
+    async def close(self):
+        jobs = [job for jobs in self._running.values() for job in jobs] + self._pending
+        for job in jobs:
+            job.task.cancel()
+        await asyncio.gather(*(job.task for job in jobs), return_exceptions=True)
+
+    async def _run(self, job: ScheduledTask):
+        try:
+            await job.granted
+            await job.factory()
+            self.completed += 1
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            if job.on_cancel:
+                await job.on_cancel()
+        except Exception as e:
+            logger.error(f"Task for user {job.user_id} failed: {str(e)}")
+        finally:
+            if job in self._pending:
+                self._pending.remove(job)
+            running = self._running.get(job.user_id)
+            if running and job in running:
+                running.remove(job)
+                if not running:
+                    del self._running[job.user_id]
+            self._dispatch()
+
+    def _dispatch(self):
+        for job in list(self._pending):
+            if self.running_count >= self.workers:
+                break
+            if len(self._running.get(job.user_id, [])) >= self.per_user or job.granted.done():
+                continue
+            self._pending.remove(job)
+            self._running.setdefault(job.user_id, []).append(job)
+            job.position = 0
+            job.granted.set_result(None)
+
+        for position, job in enumerate(self._pending, 1):
+            if job.position != position:
+                job.position = position
+                if job.on_position:
+                    self._notify(job.on_position(position))
+
+    def _notify(self, coro):
+        # Position updates are best effort, don't hold up dispatching
+        task = asyncio.create_task(coro)
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+
+
+class WebhookServer:
+    """aiohttp server that receives Telegram webhook updates for an Application.
+
+    Besides the webhook path it serves /healthz (the process is up) and
+    /readyz (the bot is accepting updates) for load balancer checks, and
+    /metrics when given a MetricsRegistry.
+    """
+
+    SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+    def __init__(self, application: Application, path: str = "/telegram", secret_token: str = None,
+                 listen: str = "0.0.0.0", port: int = 8080, metrics: MetricsRegistry = None):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.listen = listen
+        self.port = port
+        self.ready = False
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application()
+        self.app.router.add_post(path, self._handle_update)
+        self.app.router.add_get("/healthz", self._handle_health)
+        self.app.router.add_get("/readyz", self._handle_ready)
+        if metrics is not None:
+            self.app.router.add_get("/metrics", metrics.handle)
+
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token:
+            received = request.headers.get(self.SECRET_HEADER, "")
+            if not hmac.compare_digest(received.encode(), self.secret_token.encode()):
+                return web.Response(status=403)
+        if not self.ready:
+            # Telegram retries, and the load balancer will route elsewhere
+            return web.Response(status=503)
+
+        try:
+            # Covers malformed JSON and bodies that aren't UTF-8 (UnicodeDecodeError)
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        try:
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return web.Response(status=400)
+        await self.application.update_queue.put(update)
+        return web.Response()
+
+    async def _handle_health(self, request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def _handle_ready(self, request: web.Request) -> web.Response:
+        if self.ready and self.application.running:
+            return web.Response(text="ready")
+        return web.Response(status=503, text="not ready")
+
+    async def start(self):
+        # Health checks would flood the access log
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info(f"Webhook server listening on {self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        """Stop accepting updates and close the server, letting in-flight requests finish"""
+        self.ready = False
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
 
 class BugFixerBot:
     """Reopfiy Bot - handles bug fixes, feature development, code changes, and repository management"""
@@ -48,18 +3173,181 @@ class BugFixerBot:
         self.github_token = github_token
         self.groq_key = groq_key
         
+        # API endpoints; overridable for GitHub Enterprise, proxies and benchmarks
+        self.github_url = os.getenv('REPOFIY_GITHUB_API_URL', GITHUB_API_URL)
+        self.groq_url = os.getenv('REPOFIY_GROQ_URL', "https://api.groq.com/openai/v1/chat/completions")
+        self.openrouter_url = os.getenv('REPOFIY_OPENROUTER_URL', "https://openrouter.ai/api/v1/chat/completions")
+        
         # Only initialize GitHub client if token is provided
-        self.github_client = Github(github_token) if github_token else None
+        self.github_client = Github(github_token, base_url=self.github_url) if github_token else None
         
-        self.groq_url = "https://api.groq.com/openai/v1/chat/completions"
         self.groq_headers = {
             "Authorization": f"Bearer {groq_key}",
             "Content-Type": "application/json"
         }
         
-        # Store active sessions
-        self.active_fixes: Dict[int, dict] = {}
+        # Stage timings and counters, served on /metrics
+        self.metrics = MetricsRegistry()
+        self._metrics_runner: Optional[web.AppRunner] = None
+        
+        # Task sessions and user settings; point REPOFIY_SESSION_URL at sqlite or
+        # redis to keep them across restarts and share them between replicas
+        session_url = os.getenv('REPOFIY_SESSION_URL', 'memory://')
+        session_ttl = float(os.getenv('REPOFIY_SESSION_TTL', '86400'))
+        try:
+            self.sessions = SessionStore.from_url(session_url, ttl=session_ttl)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Session store {session_url} unusable, keeping sessions in memory: {str(e)}")
+            self.sessions = SessionStore.from_url("memory://", ttl=session_ttl)
+        self.persistence = SessionPersistence(
+            self.sessions,
+            ttl=float(os.getenv('REPOFIY_USER_DATA_TTL', str(30 * 86400))),
+            update_interval=float(os.getenv('REPOFIY_PERSISTENCE_INTERVAL', '5')),
+        )
+        self._session_reaper: Optional[asyncio.Task] = None
+        
+        # Code tasks run on a bounded worker pool, one at a time per user by default
+        self.tasks = TaskScheduler(
+            workers=int(os.getenv('REPOFIY_TASK_WORKERS', '4')),
+            per_user=int(os.getenv('REPOFIY_TASKS_PER_USER', '1')),
+            max_queued=int(os.getenv('REPOFIY_TASK_QUEUE_SIZE', '100')),
+            max_queued_per_user=int(os.getenv('REPOFIY_TASK_QUEUE_PER_USER', '3')),
+        )
+        # Cap on AI requests in flight across all providers
+        self.llm_slots = asyncio.Semaphore(int(os.getenv('REPOFIY_LLM_CONCURRENCY', '8')))
+        
+        # Per-request model choice from rolling latency, error and cost stats
+        self.router = ModelRouter(
+            small_tokens=int(os.getenv('REPOFIY_ROUTER_SMALL_TOKENS', '1500')),
+            max_latency=float(os.getenv('REPOFIY_ROUTER_MAX_LATENCY', '30')),
+        )
+        
+        # Retries, deadlines and hedging for AI provider calls
+        self.resilience = ProviderResilience(
+            attempts=int(os.getenv('REPOFIY_LLM_ATTEMPTS', '3')),
+            deadlines={
+                provider: float(os.getenv(f'REPOFIY_DEADLINE_{provider.upper()}', default))
+                for provider, default in (('groq', 60), ('openrouter', 120), ('anthropic', 120))
+            },
+            hedge_after=float(os.getenv('REPOFIY_HEDGE_AFTER', '15')),
+        )
+        
+        # Identical for every request so providers can cache it
+        self.system_prompt = self._load_system_prompt()
+        self.cached_prompt_tokens = 0
+        
+        # Parsed AI solutions, reused when the same request is sent again
+        self.responses = ResponseCache(
+            ttl=float(os.getenv('REPOFIY_RESPONSE_CACHE_TTL', '3600')),
+            max_entries=int(os.getenv('REPOFIY_RESPONSE_CACHE_SIZE', '512')),
+            db_path=os.getenv('REPOFIY_RESPONSE_CACHE_DB') or None,
+        )
+        
+        # All status message edits go through one rate-limited scheduler
+        self.messages = MessageEditScheduler(
+            global_rate=float(os.getenv('REPOFIY_TELEGRAM_GLOBAL_RATE', '25')),
+            chat_interval=float(os.getenv('REPOFIY_TELEGRAM_CHAT_INTERVAL', '1.0')),
+        )
+        
+        # Shared GitHub clients and content caches, persisted under REPOFIY_CACHE_DIR
+        cache_dir = os.getenv('REPOFIY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'repofiy'))
+        snapshots = None
+        if cache_dir:
+            try:
+                snapshots = SnapshotStore(
+                    cache_dir,
+                    max_age=float(os.getenv('REPOFIY_SNAPSHOT_MAX_AGE', '60')),
+                    max_bytes=int(os.getenv('REPOFIY_SNAPSHOT_MAX_MB', '1024')) * 1024 * 1024,
+                )
+            except OSError as e:
+                logger.warning(f"Snapshot store disabled, cannot use {cache_dir}: {str(e)}")
+        
+        self.github = GitHubGateway(
+            blob_cache=BlobCache(int(os.getenv('REPOFIY_BLOB_CACHE_MB', '64')) * 1024 * 1024),
+            tree_cache=TreeCache(int(os.getenv('REPOFIY_TREE_CACHE_REPOS', '64'))),
+            snapshots=snapshots,
+            head_ttl=float(os.getenv('REPOFIY_HEAD_TTL', '15')),
+            max_workers=int(os.getenv('REPOFIY_GITHUB_WORKERS', '8')),
+            reserve=int(os.getenv('REPOFIY_GITHUB_RESERVE', '500')),
+            base_url=self.github_url,
+            metrics=self.metrics,
+            request_interval=float(os.getenv('REPOFIY_GITHUB_REQUEST_INTERVAL', '0')),
+            write_interval=float(os.getenv('REPOFIY_GITHUB_WRITE_INTERVAL', '0.25')),
+        )
+        self.commits = CommitEngine(self.github)
+        self.patches = PatchEngine()
+        self.parser = ResponseParser()
+        self.repairs = 0
+        self.chunker = CodeChunker()
+        
+        # Per-repo relevance indexes for context selection
+        self.lexical_indexes: "OrderedDict[str, LexicalIndex]" = OrderedDict()
+        self.max_lexical_indexes = int(os.getenv('REPOFIY_TREE_CACHE_REPOS', '64'))
+        
+        # Pooled AI provider sessions and SDK clients
+        self.ai_clients = ProviderClientRegistry(
+            max_concurrency=int(os.getenv('REPOFIY_PROVIDER_CONCURRENCY', '8')),
+            idle_timeout=float(os.getenv('REPOFIY_PROVIDER_IDLE_TIMEOUT', '300')),
+        )
+        
+        self._register_metrics()
+        
+    def _register_metrics(self):
+        """Declare the exported metrics and collect the figures kept by other components"""
+        metrics = self.metrics
+        metrics.histogram("stage_seconds", "Duration of code task and apply pipeline stages")
+        metrics.histogram("task_seconds", "Duration of whole code tasks and applies, by outcome")
+        metrics.counter("github_requests", "GitHub API responses received, by HTTP status")
+        metrics.counter("github_response_bytes", "Bytes of GitHub API response bodies")
+        metrics.counter("llm_requests", "AI provider requests")
+        metrics.counter("llm_tokens", "Estimated AI tokens sent (in) and received (out)")
+        
+        metrics.collect("github_not_modified", "counter", "GitHub revalidations answered with 304",
+                        lambda: self.github.not_modified)
+        metrics.collect("llm_cached_prompt_tokens", "counter", "Prompt tokens read from the provider's prompt cache",
+                        lambda: self.cached_prompt_tokens)
+        metrics.collect("llm_response_repairs", "counter", "Unusable AI responses sent for repair",
+                        lambda: self.repairs)
+        for cache, store in (("response", self.responses), ("blob", self.github.blob_cache)):
+            metrics.collect("cache_hits", "counter", "Cache lookups answered from the cache",
+                            lambda store=store: store.hits, cache=cache)
+            metrics.collect("cache_misses", "counter", "Cache lookups that missed",
+                            lambda store=store: store.misses, cache=cache)
+        metrics.collect("telegram_flood_waits", "counter", "Telegram 429 (RetryAfter) responses to message edits",
+                        lambda: self.messages.flood_waits)
+        metrics.collect("tasks_running", "gauge", "Code tasks running", lambda: self.tasks.running_count)
+        metrics.collect("tasks_queued", "gauge", "Code tasks waiting for a slot", lambda: self.tasks.queued_count)
+        metrics.collect("tasks_completed", "counter", "Code tasks finished", lambda: self.tasks.completed)
+        metrics.collect("tasks_cancelled", "counter", "Code tasks cancelled", lambda: self.tasks.cancelled)
+    
+    def _load_system_prompt(self) -> str:
+        """System prompt from SYSTEM_PROMPT.md followed by the response format"""
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        if os.getenv('REPOFIY_SYSTEM_PROMPT'):
+            candidates = [os.getenv('REPOFIY_SYSTEM_PROMPT')]
+        else:
+            candidates = [os.path.join(base_dir, 'docs', 'SYSTEM_PROMPT.md'), os.path.join(base_dir, 'SYSTEM_PROMPT.md')]
         
+        content = DEFAULT_SYSTEM_PROMPT
+        for path in candidates:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    content = f.read().strip()
+                logger.info(f"✅ System prompt loaded from {path}")
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            logger.warning("⚠️ SYSTEM_PROMPT.md not found, using default")
+        return f"{content}\n\n{RESPONSE_FORMAT}"
+    
+    @staticmethod
+    def escape_markdown(text: str) -> str:
+        """Escape Telegram Markdown control characters"""
+        for char in ('_', '*', '`', '['):
+            text = text.replace(char, f"\\{char}")
+        return text
+    
     def get_loader_text(self, stage: int, base_text: str, loader_type: str = "dots") -> str:
         """Get animated loader text"""
         frames = self.LOADERS.get(loader_type, self.LOADERS["dots"])
@@ -76,6 +3364,7 @@ Fix bugs, create features, refactor code, and more.
 
 **Setup:**
 /setai - Choose AI provider (Anthropic, OpenRouter, Groq)
+/route - Choose fast vs strong model routing
 /settoken <token> - Add GitHub token
 /setrepo <owner/repo> - Set repository
 
@@ -128,6 +3417,46 @@ Ready to manage code from your phone? Let's go!
             reply_markup=reply_markup
         )
     
+    async def route_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show or set how requests are routed between fast and strong models"""
+        if context.args:
+            policy = context.args[0].lower()
+            if policy not in ModelRouter.POLICIES:
+                await update.message.reply_text(
+                    "Usage: /route <auto|quality|speed> [max cost per request in USD]\n"
+                    "Example: /route auto 0.02"
+                )
+                return
+            context.user_data['route_policy'] = policy
+            if len(context.args) > 1:
+                try:
+                    context.user_data['route_max_cost'] = float(context.args[1].lstrip('$'))
+                except ValueError:
+                    await update.message.reply_text("Max cost must be a number, e.g. 0.02")
+                    return
+            else:
+                context.user_data.pop('route_max_cost', None)
+        
+        provider = context.user_data.get('ai_provider', 'groq')
+        if provider not in MODEL_TIERS:
+            provider = "groq"
+        policy = context.user_data.get('route_policy', 'auto')
+        max_cost = context.user_data.get('route_max_cost')
+        lines = [
+            f"🧭 **Model routing:** {policy}" + (f", max ${max_cost:g} per request" if max_cost is not None else ""),
+            "auto: fast model for /create, revisions and small requests, strong model otherwise",
+            "",
+        ]
+        for tier, model in MODEL_TIERS[provider].items():
+            stats = self.router.stats((provider, model))
+            line = f"**{tier.title()}:** `{model}`"
+            if stats['samples']:
+                latency = f"{stats['p50_latency']:.1f}s" if stats['p50_latency'] is not None else "n/a"
+                cost = f"${stats['avg_cost']:.4f}" if stats['avg_cost'] is not None else "n/a"
+                line += f"\n  p50 {latency}, errors {stats['error_rate']:.0%}, avg cost {cost} ({stats['samples']} requests)"
+            lines.append(line)
+        await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+    
     async def set_token_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Update GitHub token"""
         # Check if token provided directly
@@ -137,8 +3466,7 @@ Ready to manage code from your phone? Let's go!
             if len(token) > 20:
                 try:
                     # Verify token works
-                    test_client = Github(token)
-                    test_client.get_user().login
+                    await self.github.verify_token(token)
                     
                     context.user_data['github_token'] = token
                     await update.message.reply_text(
@@ -200,10 +3528,8 @@ Ready to manage code from your phone? Let's go!
         repo_name = context.args[0]
         
         try:
-            # Get user's GitHub client
-            github_client = Github(context.user_data['github_token'])
             # Verify repository exists and user has access
-            repo = github_client.get_repo(repo_name)
+            repo = await self.github.get_repo(context.user_data['github_token'], repo_name)
             
             # Store in user context
             context.user_data['repo'] = repo_name
@@ -218,6 +3544,9 @@ Ready to manage code from your phone? Let's go!
                 f"❌ Error accessing repository: {str(e)}\n"
                 "Make sure the repository exists and your GitHub token has access."
             )
+        except RuntimeError as e:
+            # Rate limit budget exhausted; the message says when it resets
+            await update.message.reply_text(f"❌ {str(e)}\nTry /setrepo again after that.")
     
     async def fix_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Start the bug fix process"""
@@ -305,8 +3634,7 @@ Ready to manage code from your phone? Let's go!
         )
         
         try:
-            github_client = Github(context.user_data['github_token'])
-            repo = github_client.get_repo(repo_name)
+            repo = await self.github.get_repo(context.user_data['github_token'], repo_name)
             
             # Get important files
             important_files = await self.get_important_files(repo)
@@ -345,40 +3673,42 @@ Ready to manage code from your phone? Let's go!
                 f"❌ Error loading files: {str(e)}"
             )
     
+    async def get_tree_index(self, repo) -> RepoTreeIndex:
+        """Get the flat tree index for the repository's default branch"""
+        return await self.github.get_tree_index(repo)
+    
+    def get_lexical_index(self, repo_name: str) -> LexicalIndex:
+        """Relevance index for a repository, kept for the most recently used repos"""
+        index = self.lexical_indexes.get(repo_name)
+        if index is None:
+            index = LexicalIndex()
+            self.lexical_indexes[repo_name] = index
+            while len(self.lexical_indexes) > self.max_lexical_indexes:
+                self.lexical_indexes.popitem(last=False)
+        self.lexical_indexes.move_to_end(repo_name)
+        return index
+    
     async def get_important_files(self, repo, path: str = "", max_files: int = 20) -> list:
         """Get list of important files from repo"""
-        important_files = []
-        priority_extensions = ['.py', '.js', '.ts', '.jsx', '.tsx', '.java', '.go', '.rb', '.md', 'README', '.json', '.yml', '.yaml']
+        priority_extensions = ('.py', '.js', '.ts', '.jsx', '.tsx', '.java', '.go', '.rb', '.md', 'README', '.json', '.yml', '.yaml')
         
         try:
-            contents = repo.get_contents(path) if path else repo.get_contents("")
+            index = await self.get_tree_index(repo)
+            prefix = f"{path.strip('/')}/" if path else ""
             
-            for item in contents:
-                # Skip hidden and unimportant dirs
-                if item.name.startswith('.') or item.name in ['node_modules', '__pycache__', '.git', 'venv', 'env', 'dist', 'build']:
-                    continue
-                
-                if item.type == "file":
-                    # Prioritize certain extensions
-                    if any(item.name.endswith(ext) for ext in priority_extensions) or item.name in ['README', 'Dockerfile']:
-                        important_files.append(item.path)
-                
-                elif item.type == "dir" and len(important_files) < max_files:
-                    # Recursively check subdirectories
-                    try:
-                        sub_files = await self.get_important_files(repo, item.path, max_files - len(important_files))
-                        important_files.extend(sub_files)
-                    except:
-                        pass
-                
-                if len(important_files) >= max_files:
-                    break
+            important_files = [
+                entry for entry in index.files()
+                if entry.path.startswith(prefix)
+                and (entry.name.endswith(priority_extensions) or entry.name in ['README', 'Dockerfile'])
+            ]
+            # Shallow files first, they're usually the entry points
+            important_files.sort(key=lambda e: (e.depth, e.path))
             
-            return important_files[:max_files]
+            return [entry.path for entry in important_files[:max_files]]
             
         except Exception as e:
             logger.warning(f"Error getting important files: {str(e)}")
-            return important_files
+            return []
     
     async def view_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE, filename: str, repo_name: str):
         """View specific file content"""
@@ -386,12 +3716,19 @@ Ready to manage code from your phone? Let's go!
         is_callback = update.callback_query is not None
         
         try:
-            github_client = Github(context.user_data['github_token'])
-            repo = github_client.get_repo(repo_name)
-            file_obj = repo.get_contents(filename)
+            repo = await self.github.get_repo(context.user_data['github_token'], repo_name)
+            index = await self.get_tree_index(repo)
+            entry = index.get(filename)
+            
+            if entry is None or entry.type != "blob":
+                raise FileNotFoundError(f"{filename} not found in {repo_name}")
+            
+            raw = await self.github.read_blob(repo, entry)
             
             # Check if it's a binary file
-            if not isinstance(file_obj.content, str):
+            try:
+                content = raw.decode('utf-8')
+            except UnicodeDecodeError:
                 msg = f"❌ Cannot display binary file: {filename}"
                 if is_callback:
                     await update.callback_query.answer()
@@ -400,8 +3737,6 @@ Ready to manage code from your phone? Let's go!
                     await update.message.reply_text(msg)
                 return
             
-            content = file_obj.decoded_content.decode('utf-8')
-            
             # Detect language for syntax highlighting
             ext = filename.split('.')[-1] if '.' in filename else ''
             lang_map = {
@@ -484,11 +3819,10 @@ Ready to manage code from your phone? Let's go!
         
         try:
             # Get repository
-            github_client = Github(context.user_data['github_token'])
-            repo = github_client.get_repo(repo_name)
+            repo = await self.github.get_repo(context.user_data['github_token'], repo_name)
             
             # Get repository structure
-            structure = await self.get_repo_structure(repo)
+            structure = await self.get_repo_structure(repo, limit=3000)
             
             # Build file tree message
             message = f"📁 **Repository: {repo_name}**\n\n"
@@ -500,65 +3834,76 @@ Ready to manage code from your phone? Let's go!
             message += structure[:3000]  # Limit message size
             message += "\n```"
             
-            await status_message.edit_text(message, parse_mode='Markdown')
+            await self.messages.edit(status_message, message, wait=True, parse_mode='Markdown')
             
         except Exception as e:
             logger.error(f"Error analyzing repository: {str(e)}")
             error_msg = str(e).replace("_", "\\_").replace("*", "\\*")
-            await status_message.edit_text(
+            await self.messages.edit(
+                status_message,
                 f"❌ **Error analyzing repository:**\n`{error_msg}`",
+                wait=True,
                 parse_mode='Markdown'
             )
     
-    async def get_repo_structure(self, repo, path: str = "", level: int = 0, max_level: int = 3) -> str:
-        """Recursively get repository structure"""
-        if level > max_level:
-            return ""
-        
+    async def get_repo_structure(self, repo, path: str = "", max_level: int = 3, limit: int = None) -> str:
+        """Render the repository structure from the tree index, stopping after `limit` characters"""
         try:
-            contents = repo.get_contents(path) if path else repo.get_contents("")
-            
-            structure = ""
-            
-            # Separate directories and files
-            items = sorted(contents, key=lambda x: (x.type != "dir", x.name))
-            
-            for item in items:
-                indent = "  " * level
-                
-                # Skip hidden files and common unimportant dirs
-                if item.name.startswith('.') or item.name in ['node_modules', '__pycache__', '.git', 'venv', 'env']:
-                    continue
-                
-                if item.type == "dir":
-                    structure += f"{indent}📁 {item.name}/\n"
-                    # Recursively get subdirectory contents
-                    try:
-                        sub_structure = await self.get_repo_structure(repo, item.path, level + 1, max_level)
-                        structure += sub_structure
-                    except:
-                        pass
-                else:
-                    # Show file with extension icon
-                    icon = "📄"
-                    if item.name.endswith('.py'):
-                        icon = "🐍"
-                    elif item.name.endswith(('.js', '.ts', '.jsx', '.tsx')):
-                        icon = "⚡"
-                    elif item.name.endswith(('.html', '.css')):
-                        icon = "🎨"
-                    elif item.name.endswith(('.md', '.txt')):
-                        icon = "📝"
-                    elif item.name.endswith(('.json', '.yaml', '.yml')):
-                        icon = "⚙️"
-                    
-                    structure += f"{indent}{icon} {item.name}\n"
-            
-            return structure
-            
+            index = await self.get_tree_index(repo)
         except Exception as e:
             logger.warning(f"Error getting structure for {path}: {str(e)}")
             return ""
+        
+        lines: List[str] = []
+        self._render_structure(index, path, 0, max_level, lines, [0, limit])
+        return "".join(lines)
+    
+    def _render_structure(self, index: RepoTreeIndex, path: str, level: int, max_level: int,
+                          lines: List[str], budget: list) -> bool:
+        """Recursively render one directory of the tree index; False once the limit is reached"""
+        if level > max_level:
+            return True
+        
+        indent = "  " * level
+        
+        # Directories first, then files
+        items = sorted(index.children(path), key=lambda x: (x.type != "tree", x.name))
+        
+        for item in items:
+            # Skip hidden files and common unimportant dirs
+            if item.name.startswith('.') or item.name in IGNORED_DIRS:
+                continue
+            
+            if item.type == "tree":
+                if not self._add_structure_line(f"{indent}📁 {item.name}/\n", lines, budget):
+                    return False
+                if not self._render_structure(index, item.path, level + 1, max_level, lines, budget):
+                    return False
+            else:
+                # Show file with extension icon
+                icon = "📄"
+                if item.name.endswith('.py'):
+                    icon = "🐍"
+                elif item.name.endswith(('.js', '.ts', '.jsx', '.tsx')):
+                    icon = "⚡"
+                elif item.name.endswith(('.html', '.css')):
+                    icon = "🎨"
+                elif item.name.endswith(('.md', '.txt')):
+                    icon = "📝"
+                elif item.name.endswith(('.json', '.yaml', '.yml')):
+                    icon = "⚙️"
+                
+                if not self._add_structure_line(f"{indent}{icon} {item.name}\n", lines, budget):
+                    return False
+        
+        return True
+    
+    @staticmethod
+    def _add_structure_line(line: str, lines: List[str], budget: list) -> bool:
+        """Append a rendered line; budget is [characters so far, limit or None]"""
+        lines.append(line)
+        budget[0] += len(line)
+        return budget[1] is None or budget[0] < budget[1]
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle regular text messages as bug descriptions or API keys"""
@@ -603,8 +3948,7 @@ Ready to manage code from your phone? Let's go!
             if len(token) > 20:
                 try:
                     # Verify token works
-                    test_client = Github(token)
-                    test_client.get_user().login
+                    await self.github.verify_token(token)
                     
                     context.user_data['github_token'] = token
                     context.user_data['waiting_for_github_token'] = False
@@ -636,8 +3980,7 @@ Ready to manage code from your phone? Let's go!
             if len(token) > 20:
                 try:
                     # Verify token works
-                    test_client = Github(token)
-                    test_client.get_user().login
+                    await self.github.verify_token(token)
                     
                     context.user_data['github_token'] = token
                     await update.message.reply_text(
@@ -663,6 +4006,14 @@ Ready to manage code from your phone? Let's go!
                 )
                 return
         
+        if context.user_data.pop('revising', False):
+            fix_data = await self.sessions.get("fix", user_id)
+            if fix_data is not None:
+                await self.process_code_task(
+                    update, context, update.message.text, fix_data.get('task_type', 'fix'), revision=fix_data
+                )
+                return
+        
         repo = context.user_data.get('repo')
         
         if not repo:
@@ -676,13 +4027,18 @@ Ready to manage code from your phone? Let's go!
         # Treat regular messages as feature/change requests by default
         await self.process_code_task(update, context, description, task_type="change")
     
-    async def process_code_task(self, update: Update, context: ContextTypes.DEFAULT_TYPE, description: str, task_type: str = "fix"):
-        """Main code processing workflow for all task types"""
+    async def process_code_task(self, update: Update, context: ContextTypes.DEFAULT_TYPE, description: str, task_type: str = "fix",
+                                bypass_cache: bool = False, revision: dict = None):
+        """Main code processing workflow for all task types.
+        
+        With `revision` (the stored task session), `description` is the
+        user's feedback on that proposal and its code context is reused.
+        """
         user_id = update.effective_user.id
         repo_name = context.user_data.get('repo')
         
         if not repo_name:
-            await update.message.reply_text("Please set a repository first with /setrepo")
+            await update.effective_message.reply_text("Please set a repository first with /setrepo")
             return
         
         # Task type emojis and messages
@@ -693,52 +4049,92 @@ Ready to manage code from your phone? Let's go!
             "create": {"emoji": "📝", "action": "Creating"}
         }
         config = task_config.get(task_type, task_config["fix"])
+        if revision:
+            config = dict(config, action="Revising")
+            repo_name = revision['repo_name']
         
-        # Send initial message
-        status_message = await update.message.reply_text(
+        header = (
             f"{config['emoji']} **{config['action']}...**\n"
             f"Repository: {repo_name}\n"
-            f"Request: {description}",
-            parse_mode='Markdown'
+            f"Request: {description}"
         )
         
+        # Send initial message
+        status_message = await update.effective_message.reply_text(header, parse_mode='Markdown')
+        
+        async def show_position(position: int):
+            await self.messages.edit(
+                status_message, f"{header}\n\n⏳ Queued, position {position}", parse_mode='Markdown'
+            )
+        
+        async def show_cancelled():
+            await self.messages.edit(status_message, "❌ Task cancelled.", wait=True)
+        
         try:
-            # Step 1: Analyze the request with animated loader
-            github_client = Github(context.user_data['github_token'])
-            repo = github_client.get_repo(repo_name)
-            
-            # Animated fetching
-            for i in range(5):
-                await status_message.edit_text(
-                    f"{config['emoji']} **{config['action']}...**\n"
-                    f"Repository: {repo_name}\n"
-                    f"Request: {description}\n\n"
-                    f"{self.get_loader_text(i, 'Fetching repository code...')}",
-                    parse_mode='Markdown'
-                )
-                await asyncio.sleep(0.3)
+            self.tasks.submit(
+                user_id,
+                lambda: self.run_code_task(
+                    context, user_id, repo_name, description, task_type, config, status_message, header,
+                    bypass_cache, revision
+                ),
+                on_position=show_position,
+                on_cancel=show_cancelled
+            )
+        except asyncio.QueueFull:
+            await self.messages.edit(
+                status_message,
+                "⚠️ Too many tasks are waiting right now. Please try again once your earlier requests finish.",
+                wait=True
+            )
+    
+    async def run_code_task(self, context: ContextTypes.DEFAULT_TYPE, user_id: int, repo_name: str, description: str,
+                            task_type: str, config: dict, status_message, header: str, bypass_cache: bool = False,
+                            revision: dict = None):
+        """Fetch code, ask the AI and present the solution; runs on a TaskScheduler slot"""
+        progress = ProgressReporter(
+            lambda text: self.messages.edit(status_message, text, parse_mode='Markdown'),
+            header,
+            loader=self.get_loader_text
+        ).start()
+        started = time.perf_counter()
+        outcome = "error"
+        
+        try:
+            # Step 1: Fetch the repository and relevant code
+            if revision:
+                # Same code as the proposal being revised, so the prompt prefix is unchanged
+                code_context = revision['code_context']
+                repo_summary = revision['repo_summary']
+            else:
+                progress.update("Fetching repository code...")
+                with self.metrics.timer("stage_seconds", stage="repo_fetch"):
+                    repo = await self.github.get_repo(context.user_data['github_token'], repo_name)
+                
+                # Get recent files and code context
+                with self.metrics.timer("stage_seconds", stage="context_build"):
+                    code_context = await self.get_code_context(
+                        repo, description, progress, token_budget=self.context_budget(context.user_data)
+                    )
+                    repo_summary = self.repo_summary(repo, await self.get_tree_index(repo))
             
-            # Get recent files and code context
-            code_context = await self.get_code_context(repo, description)
+            # Step 2: Ask AI to analyze and propose solution, streaming its summary
+            progress.update("AI is analyzing your request...")
             
-            # Step 2: Ask AI to analyze and propose solution with animated loader
-            for i in range(8):
-                await status_message.edit_text(
-                    f"{config['emoji']} **{config['action']}...**\n"
-                    f"Repository: {repo_name}\n"
-                    f"Request: {description}\n\n"
-                    f"{self.get_loader_text(i, 'AI is analyzing your request...')}",
-                    parse_mode='Markdown'
-                )
-                await asyncio.sleep(0.2)
+            async def show_progress(summary: str, chunks: int):
+                progress.update(detail=self.escape_markdown(summary[-800:]), tokens_received=chunks)
             
             solution = await self.analyze_code_task(
                 description, 
                 code_context,
                 repo_name,
                 task_type,
-                context.user_data
+                context.user_data,
+                on_progress=show_progress,
+                bypass_cache=bypass_cache,
+                repo_summary=repo_summary,
+                revision=revision
             )
+            await progress.stop()
             
             # Step 3: Present the fix to the user
             keyboard = [
@@ -747,19 +4143,33 @@ Ready to manage code from your phone? Let's go!
                     InlineKeyboardButton("🔄 Revise", callback_data=f"revise_{user_id}")
                 ],
                 [
+                    InlineKeyboardButton("🔁 Retry", callback_data=f"retry_{user_id}"),
                     InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_{user_id}")
                 ]
             ]
+            warning = ""
+            if solution.get('truncated'):
+                # Part of the changes never arrived; applying would commit a partial fix
+                keyboard[0] = keyboard[0][1:]
+                missing = [path for path in solution['files'] if path not in solution['changes']]
+                warning = (
+                    "⚠️ **The AI response was cut off, so this proposal is incomplete"
+                    + (f" (no changes for {', '.join(missing)})" if missing else "")
+                    + ".** Retry or revise it before applying.\n\n"
+                )
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            # Store the solution
-            self.active_fixes[user_id] = {
+            # Store the solution, with the context a revision will reuse
+            await self.sessions.set("fix", user_id, {
                 'repo_name': repo_name,
-                'description': description,
+                'description': revision['description'] if revision else description,
+                'revisions': revision.get('revisions', []) + [description] if revision else [],
                 'task_type': task_type,
                 'solution': solution,
+                'code_context': code_context,
+                'repo_summary': repo_summary,
                 'status_message_id': status_message.message_id
-            }
+            })
             
             task_labels = {
                 "fix": "Bug Fix",
@@ -769,70 +4179,140 @@ Ready to manage code from your phone? Let's go!
             }
             label = task_labels.get(task_type, "Task")
             
-            await status_message.edit_text(
+            await self.messages.edit(
+                status_message,
                 f"{config['emoji']} **{label} Complete**\n\n"
                 f"**Request:** {description}\n\n"
                 f"**Proposed Solution:**\n{solution['summary']}\n\n"
                 f"**Files to modify:**\n{', '.join(solution['files'])}\n\n"
                 f"**Changes:**\n```\n{solution['diff_preview'][:500]}...\n```\n\n"
-                "What would you like to do?",
+                f"{warning}What would you like to do?",
+                wait=True,
                 parse_mode='Markdown',
                 reply_markup=reply_markup
             )
+            outcome = "ok"
             
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            await progress.stop()
+            raise
         except Exception as e:
             logger.error(f"Error processing code task: {str(e)}")
-            await status_message.edit_text(
+            await progress.stop()
+            await self.messages.edit(
+                status_message,
                 f"❌ **Error occurred:**\n{str(e)}\n\n"
                 "Please try again or contact support.",
+                wait=True,
                 parse_mode='Markdown'
             )
+        finally:
+            self.metrics.observe("task_seconds", time.perf_counter() - started, task=task_type, outcome=outcome)
     
-    async def get_code_context(self, repo, bug_description: str) -> str:
+    def context_budget(self, user_context: Dict) -> int:
+        """Prompt context budget in tokens for the user's AI provider"""
+        provider = user_context.get('ai_provider', 'groq')
+        default = CONTEXT_TOKEN_BUDGETS.get(provider, CONTEXT_TOKEN_BUDGETS['groq'])
+        return int(os.getenv(f"REPOFIY_CONTEXT_TOKENS_{provider.upper()}", default))
+    
+    def repo_summary(self, repo, index: RepoTreeIndex) -> str:
+        """Short, deterministic description of the repository for the prompt prefix"""
+        files = index.files()
+        extensions = Counter(os.path.splitext(e.name)[1] or e.name for e in files)
+        top_level = sorted(
+            e.name + ('/' if e.type == 'tree' else '')
+            for e in index.children() if not index.is_ignored(e.path)
+        )
+        return (
+            f"Repository: {repo.full_name}\n"
+            f"Default branch: {repo.default_branch}\n"
+            f"Files: {len(files)} ({', '.join(f'{ext} {count}' for ext, count in extensions.most_common(8))})\n"
+            f"Top level: {', '.join(top_level[:40])}"
+        )
+    
+    async def get_code_context(self, repo, bug_description: str, progress: ProgressReporter = None,
+                               token_budget: int = CONTEXT_TOKEN_BUDGETS['groq']) -> str:
         """Fetch relevant code context from repository"""
         try:
-            # Get repository structure
-            contents = repo.get_contents("")
+            # Whole file list in a single tree request
+            index = await self.get_tree_index(repo)
+            code_files = index.files(CODE_EXTENSIONS)
             
-            # Build a context of relevant files
-            code_files = []
-            relevant_files = []
+            lexical = self.get_lexical_index(repo.full_name)
+            lexical.sync(code_files)
             
-            def scan_directory(contents):
-                for content in contents:
-                    if content.type == "dir":
-                        scan_directory(repo.get_contents(content.path))
-                    elif content.name.endswith(('.py', '.js', '.ts', '.java', '.go', '.rb')):
-                        code_files.append(content)
+            # Fold in anything already downloaded, it's free
+            indexed = 0
+            for entry in code_files:
+                if not lexical.has_content(entry.path):
+                    data = self.github.blob_cache.peek(repo.full_name, entry.sha)
+                    if data is not None:
+                        self._index_blob(lexical, entry, data)
+                indexed += lexical.has_content(entry.path)
+            
+            # Download the best candidates, index their content and rank again
+            candidates = [index.get(path) for path, _ in lexical.search(bug_description, limit=12)]
+            chosen = {entry.path for entry in candidates}
+            if len(candidates) < 5:
+                # Too few matches to go on (e.g. a cold index and no path in common with
+                # the request): read some small, shallow files now so the model sees code
+                fallback = heapq.nsmallest(
+                    5 - len(candidates),
+                    (e for e in code_files if e.path not in chosen),
+                    key=lambda e: (lexical.has_content(e.path), e.depth, e.size)
+                )
+                candidates += fallback
+                chosen.update(entry.path for entry in fallback)
+            if len(candidates) < 12 and indexed < 200:
+                # Warm the index for later requests with a few more unread files;
+                # in the background, so this request doesn't wait for them
+                unread = heapq.nsmallest(
+                    12 - len(candidates),
+                    (e for e in code_files if not lexical.has_content(e.path) and e.path not in chosen),
+                    key=lambda e: (e.depth, e.size)
+                )
+                self.github.prefetch(repo, unread)
             
-            scan_directory(contents)
+            fetched = 0
+            contents: Dict[str, str] = {}
             
-            # Use simple heuristics to find relevant files
-            # In production, you'd use more sophisticated methods
-            keywords = bug_description.lower().split()
+            async def fetch(file):
+                nonlocal fetched
+                data = await self.github.read_blob(repo, file)
+                fetched += 1
+                if progress:
+                    progress.update(files_fetched=f"{fetched}/{len(candidates)}")
+                return data
             
-            for file in code_files[:20]:  # Limit to first 20 files
-                file_path_lower = file.path.lower()
-                if any(keyword in file_path_lower for keyword in keywords):
-                    relevant_files.append(file)
+            blobs = await asyncio.gather(*(fetch(file) for file in candidates), return_exceptions=True)
+            for file, blob in zip(candidates, blobs):
+                if isinstance(blob, Exception):
+                    logger.warning(f"Could not fetch {file.path}: {str(blob)}")
+                    continue
+                text = self._index_blob(lexical, file, blob)
+                if text is not None:
+                    contents[file.path] = text
             
-            # If no matches, just take the first few files
-            if not relevant_files:
-                relevant_files = code_files[:5]
+            ranked = [(path, score) for path, score in lexical.search(bug_description, limit=50) if path in contents]
+            if ranked:
+                # Leave out files that only scored a fraction of the best one
+                best = ranked[0][1]
+                relevant_files = [path for path, score in ranked if score >= best * 0.3]
+            else:
+                relevant_files = list(contents)
             
             # Build context
             context = f"Repository: {repo.full_name}\n"
             context += f"Default Branch: {repo.default_branch}\n\n"
             context += "Relevant Files:\n"
             
-            for file in relevant_files[:5]:  # Limit context size
-                try:
-                    content = file.decoded_content.decode('utf-8')
-                    context += f"\n--- {file.path} ---\n"
-                    context += content[:2000]  # Limit file size
-                    context += "\n...\n"
-                except:
-                    continue
+            packer = ContextPacker(token_budget - estimate_tokens(context))
+            context += packer.pack(
+                [(path, contents[path], self.chunker.chunks(path, index.get(path).sha, contents[path])) for path in relevant_files],
+                bug_description
+            )
+            logger.info(f"Packed {packer.used}/{packer.budget} context tokens for {repo.full_name}")
             
             return context
             
@@ -840,27 +4320,127 @@ Ready to manage code from your phone? Let's go!
             logger.error(f"Error getting code context: {str(e)}")
             return f"Repository: {repo.full_name}\nError fetching code context: {str(e)}"
     
-    async def call_ai(self, prompt: str, user_context: Dict) -> str:
-        """Call the appropriate AI provider"""
+    def _index_blob(self, lexical: LexicalIndex, entry: TreeEntry, data: bytes) -> Optional[str]:
+        """Decode a source blob, chunk it and add it to the lexical index"""
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        chunks = self.chunker.chunks(entry.path, entry.sha, text)
+        lexical.add_content(entry.path, entry.sha, text, [chunk.name for chunk in chunks if chunk.name])
+        return text
+    
+    def build_prompt(self, description: str, code_context: str, repo_summary: str, task_type: str,
+                     revision: dict = None) -> PromptParts:
+        """Stable system/repo/code blocks followed by this request"""
+        task_prompts = {
+            "fix": "You are analyzing a BUG REPORT and need to propose a FIX.",
+            "feature": "You are analyzing a FEATURE REQUEST and need to implement it.",
+            "change": "You are analyzing a CODE CHANGE REQUEST and need to implement the changes.",
+            "create": "You are analyzing a REQUEST TO CREATE new code/file and need to implement it."
+        }
+        task_instruction = task_prompts.get(task_type, task_prompts["fix"])
+        
+        if revision:
+            previous = revision['solution']
+            earlier = "".join(f"\nEarlier feedback: {feedback}" for feedback in revision.get('revisions', []))
+            request = (
+                f"{task_instruction}\n\n"
+                f"Request: {revision['description']}\n\n"
+                f"Your previous proposal:\n"
+                f"{json.dumps({key: previous.get(key) for key in ('summary', 'files', 'changes')}, indent=2)}\n"
+                f"{earlier}\n"
+                f"Revise it as follows: {description}\n"
+                f"Return the complete updated proposal in the same JSON format."
+            )
+        else:
+            request = f"{task_instruction}\n\nRequest: {description}"
+        if revision and revision.get('conflicts'):
+            request += "\nThese edits did not match the current files: " + "; ".join(revision['conflicts'])
+        return PromptParts(self.system_prompt, repo_summary, code_context, request)
+    
+    def route_model(self, user_context: Dict, task: Optional[str], prompt_tokens: int) -> str:
+        """Model of the user's provider for this request, within their /route policy"""
+        provider = user_context.get('ai_provider', 'groq')
+        if provider not in MODEL_TIERS:
+            provider = "groq"
+        return self.router.choose(
+            provider, task, prompt_tokens,
+            policy=user_context.get('route_policy', 'auto'),
+            max_cost=user_context.get('route_max_cost'),
+        )
+    
+    async def call_ai(self, prompt: PromptParts, user_context: Dict, on_token=None, model: str = None) -> str:
+        """Call the appropriate AI provider.
+        
+        If `on_token` is given the response is streamed: it is awaited with
+        every text chunk and may return True to stop the stream early.
+        `model` defaults to the provider's strong model.
+        """
         provider = user_context.get('ai_provider', 'groq')
+        if provider not in DEFAULT_MODELS:
+            provider = "groq"
         api_key = user_context.get('ai_key')
+        prompt_tokens = estimate_tokens(prompt.text())
         
-        if provider == "openrouter":
-            return await self.call_openrouter(prompt, api_key)
-        elif provider == "anthropic":
-            return await self.call_anthropic(prompt, api_key)
-        else:  # default to groq
-            return await self.call_groq(prompt, api_key)
+        primary = (provider, model or DEFAULT_MODELS[provider])
+        keys = {primary: api_key}
+        backup = self.hedge_target(provider, api_key, primary[1])
+        if backup:
+            keys[backup[:2]] = backup[2]
+            backup = backup[:2]
+        
+        async def call(target, on_chunk):
+            name, model = target
+            started = time.monotonic()
+            try:
+                if name == "openrouter":
+                    text = await self.call_openrouter(prompt, keys[target], on_chunk, model)
+                elif name == "anthropic":
+                    text = await self.call_anthropic(prompt, keys[target], on_chunk, model)
+                else:
+                    text = await self.call_groq(prompt, keys[target], on_chunk, model)
+            except Exception:
+                self.router.record(target, time.monotonic() - started, ok=False)
+                self.metrics.inc("llm_requests", provider=name, model=model, outcome="error")
+                raise
+            completion_tokens = estimate_tokens(text)
+            self.router.record(target, time.monotonic() - started, True, prompt_tokens, completion_tokens)
+            self.metrics.inc("llm_requests", provider=name, model=model, outcome="ok")
+            self.metrics.inc("llm_tokens", prompt_tokens, provider=name, model=model, direction="in")
+            self.metrics.inc("llm_tokens", completion_tokens, provider=name, model=model, direction="out")
+            return text
+        
+        async with self.llm_slots:
+            return await self.resilience.hedged(primary, backup, call, on_token)
+    
+    def hedge_target(self, provider: str, api_key: str, model: str) -> Optional[tuple]:
+        """(provider, model, api_key) for hedged backup requests, from REPOFIY_HEDGE_TARGET"""
+        setting = os.getenv('REPOFIY_HEDGE_TARGET', '')
+        if not setting:
+            return None
+        backup_provider, _, backup_model = setting.partition(':')
+        backup_model = backup_model or DEFAULT_MODELS.get(backup_provider)
+        if backup_provider == provider:
+            key = api_key
+        elif backup_provider == "groq" and self.groq_key:
+            # The bot's own Groq key can back up any provider
+            key = self.groq_key
+        else:
+            return None
+        if backup_provider not in DEFAULT_MODELS or (backup_provider, backup_model) == (provider, model):
+            return None
+        return backup_provider, backup_model, key
     
-    async def call_groq(self, prompt: str, api_key: str = None) -> str:
+    async def call_groq(self, prompt: PromptParts, api_key: str = None, on_token=None, model: str = None) -> str:
         """Call Groq API"""
         if api_key is None:
             api_key = self.groq_key
         
         payload = {
-            "model": "llama-3.3-70b-versatile",
+            "model": model or DEFAULT_MODELS["groq"],
             "max_tokens": 4000,
-            "messages": [{"role": "user", "content": prompt}]
+            "messages": prompt.chat_messages()
         }
         
         headers = {
@@ -868,33 +4448,50 @@ Ready to manage code from your phone? Let's go!
             "Content-Type": "application/json"
         }
         
-        response = requests.post(
-            "https://api.groq.com/openai/v1/chat/completions",
-            json=payload,
-            headers=headers,
-            timeout=30
-        )
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
+        if on_token:
+            return await self._stream_sse("groq", api_key, self.groq_url, payload, headers, on_token)
+        
+        data = await self._post_json("groq", api_key, self.groq_url, payload, headers)
+        return data['choices'][0]['message']['content']
     
-    async def call_anthropic(self, prompt: str, api_key: str) -> str:
-        """Call Anthropic Claude API"""
-        from anthropic import Anthropic
-        
-        client = Anthropic(api_key=api_key)
-        response = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=4000,
-            messages=[{"role": "user", "content": prompt}]
-        )
-        return response.content[0].text
+    async def call_anthropic(self, prompt: PromptParts, api_key: str, on_token=None, model: str = None) -> str:
+        """Call Anthropic Claude API, caching the system prompt and code context"""
+        request = {
+            "model": model or DEFAULT_MODELS["anthropic"],
+            "max_tokens": 4000,
+            **prompt.anthropic_request()
+        }
+        
+        async with self.ai_clients.acquire("anthropic", api_key) as client:
+            if not on_token:
+                response = await client.messages.create(**request)
+                self._record_prompt_cache(response.usage)
+                return response.content[0].text
+            
+            text = ""
+            async with client.messages.stream(**request) as stream:
+                async for chunk in stream.text_stream:
+                    text += chunk
+                    if await on_token(chunk):
+                        break
+                else:
+                    self._record_prompt_cache((await stream.get_final_message()).usage)
+            return text
+    
+    def _record_prompt_cache(self, usage):
+        cached = getattr(usage, 'cache_read_input_tokens', None) or 0
+        written = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        self.cached_prompt_tokens += cached
+        if cached or written:
+            logger.info(f"Anthropic prompt cache: {cached} tokens read, {written} written")
     
-    async def call_openrouter(self, prompt: str, api_key: str) -> str:
+    async def call_openrouter(self, prompt: PromptParts, api_key: str, on_token=None, model: str = None) -> str:
         """Call OpenRouter API"""
+        url = self.openrouter_url
         payload = {
-            "model": "meta-llama/llama-3.1-70b-instruct",  # Default model
+            "model": model or DEFAULT_MODELS["openrouter"],
             "max_tokens": 4000,
-            "messages": [{"role": "user", "content": prompt}]
+            "messages": prompt.chat_messages()
         }
         
         headers = {
@@ -903,73 +4500,117 @@ Ready to manage code from your phone? Let's go!
             "Content-Type": "application/json"
         }
         
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            json=payload,
-            headers=headers,
-            timeout=30
-        )
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
-    
-    async def analyze_code_task(self, description: str, code_context: str, repo_name: str, task_type: str, user_context: Dict = None) -> dict:
-        """Use AI to analyze code task and propose solution"""
-        
-        task_prompts = {
-            "fix": f"You are analyzing a BUG REPORT and need to propose a FIX.",
-            "feature": f"You are analyzing a FEATURE REQUEST and need to implement it.",
-            "change": f"You are analyzing a CODE CHANGE REQUEST and need to implement the changes.",
-            "create": f"You are analyzing a REQUEST TO CREATE new code/file and need to implement it."
-        }
+        if on_token:
+            return await self._stream_sse("openrouter", api_key, url, payload, headers, on_token)
         
-        task_instruction = task_prompts.get(task_type, task_prompts["fix"])
+        data = await self._post_json("openrouter", api_key, url, payload, headers)
+        return data['choices'][0]['message']['content']
+    
+    async def _post_json(self, provider: str, api_key: str, url: str, payload: dict, headers: dict) -> dict:
+        """POST a JSON payload over the provider's pooled session"""
+        # The overall deadline is enforced by ProviderResilience
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10)
+        async with self.ai_clients.acquire(provider, api_key) as session:
+            async with session.post(url, json=payload, headers=headers, timeout=timeout) as response:
+                if response.status >= 400:
+                    logger.error(f"AI provider error {response.status}: {await response.text()}")
+                response.raise_for_status()
+                return await response.json()
+    
+    async def _stream_sse(self, provider: str, api_key: str, url: str, payload: dict, headers: dict, on_token) -> str:
+        """Stream an OpenAI-compatible chat completion (server-sent events)"""
+        # No total deadline for streams, only for gaps between chunks
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+        text = ""
+        async with self.ai_clients.acquire(provider, api_key) as session:
+            async with session.post(url, json={**payload, "stream": True}, headers=headers, timeout=timeout) as response:
+                if response.status >= 400:
+                    logger.error(f"AI provider error {response.status}: {await response.text()}")
+                response.raise_for_status()
+                
+                # Some gateways ignore "stream" and answer with a plain completion
+                if response.content_type == 'application/json':
+                    text = (await response.json())['choices'][0]['message']['content']
+                    await on_token(text)
+                    return text
+                
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8').strip()
+                    # Skip keep-alive comments and blank separators
+                    if not line.startswith('data:'):
+                        continue
+                    data = line[5:].strip()
+                    if data == '[DONE]':
+                        break
+                    
+                    choices = json.loads(data).get('choices') or [{}]
+                    chunk = (choices[0].get('delta') or {}).get('content') or ""
+                    if not chunk:
+                        continue
+                    text += chunk
+                    if await on_token(chunk):
+                        break
+        return text
+    
+    async def analyze_code_task(self, description: str, code_context: str, repo_name: str, task_type: str,
+                                user_context: Dict = None, on_progress=None, bypass_cache: bool = False,
+                                repo_summary: str = None, revision: dict = None) -> dict:
+        """Use AI to analyze code task and propose solution.
         
-        prompt = f"""You are an expert software engineer. {task_instruction}
-
-Repository: {repo_name}
-Request: {description}
-
-Code Context:
-{code_context}
-
-Please analyze this request and provide:
-1. A summary of what's likely causing the bug
-2. The specific files that need to be modified
-3. The exact code changes needed (in unified diff format)
-4. Any tests that should be run
-
-Respond in JSON format:
-{{
-    "summary": "Brief explanation of the fix",
-    "cause": "Root cause analysis",
-    "files": ["list", "of", "files"],
-    "changes": {{
-        "filename": "code changes for this file"
-    }},
-    "diff_preview": "Brief preview of the main changes",
-    "tests_to_run": ["list of test commands"],
-    "confidence": "high/medium/low"
-}}
-"""
+        With `on_progress`, the response is streamed and the callback is
+        awaited with the summary streamed so far and the number of chunks.
+        Identical requests against identical code are answered from the
+        response cache unless `bypass_cache` is set. With `revision`, the
+        previous proposal is revised according to `description`.
+        """
+        user_context = user_context or {}
+        provider = user_context.get('ai_provider', 'groq')
+        repo_summary = repo_summary or f"Repository: {repo_name}"
+        prompt = self.build_prompt(description, code_context, repo_summary, task_type, revision)
+        # Size the request by its code and text; the system prompt is the same for every request
+        model = self.route_model(
+            user_context, "revise" if revision else task_type, estimate_tokens(code_context) + estimate_tokens(description)
+        )
+        cache_key = ResponseCache.make_key(provider, model, task_type, prompt.request, prompt.prefix, prompt.system)
+        if not bypass_cache:
+            cached = await self.responses.get(cache_key)
+            if cached is not None:
+                logger.info(f"Response cache hit for {repo_name}")
+                return cached
         
         try:
-            response_text = await self.call_ai(prompt, user_context or {})
-            
-            # Extract JSON from response (Claude might wrap it in markdown)
-            if "```json" in response_text:
-                json_start = response_text.find("```json") + 7
-                json_end = response_text.find("```", json_start)
-                response_text = response_text[json_start:json_end].strip()
-            elif "```" in response_text:
-                json_start = response_text.find("```") + 3
-                json_end = response_text.find("```", json_start)
-                response_text = response_text[json_start:json_end].strip()
+            if on_progress:
+                tracker = StreamingJSONTracker()
+                chunks = 0
+                
+                async def on_token(chunk: str) -> bool:
+                    nonlocal chunks
+                    chunks += 1
+                    done = tracker.feed(chunk)
+                    await on_progress(tracker.partial_summary(), chunks)
+                    # Stop streaming as soon as the JSON object is closed
+                    return done
+                
+                with self.metrics.timer("stage_seconds", stage="llm_call"):
+                    response_text = await self.call_ai(prompt, user_context, on_token, model=model)
+                if tracker.complete:
+                    response_text = tracker.document
+            else:
+                with self.metrics.timer("stage_seconds", stage="llm_call"):
+                    response_text = await self.call_ai(prompt, user_context, model=model)
             
-            fix_data = json.loads(response_text)
-            return fix_data
+            with self.metrics.timer("stage_seconds", stage="json_parse"):
+                fix_data, problems = self.parser.parse(response_text)
+            if fix_data is None:
+                logger.warning(f"Unusable AI response ({'; '.join(problems)}), asking for a repair")
+                with self.metrics.timer("stage_seconds", stage="response_repair"):
+                    fix_data, problems = await self.repair_response(response_text, problems, user_context)
+            if fix_data is not None:
+                if not fix_data.get('truncated'):
+                    await self.responses.put(cache_key, fix_data)
+                return fix_data
             
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing Groq response: {str(e)}")
+            logger.error(f"Error parsing AI response: {'; '.join(problems)}")
             # Return a fallback response
             return {
                 "summary": response_text[:200],
@@ -980,13 +4621,35 @@ Respond in JSON format:
                 "tests_to_run": [],
                 "confidence": "low"
             }
-        except requests.exceptions.HTTPError as e:
-            logger.error(f"Groq API error: {e.response.text}")
+        except aiohttp.ClientResponseError as e:
+            logger.error("%s API error: %s %s", provider, e.status, e.message)
             raise
         except Exception as e:
-            logger.error(f"Error calling Groq API: {str(e)}")
+            logger.error("Error calling %s API: %s", provider, e)
             raise
     
+    async def repair_response(self, response_text: str, problems: List[str], user_context: Dict):
+        """Have a fast model fix the syntax of an unusable response; (solution or None, problems)"""
+        fields = ", ".join(
+            f'"{field}" ({kind.__name__})' for field, kind in {**ResponseParser.REQUIRED, **ResponseParser.OPTIONAL}.items()
+        )
+        prompt = PromptParts(
+            "You repair malformed JSON. Reply with the corrected JSON object only.",
+            "", "",
+            f"This response could not be used: {'; '.join(problems)}.\n"
+            f"Fields: {fields}. \"changes\" maps file paths to their edits.\n"
+            f"Fix only the structure and syntax and keep every value's content unchanged.\n\n"
+            f"{response_text}"
+        )
+        model = self.route_model(user_context, "repair", estimate_tokens(response_text))
+        try:
+            repaired = await self.call_ai(prompt, user_context, model=model)
+        except Exception as e:
+            logger.warning(f"Response repair failed: {str(e)}")
+            return None, problems
+        self.repairs += 1
+        return self.parser.parse(repaired)
+    
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle button callbacks"""
         query = update.callback_query
@@ -1012,10 +4675,11 @@ Respond in JSON format:
             provider = callback_data.replace("ai_", "")
             context.user_data['ai_provider'] = provider
             
-            await query.edit_message_text(
+            await self.messages.edit(
+                query.message,
                 f"AI provider set to **{provider.upper()}**\n\n"
                 f"Now send your {provider.upper()} API key:",
-                parse_mode='Markdown'
+                wait=True, parse_mode='Markdown'
             )
             context.user_data['waiting_for_ai_key'] = True
             return
@@ -1027,100 +4691,117 @@ Respond in JSON format:
         action, user_id = callback_data.split('_')
         user_id = int(user_id)
         
-        if user_id not in self.active_fixes:
-            await query.edit_message_text("This task session has expired. Please start a new one.")
+        fix_data = await self.sessions.get("fix", user_id)
+        if fix_data is None:
+            await self.messages.edit(
+                query.message, "This task session has expired. Please start a new one.", wait=True
+            )
             return
         
         if action == "apply":
-            await self.apply_fix(query, context, user_id)
+            if fix_data['solution'].get('truncated'):
+                await self.messages.edit(
+                    query.message,
+                    "⚠️ This proposal is incomplete and can't be applied. Retry or revise it first.",
+                    wait=True,
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton("🔄 Revise", callback_data=f"revise_{user_id}"),
+                        InlineKeyboardButton("🔁 Retry", callback_data=f"retry_{user_id}"),
+                        InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_{user_id}")
+                    ]])
+                )
+                return
+            await self.apply_fix(query, context, user_id, fix_data)
         elif action == "revise":
-            await query.edit_message_text(
-                "Please describe what you'd like to change about the fix:",
-                parse_mode='Markdown'
+            # The next text message is feedback on this proposal
+            context.user_data['revising'] = True
+            await self.messages.edit(
+                query.message, "Please describe what you'd like to change about the fix:", wait=True
+            )
+        elif action == "retry":
+            # Explicit retry: ask the AI again instead of reusing the cached answer
+            # Keep the old proposal readable but drop its buttons; as a text edit
+            # it goes through the scheduler, ordered after any pending update
+            await self.messages.edit(
+                query.message, query.message.text_markdown_v2, wait=True, parse_mode='MarkdownV2', reply_markup=None
+            )
+            await self.process_code_task(
+                update, context, fix_data['description'], fix_data.get('task_type', 'fix'), bypass_cache=True
             )
         elif action == "cancel":
-            del self.active_fixes[user_id]
-            await query.edit_message_text("❌ Fix cancelled.")
+            await self.sessions.delete("fix", user_id)
+            await self.messages.edit(query.message, "❌ Fix cancelled.", wait=True)
     
-    async def apply_fix(self, query, context, user_id: int):
+    async def apply_fix(self, query, context, user_id: int, fix_data: dict):
         """Apply the proposed solution to the repository"""
-        fix_data = self.active_fixes[user_id]
         repo_name = fix_data['repo_name']
         solution = fix_data['solution']
         task_type = fix_data.get('task_type', 'fix')
         
-        # Animated applying status
-        for i in range(3):
-            await query.edit_message_text(
-                f"{self.get_loader_text(i, '🔧 Applying fix...')}\n"
-                "Creating branch and committing changes...",
-                parse_mode='Markdown'
-            )
-            await asyncio.sleep(0.3)
+        status_message = query.message
+        await self.messages.edit(status_message, "🔧 **Applying fix...**", parse_mode='Markdown')
+        progress = ProgressReporter(
+            lambda text: self.messages.edit(status_message, text, parse_mode='Markdown'),
+            "🔧 **Applying fix...**",
+            loader=self.get_loader_text
+        ).start()
+        started = time.perf_counter()
+        outcome = "error"
         
         try:
-            # Get user's GitHub client
-            github_client = Github(context.user_data['github_token'])
-            repo = github_client.get_repo(repo_name)
+            progress.update("Preparing commit...")
+            with self.metrics.timer("stage_seconds", stage="repo_fetch"):
+                repo = await self.github.get_repo(context.user_data['github_token'], repo_name)
+                base_branch = await self.github.run(repo.get_branch, repo.default_branch)
             
-            # Create a new branch
-            base_branch = repo.get_branch(repo.default_branch)
             task_prefix = {"fix": "bugfix", "feature": "feature", "change": "refactor", "create": "feat"}
             prefix = task_prefix.get(task_type, "update")
             branch_name = f"{prefix}/ai-{user_id}-{int(asyncio.get_event_loop().time())}"
             
-            repo.create_git_ref(
-                ref=f"refs/heads/{branch_name}",
-                sha=base_branch.commit.sha
-            )
+            # Apply the proposed edits to the current files
+            progress.update("Applying edits...")
+            with self.metrics.timer("stage_seconds", stage="patch"):
+                # Edits must apply to the commit we build on, not a cached head that may lag behind it
+                index = await self.github.tree_at(repo, base_branch.commit.sha)
+                changes, conflicts = await self.resolve_changes(repo, index, solution.get('changes', {}))
+            if conflicts:
+                outcome = "conflict"
+                await progress.stop()
+                fix_data['conflicts'] = conflicts
+                await self.sessions.set("fix", user_id, fix_data)
+                await self.messages.edit(
+                    status_message,
+                    "⚠️ **The changes did not apply cleanly**\n\n"
+                    + "\n".join(f"• `{conflict}`" for conflict in conflicts[:10])
+                    + "\n\nNothing was committed. Use Revise to get an updated proposal.",
+                    wait=True,
+                    parse_mode='Markdown',
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton("🔄 Revise", callback_data=f"revise_{user_id}"),
+                        InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_{user_id}")
+                    ]])
+                )
+                return
             
-            # Apply changes to files
-            files_updated = 0
-            total_files = len(solution.get('changes', {}))
-            
-            for idx, (filename, changes) in enumerate(solution.get('changes', {}).items()):
-                # Show progress with loader
-                for i in range(2):
-                    await query.edit_message_text(
-                        f"{self.get_loader_text(i, '🔧 Applying fix...')}\n"
-                        f"Writing files: {idx + 1}/{total_files} - {filename}",
-                        parse_mode='Markdown'
-                    )
-                    await asyncio.sleep(0.2)
-                
-                try:
-                    try:
-                        # Try to get existing file
-                        file = repo.get_contents(filename, ref=branch_name)
-                        # Update existing file
-                        repo.update_file(
-                            path=filename,
-                            message=f"chore: {fix_data['description'][:50]}",
-                            content=changes,
-                            sha=file.sha,
-                            branch=branch_name
-                        )
-                    except Exception:
-                        # File doesn't exist, create it
-                        repo.create_file(
-                            path=filename,
-                            message=f"feat: {fix_data['description'][:50]}",
-                            content=changes,
-                            branch=branch_name
-                        )
-                    files_updated += 1
-                    logger.info(f"Successfully processed {filename}")
-                except Exception as e:
-                    logger.warning(f"Could not process {filename}: {str(e)}")
-            
-            # Show PR creation loader
-            for i in range(3):
-                await query.edit_message_text(
-                    f"{self.get_loader_text(i, '🔧 Applying fix...')}\n"
-                    "Creating pull request...",
-                    parse_mode='Markdown'
+            # Keep executable bits of files we overwrite
+            modes = {path: entry.mode for path in changes if (entry := index.get(path))}
+            
+            # All files in a single commit on a new branch
+            commit_type = {"fix": "fix", "feature": "feat", "change": "refactor", "create": "feat"}
+            progress.update("Uploading changes...")
+            with self.metrics.timer("stage_seconds", stage="commit"):
+                await self.commits.commit(
+                    repo,
+                    base_branch,
+                    branch_name,
+                    changes,
+                    f"{commit_type.get(task_type, 'chore')}: {fix_data['description'][:50]}",
+                    modes=modes,
+                    progress=progress
                 )
-                await asyncio.sleep(0.3)
+            logger.info(f"Committed {len(solution.get('changes', {}))} files to {branch_name}")
+            
+            progress.update("Creating pull request...", detail="")
             
             # Create pull request
             task_labels = {
@@ -1131,9 +4812,11 @@ Respond in JSON format:
             }
             pr_title = f"{task_labels.get(task_type, '🤖 Auto-fix')}: {fix_data['description'][:50]}"
             
-            pr = repo.create_pull(
-                title=pr_title,
-                body=f"""## Automated {task_labels.get(task_type, 'Fix')}
+            with self.metrics.timer("stage_seconds", stage="pr_create"):
+                pr = await self.github.run(
+                    repo.create_pull,
+                    title=pr_title,
+                    body=f"""## Automated {task_labels.get(task_type, 'Fix')}
 
 **Description:** {fix_data['description']}
 
@@ -1146,9 +4829,11 @@ Respond in JSON format:
 ---
 *This PR was automatically generated by AI Code Assistant*
 """,
-                head=branch_name,
-                base=repo.default_branch
-            )
+                    head=branch_name,
+                    base=repo.default_branch
+                )
+            
+            await progress.stop()
             
             # Success message
             keyboard = [[InlineKeyboardButton("🔗 View PR", url=pr.html_url)]]
@@ -1162,37 +4847,83 @@ Respond in JSON format:
             }
             success_msg = task_success.get(task_type, "✅ Applied")
             
-            await query.edit_message_text(
+            await self.messages.edit(
+                status_message,
                 f"{success_msg} Successfully!\n\n"
                 f"**Branch:** {branch_name}\n"
                 f"**Pull Request:** #{pr.number}\n"
                 f"**Files Modified:** {len(solution.get('changes', {}))}\n\n"
                 f"Review the changes and merge when ready!",
+                wait=True,
                 parse_mode='Markdown',
                 reply_markup=reply_markup
             )
             
             # Clean up
-            del self.active_fixes[user_id]
+            await self.sessions.delete("fix", user_id)
+            outcome = "ok"
             
         except Exception as e:
             logger.error(f"Error applying fix: {str(e)}")
+            await progress.stop()
             error_msg = str(e).replace("_", "\\_").replace("*", "\\*").replace("[", "\\[").replace("]", "\\]")
-            await query.edit_message_text(
+            await self.messages.edit(
+                status_message,
                 f"❌ **Error applying fix:**\n`{error_msg}`\n\n"
                 "Please check your repository permissions and try again.",
+                wait=True,
                 parse_mode='Markdown'
             )
+        finally:
+            self.metrics.observe("task_seconds", time.perf_counter() - started, task="apply", outcome=outcome)
+    
+    async def resolve_changes(self, repo, index: RepoTreeIndex, proposed: Dict[str, Optional[str]]):
+        """New file contents for proposed edits, and the edits that did not apply"""
+        changes, conflicts = {}, []
+        for path, change in proposed.items():
+            if change is None:
+                changes[path] = None
+                continue
+            entry = index.get(path)
+            base = None
+            if entry is not None and self.patches.kind(change) != "content":
+                try:
+                    base = (await self.github.read_blob(repo, entry)).decode('utf-8')
+                except UnicodeDecodeError:
+                    # Patching a lossy decode would commit U+FFFD over the original bytes
+                    conflicts.append(f"{path}: not a UTF-8 text file, edits can't be applied to it")
+                    continue
+            result = await asyncio.to_thread(self.patches.apply, base, change)
+            conflicts.extend(f"{path}: {conflict}" for conflict in result.conflicts)
+            changes[path] = result.content
+            if result.applied:
+                logger.info(f"Patched {path}: {result.applied} edits")
+        return changes, conflicts
     
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Check status of active tasks"""
         user_id = update.effective_user.id
+        stats = (
+            f"Tasks: {self.tasks.running_count} running, {self.tasks.queued_count} queued\n"
+            f"Response cache: {self.responses.hits} hits, {self.responses.misses} misses"
+        )
+        if context.user_data.get('github_token'):
+            budget = self.github.budget(context.user_data['github_token'])
+            if budget:
+                reset = time.strftime('%H:%M UTC', time.gmtime(budget['reset']))
+                stats = f"GitHub API: {budget['remaining']}/{budget['limit']} requests left, resets {reset}\n{stats}"
+        stats += f"\nGitHub revalidations answered 304: {self.github.not_modified}"
+        stats += f"\nPrompt tokens read from provider cache: {self.cached_prompt_tokens}"
+        stats += f"\nAI responses repaired: {self.repairs}"
+        queued = [job.position for job in self.tasks.user_tasks(user_id) if job.position]
+        if queued:
+            stats = f"Your queued tasks: position {', '.join(map(str, queued))}\n{stats}"
         
-        if user_id not in self.active_fixes:
-            await update.message.reply_text("No active task sessions.")
+        fix_data = await self.sessions.get("fix", user_id)
+        if fix_data is None:
+            await update.message.reply_text(f"No active task sessions.\n{stats}")
             return
         
-        fix_data = self.active_fixes[user_id]
         task_type = fix_data.get('task_type', 'fix')
         task_labels = {
             "fix": "Bug Fix",
@@ -1204,7 +4935,8 @@ Respond in JSON format:
             f"**Active Task Session**\n"
             f"Type: {task_labels.get(task_type, 'Task')}\n"
             f"Repository: {fix_data['repo_name']}\n"
-            f"Description: {fix_data['description']}",
+            f"Description: {fix_data['description']}\n"
+            f"{stats}",
             parse_mode='Markdown'
         )
     
@@ -1212,19 +4944,108 @@ Respond in JSON format:
         """Cancel current operation"""
         user_id = update.effective_user.id
         
-        if user_id in self.active_fixes:
-            del self.active_fixes[user_id]
+        cancelled = self.tasks.cancel(user_id)
+        if cancelled or await self.sessions.get("fix", user_id) is not None:
+            await self.sessions.delete("fix", user_id)
             await update.message.reply_text("✅ Current operation cancelled.")
         else:
             await update.message.reply_text("No active operations to cancel.")
     
+    async def post_init(self, application: Application):
+        """Start background upkeep once the application is running"""
+        self._session_reaper = asyncio.create_task(self._reap_sessions(application))
+        metrics_port = os.getenv('REPOFIY_METRICS_PORT')
+        if metrics_port:
+            self._metrics_runner = await self.metrics.serve(
+                os.getenv('REPOFIY_METRICS_LISTEN', '0.0.0.0'), int(metrics_port)
+            )
+    
+    async def _reap_sessions(self, application: Application):
+        """Periodically drop expired sessions and idle users' in-memory data"""
+        while True:
+            await asyncio.sleep(600)
+            try:
+                purged = await self.sessions.purge_expired()
+                idle = self.persistence.forget_idle(application.user_data)
+                if purged or idle:
+                    logger.info(f"Expired {purged} stored sessions, released {idle} idle users")
+            except Exception as e:
+                logger.warning(f"Session cleanup failed: {str(e)}")
+    
+    async def shutdown(self, application: Application):
+        """Release shared resources when the application stops"""
+        if self._session_reaper is not None:
+            self._session_reaper.cancel()
+        if self._metrics_runner is not None:
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
+        await self.tasks.close()
+        await self.github.close()
+        self.responses.close()
+        await self.sessions.close()
+        await self.ai_clients.close()
+    
+    async def serve_webhook(self, application: Application, webhook_url: str):
+        """Run the bot behind a webhook until SIGINT/SIGTERM, then drain and shut down"""
+        secret_token = os.getenv('REPOFIY_WEBHOOK_SECRET') or hashlib.sha256(self.telegram_token.encode()).hexdigest()
+        server = WebhookServer(
+            application,
+            path=os.getenv('REPOFIY_WEBHOOK_PATH', '/telegram'),
+            secret_token=secret_token,
+            listen=os.getenv('REPOFIY_WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('REPOFIY_WEBHOOK_PORT', '8080')),
+            metrics=self.metrics,
+        )
+        
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        
+        await application.initialize()
+        await self.post_init(application)
+        try:
+            await server.start()
+            await application.bot.set_webhook(
+                url=webhook_url.rstrip('/') + server.path,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            await application.start()
+            server.ready = True
+            logger.info("🚀 Reopfiy Bot started (webhook)!")
+            
+            await stop.wait()
+            logger.info("Shutting down webhook server...")
+        finally:
+            # Stop taking updates first, then let the application finish queued ones
+            await server.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            await self.shutdown(application)
+    
     def run(self):
-        """Start the bot"""
-        application = Application.builder().token(self.telegram_token).build()
+        """Start the bot, behind a webhook when REPOFIY_WEBHOOK_URL is set, otherwise by polling"""
+        webhook_url = os.getenv('REPOFIY_WEBHOOK_URL')
+        builder = (
+            Application.builder()
+            .token(self.telegram_token)
+            # Handle updates from different users in parallel
+            .concurrent_updates(int(os.getenv('REPOFIY_CONCURRENT_UPDATES', '64')))
+            .persistence(self.persistence)
+            .post_init(self.post_init)
+            .post_shutdown(self.shutdown)
+        )
+        if webhook_url:
+            # Updates arrive through WebhookServer instead of PTB's updater
+            builder = builder.updater(None)
+        application = builder.build()
         
         # Add handlers
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(CommandHandler("setai", self.set_ai_command))
+        application.add_handler(CommandHandler("route", self.route_command))
         application.add_handler(CommandHandler("settoken", self.set_token_command))
         application.add_handler(CommandHandler("setrepo", self.set_repo_command))
         application.add_handler(CommandHandler("view", self.view_command))
@@ -1238,6 +5059,10 @@ Respond in JSON format:
         application.add_handler(CallbackQueryHandler(self.handle_callback))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
         
+        if webhook_url:
+            asyncio.run(self.serve_webhook(application, webhook_url))
+            return
+        
         logger.info("🚀 Reopfiy Bot started!")
         application.run_polling()
 
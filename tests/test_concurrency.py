@@ -0,0 +1,93 @@
+"""
+Concurrent /fix requests must overlap instead of queuing behind each other.
+
+Runs against the local GitHub and LLM stand-ins from benchmarks/servers.py,
+with the LLM answering after a fixed delay, and checks that N users'
+simultaneous /fix requests finish in roughly the time of one.
+
+    python -m unittest discover tests
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from servers import GitHubStandIn, LLMStandIn  # noqa: E402
+from fake_telegram import Outbox, FakeUpdate, FakeContext  # noqa: E402
+
+USERS = 8
+LLM_LATENCY = 1.0
+REQUEST = "Fix the login timing attack in auth: password hashes are compared with =="
+
+
+class ConcurrentFixTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.github = GitHubStandIn(100)
+        self.llm = LLMStandIn(latency=LLM_LATENCY)
+        await self.github.start()
+        await self.llm.start()
+        self.cache_dir = tempfile.TemporaryDirectory(prefix="repofiy-test-")
+        self.environ = dict(os.environ)
+        os.environ.update({
+            'REPOFIY_GITHUB_API_URL': self.github.url,
+            'REPOFIY_GROQ_URL': self.llm.endpoint,
+            'REPOFIY_OPENROUTER_URL': self.llm.endpoint,
+            'REPOFIY_CACHE_DIR': self.cache_dir.name,
+            'REPOFIY_SESSION_URL': 'memory://',
+            'REPOFIY_TELEGRAM_CHAT_INTERVAL': '0',
+            'REPOFIY_TASK_WORKERS': str(USERS),
+        })
+        import repofiy_bot
+        self.bot = repofiy_bot.BugFixerBot("test-telegram-token", groq_key="test-groq-key")
+        self.outbox = Outbox()
+
+    async def asyncTearDown(self):
+        await self.bot.shutdown(None)
+        await self.llm.stop()
+        await self.github.stop()
+        self.cache_dir.cleanup()
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    async def fix(self, user_id: int):
+        context = FakeContext({'github_token': 'test-github-token', 'repo': self.github.full_name, 'ai_provider': 'groq'})
+        update = FakeUpdate(self.outbox, user_id, f"/fix {REQUEST}")
+        await self.bot.process_code_task(update, context, REQUEST, "fix", bypass_cache=True)
+        while self.bot.tasks.user_tasks(user_id):
+            running = [job.task for job in self.bot.tasks.user_tasks(user_id) if job.task is not None]
+            if running:
+                await asyncio.wait(running)
+            else:
+                await asyncio.sleep(0.01)
+        solution = await self.bot.sessions.get("fix", user_id)
+        self.assertIsNotNone(solution, f"no proposal for user {user_id}")
+        self.assertTrue(solution['solution']['changes'])
+
+    async def test_simultaneous_fixes_take_about_as_long_as_one(self):
+        # Warm the repository caches so both measurements do the same work
+        await self.fix(1)
+
+        started = time.perf_counter()
+        await self.fix(2)
+        single = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await asyncio.gather(*(self.fix(user_id) for user_id in range(10, 10 + USERS)))
+        parallel = time.perf_counter() - started
+
+        self.assertGreaterEqual(single, LLM_LATENCY)
+        # Serialised, the batch would take USERS times as long
+        self.assertLess(parallel, single * 1.5, f"{USERS} fixes took {parallel:.2f}s, one took {single:.2f}s")
+        self.assertEqual(self.llm.stats.total_calls, USERS + 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
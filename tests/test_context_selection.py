@@ -0,0 +1,117 @@
+"""Choosing and packing code context: LexicalIndex ranking, ContextPacker budgets
+and get_code_context against the GitHub stand-in from benchmarks/servers.py."""
+
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from repofiy_bot import CodeChunker, ContextPacker, LexicalIndex, TreeEntry  # noqa: E402
+from servers import TARGET_PATH, GitHubStandIn  # noqa: E402
+
+
+def entry(path: str, sha: str = None) -> TreeEntry:
+    return TreeEntry(path, "blob", 100, sha or f"sha-{path}", "100644")
+
+
+class LexicalIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = LexicalIndex()
+        self.index.sync([entry("src/auth/session.py"), entry("src/billing/invoice.py"), entry("docs/guide.py")])
+
+    def test_tokenize_splits_identifiers(self):
+        tokens = set(LexicalIndex.tokenize("parseHTTPHeader session_token"))
+        self.assertTrue({"parsehttpheader", "parse", "http", "header", "session_token", "session", "token"} <= tokens)
+        self.assertNotIn("return", LexicalIndex.tokenize("return x"))
+
+    def test_paths_rank_before_any_content_is_known(self):
+        self.assertEqual(self.index.search("session expires too early")[0][0], "src/auth/session.py")
+
+    def test_content_and_symbols_are_searchable(self):
+        self.index.add_content("src/billing/invoice.py", "sha-src/billing/invoice.py",
+                               "def total(items):\n    return sum(i.price for i in items)\n", ["total"])
+        self.assertEqual(self.index.search("wrong price total")[0][0], "src/billing/invoice.py")
+        self.assertTrue(self.index.has_content("src/billing/invoice.py"))
+
+    def test_sync_drops_content_of_changed_files(self):
+        self.index.add_content("docs/guide.py", "sha-docs/guide.py", "refund policy", [])
+        self.index.sync([entry("src/auth/session.py"), entry("docs/guide.py", sha="changed")])
+        self.assertFalse(self.index.has_content("docs/guide.py"))
+        self.assertEqual(self.index.search("refund"), [])
+        self.assertNotIn("src/billing/invoice.py", self.index.docs)
+
+
+class ContextPackerTest(unittest.TestCase):
+
+    SOURCE = "".join(
+        f"def handler_{i}(value):\n" + "".join(f"    value = value * {j} + {i}\n" for j in range(20)) + "    return value\n\n\n"
+        for i in range(30)
+    ) + "def refresh_token(session):\n    return session.renew()\n"
+
+    def files(self):
+        return [("app.py", self.SOURCE, CodeChunker().chunks("app.py", "sha-app", self.SOURCE))]
+
+    def test_files_that_fit_go_in_whole(self):
+        packer = ContextPacker(100_000)
+        self.assertEqual(packer.pack(self.files(), "refresh token"), f"\n--- app.py ---\n{self.SOURCE}\n")
+
+    def test_large_files_contribute_matching_functions(self):
+        packer = ContextPacker(200)
+        packed = packer.pack(self.files(), "refresh token")
+        self.assertIn("--- app.py (excerpts) ---", packed)
+        self.assertIn("def refresh_token(session):", packed)
+        self.assertNotIn("def handler_0(", packed)
+        self.assertLessEqual(packer.used, packer.budget)
+
+
+class CodeContextTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.github = GitHubStandIn(300)
+        await self.github.start()
+        self.cache_dir = tempfile.TemporaryDirectory(prefix="repofiy-test-")
+        self.environ = dict(os.environ)
+        os.environ.update({
+            'REPOFIY_GITHUB_API_URL': self.github.url,
+            'REPOFIY_CACHE_DIR': self.cache_dir.name,
+            'REPOFIY_SESSION_URL': 'memory://',
+        })
+        os.environ.pop('REPOFIY_RESPONSE_CACHE_DB', None)
+        import repofiy_bot
+        self.bot = repofiy_bot.BugFixerBot("test-telegram-token", groq_key="test-groq-key")
+        self.repo = await self.bot.github.get_repo("test-github-token", self.github.full_name)
+
+    async def asyncTearDown(self):
+        # Let index-warming prefetches finish while the stand-in is still up
+        await asyncio.gather(*self.bot.github._background, return_exceptions=True)
+        await self.bot.shutdown(None)
+        await self.github.stop()
+        self.cache_dir.cleanup()
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    async def test_matching_path_is_read_on_a_cold_index(self):
+        context = await self.bot.get_code_context(self.repo, "the auth login compares password hashes with ==")
+        self.assertIn(f"--- {TARGET_PATH} ---", context)
+        self.assertIn("def login(user, password):", context)
+
+    async def test_unmatched_request_still_gets_some_code(self):
+        context = await self.bot.get_code_context(self.repo, "something feels slow lately")
+        self.assertNotIn("Error fetching code context", context)
+        self.assertIn("\n--- ", context)
+
+    async def test_warm_index_finds_files_by_content(self):
+        await self.bot.get_code_context(self.repo, "the auth login compares password hashes with ==")
+        # No path mentions pbkdf2, only the text of auth.py does
+        context = await self.bot.get_code_context(self.repo, "pbkdf2_hmac iteration count is too low")
+        self.assertIn(f"--- {TARGET_PATH} ---", context)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""GitHubGateway background work and rate limit budget, against a stub repository."""
+
+import asyncio
+import base64
+import os
+import sys
+import threading
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repofiy_bot import BlobCache, GitHubGateway, TreeCache, TreeEntry  # noqa: E402
+
+
+class StubRepo:
+    """Stands in for a PyGithub Repository whose blob downloads take `latency` seconds"""
+
+    def __init__(self, latency: float = 0.05, remaining: int = -1, limit: int = -1, reset: float = 0):
+        self.full_name = "octo/stub"
+        self.latency = latency
+        self.downloads = 0
+        self._lock = threading.Lock()
+        self._requester = types.SimpleNamespace(rate_limiting=(remaining, limit), rate_limiting_resettime=reset)
+
+    def get_git_blob(self, sha):
+        time.sleep(self.latency)
+        with self._lock:
+            self.downloads += 1
+        return types.SimpleNamespace(content=base64.b64encode(sha.encode()).decode())
+
+
+def entries(count: int):
+    return [TreeEntry(f"src/f{i}.py", "blob", 10, f"sha{i}", "100644") for i in range(count)]
+
+
+class GitHubGatewayTest(unittest.IsolatedAsyncioTestCase):
+
+    def gateway(self) -> GitHubGateway:
+        return GitHubGateway(BlobCache(1 << 20), TreeCache(4), max_workers=2)
+
+    async def test_close_cancels_prefetches_before_shutting_down(self):
+        github, repo = self.gateway(), StubRepo()
+        github.prefetch(repo, entries(50))
+        await asyncio.sleep(0.12)
+        await github.close()
+        self.assertEqual(github._background, set())
+        downloads = repo.downloads
+        self.assertLess(downloads, 50)
+        await asyncio.sleep(0.15)
+        # A download already running on a thread can finish, but nothing new starts
+        self.assertLessEqual(repo.downloads, downloads + 1)
+
+    async def test_prefetched_blobs_are_served_from_cache(self):
+        github, repo = self.gateway(), StubRepo(latency=0)
+        github.prefetch(repo, entries(3))
+        await asyncio.gather(*github._background)
+        self.assertEqual(await github.read_blob(repo, entries(3)[2]), b"sha2")
+        self.assertEqual(repo.downloads, 3)
+        await github.close()
+
+    async def test_exhausted_budget_fails_fast(self):
+        github = self.gateway()
+        repo = StubRepo(remaining=0, limit=5000, reset=time.time() + 600)
+        with self.assertRaisesRegex(RuntimeError, "resets in 10 min"):
+            await github.read_blob(repo, entries(1)[0])
+        self.assertEqual(repo.downloads, 0)
+        await github.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+"""PatchEngine placement of SEARCH/REPLACE blocks and diffs, and resolve_changes on real file bytes."""
+
+import asyncio
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repofiy_bot import BugFixerBot, PatchEngine, RepoTreeIndex, TreeEntry  # noqa: E402
+
+BASE = """import hmac
+
+
+def check(password, stored):
+    if not password:
+        return False
+    return hash(password) == stored
+
+
+def other():
+    return 1
+"""
+
+
+def block(search: str, replace: str) -> str:
+    return f"<<<<<<< SEARCH\n{search}\n=======\n{replace}\n>>>>>>> REPLACE"
+
+
+class PatchEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = PatchEngine()
+
+    def test_exact_block(self):
+        result = self.engine.apply(BASE, block(
+            "    return hash(password) == stored", "    return hmac.compare_digest(hash(password), stored)"
+        ))
+        self.assertEqual(result.conflicts, [])
+        self.assertIn("hmac.compare_digest(hash(password), stored)", result.content)
+        self.assertTrue(result.content.endswith("return 1\n"))
+
+    def test_block_with_lost_indentation_is_reindented(self):
+        result = self.engine.apply(BASE, block(
+            "if not password:\n    return False", "if not password:\n    raise ValueError('empty')"
+        ))
+        self.assertEqual(result.conflicts, [])
+        self.assertIn("    if not password:\n        raise ValueError('empty')\n", result.content)
+
+    def test_block_with_extra_blank_lines(self):
+        result = self.engine.apply(BASE, block("\ndef other():\n    return 1\n", "def other():\n    return 2"))
+        self.assertEqual(result.conflicts, [])
+        self.assertIn("    return 2\n", result.content)
+
+    def test_missing_lines_are_a_conflict(self):
+        result = self.engine.apply(BASE, block("def missing():\n    pass", "def missing():\n    return 0"))
+        self.assertEqual(result.applied, 0)
+        self.assertEqual(result.conflicts, ["block 1: the original lines were not found"])
+
+    def test_ambiguous_block_is_a_conflict(self):
+        result = self.engine.apply("x = 1\ny = 2\nx = 1\n", block("x = 1", "x = 3"))
+        self.assertEqual(result.content, "x = 1\ny = 2\nx = 1\n")
+        self.assertEqual(result.conflicts, ["block 1: the original lines match more than one place"])
+
+    def test_earlier_block_disambiguates_a_later_one(self):
+        change = block("x = 1\ny = 2", "x = 0\ny = 2") + "\n" + block("x = 1", "x = 5")
+        self.assertEqual(self.engine.apply("x = 1\ny = 2\nx = 1\n", change).content, "x = 0\ny = 2\nx = 5\n")
+
+    def test_unified_diff_with_shifted_line_numbers_and_stale_context(self):
+        diff = (
+            "--- a/auth.py\n+++ b/auth.py\n"
+            "@@ -20,4 +20,4 @@\n"
+            " def check(password, stored):\n"
+            "     if not password:\n"
+            "         return False\n"
+            "-    return hash(password) == stored\n"
+            "+    return hmac.compare_digest(hash(password), stored)\n"
+            " # context line the file no longer has\n"
+        )
+        result = self.engine.apply(BASE, diff)
+        self.assertEqual(result.conflicts, [])
+        self.assertIn("hmac.compare_digest", result.content)
+
+    def test_crlf_line_endings_are_kept(self):
+        base = BASE.replace("\n", "\r\n")
+        result = self.engine.apply(base, block("def other():\n    return 1", "def other():\n    return 2"))
+        self.assertIn("def other():\r\n    return 2\r\n", result.content)
+        self.assertNotIn("\r\r", result.content)
+
+    def test_full_content_for_a_new_file(self):
+        result = self.engine.apply(None, "print('hi')\n")
+        self.assertEqual(result, ("print('hi')\n", 0, []))
+
+    def test_edit_to_a_file_that_does_not_exist(self):
+        result = self.engine.apply(None, block("a", "b"))
+        self.assertEqual(result.conflicts, ["block 1: file does not exist"])
+
+
+class ResolveChangesTest(unittest.TestCase):
+
+    def resolve(self, blobs: dict, proposed: dict):
+        entries = [TreeEntry(path, "blob", len(data), f"sha-{path}", "100644") for path, data in blobs.items()]
+
+        async def read_blob(repo, entry):
+            return blobs[entry.path]
+
+        bot = types.SimpleNamespace(github=types.SimpleNamespace(read_blob=read_blob), patches=PatchEngine())
+        return asyncio.run(BugFixerBot.resolve_changes(bot, None, RepoTreeIndex(entries), proposed))
+
+    def test_edits_deletions_and_new_files(self):
+        changes, conflicts = self.resolve(
+            {"auth.py": BASE.encode(), "old.py": b"x\n"},
+            {"auth.py": block("def other():\n    return 1", "def other():\n    return 2"),
+             "old.py": None, "new.py": "y = 1\n"},
+        )
+        self.assertEqual(conflicts, [])
+        self.assertIn("return 2", changes["auth.py"])
+        self.assertIsNone(changes["old.py"])
+        self.assertEqual(changes["new.py"], "y = 1\n")
+
+    def test_non_utf8_file_is_refused_not_mangled(self):
+        changes, conflicts = self.resolve(
+            {"legacy.py": "# caf\xe9\nx = 1\n".encode("latin-1")},
+            {"legacy.py": block("x = 1", "x = 2")},
+        )
+        self.assertNotIn("legacy.py", changes)
+        self.assertEqual(conflicts, ["legacy.py: not a UTF-8 text file, edits can't be applied to it"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""ResponseParser and StreamingJSONTracker on well-formed, noisy and cut-off model output."""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repofiy_bot import ResponseParser, StreamingJSONTracker  # noqa: E402
+
+SOLUTION = {
+    "summary": "Compare password hashes in constant time",
+    "files": ["auth.py", "utils.py"],
+    "changes": {
+        "auth.py": "<<<<<<< SEARCH\nreturn a == b\n=======\nreturn hmac.compare_digest(a, b)\n>>>>>>> REPLACE",
+        "utils.py": "def call(f, a,}):\n    pass\n",
+    },
+    "diff_preview": "- a == b\n+ hmac.compare_digest(a, b)",
+}
+
+
+class ResponseParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = ResponseParser()
+        self.document = json.dumps(SOLUTION)
+
+    def test_plain_object(self):
+        data, problems = self.parser.parse(self.document)
+        self.assertEqual(problems, [])
+        self.assertEqual(data["changes"], SOLUTION["changes"])
+        self.assertNotIn("truncated", data)
+
+    def test_prose_and_fences_around_the_object(self):
+        data, _ = self.parser.parse(f"Here is the fix:\n```json\n{self.document}\n```\nHope it helps {{}}")
+        self.assertEqual(data["summary"], SOLUTION["summary"])
+
+    def test_balanced_braces_in_prose_are_skipped(self):
+        data, _ = self.parser.parse(f"I'll use {{curly}} braces. {self.document}")
+        self.assertEqual(data["files"], SOLUTION["files"])
+
+    def test_unmatched_brace_in_prose_is_skipped(self):
+        data, _ = self.parser.parse(f"The `{{` in line 3 is wrong. {self.document}")
+        self.assertEqual(data["files"], SOLUTION["files"])
+
+    def test_trailing_commas_outside_strings_are_removed(self):
+        document = self.document[:-1] + ',}'
+        data, _ = self.parser.parse(document.replace('"utils.py"],', '"utils.py",],'))
+        self.assertEqual(data["files"], SOLUTION["files"])
+        # The comma before "}" inside the code string is content, not syntax
+        self.assertEqual(data["changes"]["utils.py"], SOLUTION["changes"]["utils.py"])
+
+    def test_raw_newlines_inside_strings(self):
+        data, _ = self.parser.parse(self.document.replace("\\n", "\n"))
+        self.assertEqual(data["changes"], SOLUTION["changes"])
+
+    def test_cut_off_response_keeps_complete_changes_and_is_marked(self):
+        cut = self.document[:self.document.index('"utils.py": "') + 20]
+        data, problems = self.parser.parse(cut)
+        self.assertEqual(problems, [])
+        self.assertTrue(data["truncated"])
+        self.assertEqual(list(data["changes"]), ["auth.py"])
+        self.assertEqual(data["files"], SOLUTION["files"])
+
+    def test_optional_fields_of_the_wrong_type_are_coerced_or_dropped(self):
+        data, problems = self.parser.parse(json.dumps(
+            dict(SOLUTION, confidence=0.9, tests_to_run="pytest", cause={"why": "timing"})
+        ))
+        self.assertEqual(problems, [])
+        self.assertEqual(data["confidence"], "0.9")
+        self.assertEqual(data["tests_to_run"], ["pytest"])
+        self.assertNotIn("cause", data)
+
+    def test_missing_required_fields_are_reported(self):
+        data, problems = self.parser.parse('{"summary": "only this"}')
+        self.assertIsNone(data)
+        self.assertIn('"changes" is missing', problems)
+
+    def test_no_json_at_all(self):
+        self.assertEqual(self.parser.parse("Sorry, I can't help."), (None, ["the response contains no JSON object"]))
+
+
+class StreamingJSONTrackerTest(unittest.TestCase):
+
+    def test_completes_as_soon_as_the_object_closes(self):
+        document = json.dumps(SOLUTION)
+        tracker = StreamingJSONTracker()
+        text = "Sure: {curly} " + document + " and more text"
+        done_at = next(i for i in range(0, len(text), 7) if tracker.feed(text[i:i + 7]))
+        self.assertEqual(tracker.document, document)
+        self.assertEqual(tracker.rejected, ["{curly}"])
+        self.assertLess(done_at, len(text) - 7)
+
+    def test_partial_summary(self):
+        tracker = StreamingJSONTracker()
+        tracker.feed('{"summary": "Compare \\"hashes\\" in const')
+        self.assertEqual(tracker.partial_summary(), 'Compare "hashes" in const')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+"""ModelRouter tier selection: size, task, policy, errors and latency."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repofiy_bot import MODEL_TIERS, ModelRouter  # noqa: E402
+
+FAST = ("groq", MODEL_TIERS["groq"]["fast"])
+STRONG = ("groq", MODEL_TIERS["groq"]["strong"])
+
+
+class ModelRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = ModelRouter(small_tokens=1500, min_samples=5, max_latency=30)
+
+    def record(self, target, latency, count=5, ok=True):
+        for _ in range(count):
+            self.router.record(target, latency, ok)
+
+    def test_small_requests_and_fast_tasks_use_the_fast_model(self):
+        self.assertEqual(self.router.choose("groq", "fix", 200), FAST[1])
+        self.assertEqual(self.router.choose("groq", "revise", 5000), FAST[1])
+
+    def test_large_code_tasks_use_the_strong_model(self):
+        self.assertEqual(self.router.choose("groq", "fix", 5000), STRONG[1])
+
+    def test_failing_model_is_swapped_for_the_other_tier(self):
+        self.record(STRONG, 1.0, ok=False)
+        self.assertEqual(self.router.choose("groq", "fix", 5000), FAST[1])
+
+    def test_slow_strong_model_falls_back_to_the_fast_one(self):
+        self.record(STRONG, 45.0)
+        self.record(FAST, 3.0)
+        self.assertEqual(self.router.choose("groq", "fix", 5000), FAST[1])
+
+    def test_latency_needs_enough_samples(self):
+        self.record(STRONG, 45.0, count=4)
+        self.assertEqual(self.router.choose("groq", "fix", 5000), STRONG[1])
+
+    def test_slow_strong_model_is_kept_when_the_fast_one_is_no_better(self):
+        self.record(STRONG, 45.0)
+        self.record(FAST, 50.0)
+        self.assertEqual(self.router.choose("groq", "fix", 5000), STRONG[1])
+
+    def test_slow_strong_model_is_kept_when_the_fast_one_is_failing(self):
+        self.record(STRONG, 45.0)
+        self.record(FAST, 3.0, ok=False)
+        self.assertEqual(self.router.choose("groq", "fix", 5000), STRONG[1])
+
+    def test_quality_policy_ignores_latency(self):
+        self.record(STRONG, 45.0)
+        self.assertEqual(self.router.choose("groq", "fix", 200, policy="quality"), STRONG[1])
+
+    def test_latency_routing_can_be_disabled(self):
+        router = ModelRouter(max_latency=0)
+        for _ in range(5):
+            router.record(STRONG, 45.0, True)
+        self.assertEqual(router.choose("groq", "fix", 5000), STRONG[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""WebhookServer request handling: auth, readiness and malformed bodies."""
+
+import asyncio
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+
+from repofiy_bot import WebhookServer  # noqa: E402
+
+SECRET = "test-secret"
+
+
+class WebhookServerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.application = types.SimpleNamespace(bot=None, update_queue=asyncio.Queue(), running=True)
+        self.server = WebhookServer(self.application, secret_token=SECRET)
+        self.server.ready = True
+        self.client = TestClient(TestServer(self.server.app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def post(self, body: bytes, secret: str = SECRET) -> int:
+        response = await self.client.post(
+            "/telegram", data=body,
+            headers={WebhookServer.SECRET_HEADER: secret, "Content-Type": "application/json"},
+        )
+        return response.status
+
+    async def test_valid_update_is_queued(self):
+        self.assertEqual(await self.post(b'{"update_id": 7}'), 200)
+        self.assertEqual(self.application.update_queue.get_nowait().update_id, 7)
+
+    async def test_wrong_secret_is_forbidden(self):
+        self.assertEqual(await self.post(b'{"update_id": 7}', secret="nope"), 403)
+
+    async def test_not_ready_is_unavailable(self):
+        self.server.ready = False
+        self.assertEqual(await self.post(b'{"update_id": 7}'), 503)
+
+    async def test_malformed_bodies_are_rejected(self):
+        for body in (b'{"update_id": ', b'[1, 2]', '{"update_id": "caf\xe9"}'.encode("latin-1"),
+                     b'{"update_id": 7, "message": "not an object"}'):
+            with self.subTest(body=body):
+                self.assertEqual(await self.post(body), 400)
+        self.assertTrue(self.application.update_queue.empty())
+
+
+if __name__ == "__main__":
+    unittest.main()